@@ -25,6 +25,67 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from __future__ import (absolute_import, division, print_function)
+from collections import OrderedDict
+import re
+
+# Markers written to the output by instrumented driver programs:
+marker_prefix = 'FRUITPy '
+timing_marker = marker_prefix + 'timing:'
+case_start_marker = marker_prefix + 'case start:'
+case_end_marker = marker_prefix + 'case end:'
+
+# Patterns for scanning Fortran source dependencies:
+use_pattern = re.compile(r'\s*use\b\s*(?:,\s*(intrinsic|non_intrinsic)\s*)?'
+                         r'(?:::)?\s*(\w+)', re.IGNORECASE)
+module_pattern = re.compile(r'^[ \t]*module[ \t]+'
+                            r'(?!(?:procedure|subroutine|function)\b)(\w+)',
+                            re.IGNORECASE | re.MULTILINE)
+submodule_pattern = re.compile(r'^[ \t]*submodule[ \t]*\([ \t]*(\w+)',
+                               re.IGNORECASE | re.MULTILINE)
+use_statement_pattern = re.compile(r'^' + use_pattern.pattern,
+                                   re.IGNORECASE | re.MULTILINE)
+include_pattern = re.compile(r'^[ \t]*#?[ \t]*include[ \t]*[\'"]([^\'"]+)',
+                             re.IGNORECASE | re.MULTILINE)
+
+# Patterns for scanning test modules, matching end statements, module
+# statements, the start of interface blocks, subroutines and use
+# statements, and (if the text contains any) functions. For subroutines,
+# the first non-blank line following the statement (and any continuation
+# lines) is also captured, as it may contain the description. The patterns
+# are matched against lower-cased text (so do not need to ignore case,
+# which is slower) with newlines added at both ends, and start
+# with a newline rather than '^' (and check the first letter of the
+# statement) so the regular expression engine can skip other lines
+# quickly. The last group in each alternative identifies the type of
+# statement matched. As statements are only matched at the start of
+# lines, comments and continued string literals (whose continuation lines
+# must start with '&') cannot be mistaken for them, and the function
+# alternative skips over any string literals before the 'function'
+# keyword. Carriage returns are allowed before line ends, for files with
+# Windows line endings read on Python 2:
+test_statement_alternatives = [
+    r'end(?:[ \t]*(?P<end>subroutine|function|interface|module)\b[^\n!]*)?'
+    r'[ \t\r]*(?:!|$)',
+    r'module[ \t]+(?P<module>\w+)[ \t\r]*(?:!|$)',
+    r'(?:abstract[ \t]+)?(?P<interface>interface)\b',
+    r'(?:(?:pure|impure|elemental|recursive|non_recursive|module)[ \t]+)*'
+    r'subroutine[ \t]+(?:&[ \t]*\n[ \t]*&?[ \t]*)?(?P<subroutine>\w+)'
+    r'(?=[^\n&]*(?:&(?:[ \t]*(?:![^\n]*)?\n)?[^\n&]*)*\n\s*'
+    r'(?P<following>[^\n]*))',
+    r'use\b[ \t]*(?:,[ \t]*(?P<nature>intrinsic|non_intrinsic)[ \t]*)?'
+    r'(?:::)?[ \t]*(?P<use>\w+)']
+function_statement_alternative = (
+    r'(?:(?:pure|impure|elemental|recursive|non_recursive|module|integer|'
+    r'real|double|complex|logical|character|type|class)'
+    r'(?:[^\n!\'"]|"[^"\n]*"|\'[^\'\n]*\')*?[ \t])?'
+    r'(?P<function>function)[ \t]+\w+[ \t]*[(&]')
+test_statement_pattern = re.compile(
+    r'\n[ \t]*(?=[aeimnprsu])(?:' + '|'.join(test_statement_alternatives) +
+    ')', re.MULTILINE)
+test_function_statement_pattern = re.compile(
+    r'\n[ \t]*(?=[acdefilmnprstu])(?:' +
+    '|'.join(test_statement_alternatives +
+             [function_statement_alternative]) + ')', re.MULTILINE)
 
 
 def subroutine_type(name):
@@ -49,6 +110,8 @@ def subroutine_type(name):
 class test_subroutine(object):
     """Stores test subroutine data."""
 
+    __slots__ = ['name', 'description', 'subtype']
+
     def __init__(self, name="", description="", subtype=None):
         self.name = name
         self.description = description
@@ -57,75 +120,1148 @@ class test_subroutine(object):
 
 class test_module(object):
 
-    """Stores test module data."""
+    """Stores test module data. Slots are used to keep the memory needed
+    for large test suites down. If lazy is True, the test file is not
+    parsed until its data are first needed, and the data are then taken
+    from the cache (a parse_cache), if there is one and it has a valid
+    entry for the file."""
 
-    def __init__(self, test_filename):
+    data_names = ['test_module_name', 'setup', 'teardown', 'global_setup',
+                  'global_teardown', 'subroutines', 'uses']
+    __slots__ = ['test_filename', 'cache'] + data_names
+
+    def __init__(self, test_filename, data=None, lazy=False, cache=None):
         self.test_filename = test_filename
-        self.parse()
+        self.cache = cache
+        if data is not None:
+            self.set_data(data)
+        elif not lazy:
+            self.parse()
 
     def __repr__(self):
         return str([sub.name for sub in self.subroutines])
 
+    def __getattr__(self, name):
+        """Loads module data when they are first needed, for a module
+        created lazily. Attributes other than the subroutines are taken
+        from a valid cache entry, if there is one, without loading the
+        subroutines, so that e.g. checking for global setup or finding
+        impacted modules does not load the whole suite."""
+        if name in test_module.data_names:
+            data = None
+            if self.cache is not None:
+                data = self.cache.get(self.test_filename)
+            if data is None:
+                self.parse_to_cache()
+            elif name == 'subroutines':
+                self.set_data(data)
+            else:
+                self.set_summary(data)
+            return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def get_loaded(self):
+        try:
+            object.__getattribute__(self, 'subroutines')
+            return True
+        except AttributeError:
+            return False
+    loaded = property(get_loaded)
+
+    def load(self):
+        """Loads module data from the cache, if possible, otherwise parses
+        the test file (and adds its data to the cache)."""
+        data = None
+        if self.cache is not None:
+            data = self.cache.get(self.test_filename)
+        if data is None:
+            self.parse_to_cache()
+        else:
+            self.set_data(data)
+
+    def parse_to_cache(self):
+        """Parses the test file, and adds its data to the cache if there is
+        one."""
+        data = parse_test_module_data(self.test_filename)
+        if self.cache is not None:
+            self.cache.put(self.test_filename, data)
+        self.set_data(data)
+
     def parse(self):
-        """Parse module name and test cases."""
-        with open(self.test_filename) as f:
-            self.parse_test_module_name(f)
-            self.parse_subroutines(f)
+        """Parses module name and test cases."""
+        self.set_data(parse_test_module_data(self.test_filename))
 
     def parse_test_module_name(self, f):
-        """Parses test module name from file f."""
-        self.test_module_name = None
-        while self.test_module_name is None:
-            line = f.readline()
-            imod = line.lower().find('module')
-            if imod >= 0 and '!' not in line[:imod]:
-                self.test_module_name = line[imod:].strip().split()[1]
+        """Parses test module name. Deprecated: the whole test file is
+        parsed by parse_test_module_data(), and f is not used."""
+        import warnings
+        warnings.warn("parse_test_module_name() is deprecated, "
+                      "use parse_test_module_data()",
+                      DeprecationWarning, stacklevel=2)
+        data = parse_test_module_data(self.test_filename)
+        self.test_module_name = data['test_module_name']
 
     def parse_subroutine_description(self, f, subname):
-        """Parses subroutine to find its description."""
-        line = f.readline()
-        while not line.strip():
-            line = f.readline()
-        comment_pos = line.find('!')
-        if comment_pos >= 0:
-            description = line[comment_pos+1:].strip()
-        else:
-            description = subname
-        return description
+        """Returns description of a subroutine. Deprecated: the whole test
+        file is parsed by parse_test_module_data(), and f is not used."""
+        import warnings
+        warnings.warn("parse_subroutine_description() is deprecated, "
+                      "use parse_test_module_data()",
+                      DeprecationWarning, stacklevel=2)
+        data = parse_test_module_data(self.test_filename)
+        for name, description, subtype in data['subroutines']:
+            if name == subname:
+                return description
+        return subname
 
     def parse_subroutine(self, f, line):
-        """Parses a single subroutine in a test module."""
-        isub = line.lower().find('subroutine')
-        pre = line[:isub]
-        if '!' not in pre and 'end' not in pre.lower():
-            subname = line[isub:].strip().split()[1]
-            bracpos = subname.find('(')
-            if bracpos >= 0:
-                subname = subname[:bracpos]
-            subtype = subroutine_type(subname)
-            if subtype == 'test':
-                description = self.parse_subroutine_description(f, subname)
-                sub = test_subroutine(subname, description, subtype)
-                self.subroutines.append(sub)
-            elif subtype == 'setup':
-                self.setup = subname
-            elif subtype == 'teardown':
-                self.teardown = subname
-            elif subtype == 'global setup':
-                self.global_setup = True
-            elif subtype == 'global teardown':
-                self.global_teardown = True
+        """Parses subroutines in test module. Deprecated: the whole test
+        file is parsed by parse_test_module_data(), so all its subroutines
+        are set, and f and line are not used."""
+        import warnings
+        warnings.warn("parse_subroutine() is deprecated, "
+                      "use parse_test_module_data()",
+                      DeprecationWarning, stacklevel=2)
+        self.set_data(parse_test_module_data(self.test_filename))
 
     def parse_subroutines(self, f):
-        """Parses subroutines in test module."""
-        self.setup, self.teardown = None, None
-        self.global_setup, self.global_teardown = False, False
-        self.subroutines = []
-        line = f.readline()
-        while line:
-            if 'subroutine' in line.lower():
-                self.parse_subroutine(f, line)
-            line = f.readline()
+        """Parses subroutines in test module. Deprecated: the whole test
+        file is parsed by parse_test_module_data(), and f is not used."""
+        import warnings
+        warnings.warn("parse_subroutines() is deprecated, "
+                      "use parse_test_module_data()",
+                      DeprecationWarning, stacklevel=2)
+        self.set_data(parse_test_module_data(self.test_filename))
+
+    def get_data(self):
+        """Returns parsed module data as a dictionary, e.g. for caching."""
+        return {'test_module_name': self.test_module_name,
+                'setup': self.setup, 'teardown': self.teardown,
+                'global_setup': self.global_setup,
+                'global_teardown': self.global_teardown,
+                'subroutines': [[sub.name, sub.description, sub.subtype]
+                                for sub in self.subroutines],
+                'uses': self.uses}
+
+    def set_data(self, data):
+        """Sets module data from a dictionary, as returned by get_data().
+        Descriptions equal to subroutine names share the same string."""
+        self.set_summary(data)
+        self.subroutines = [test_subroutine(name, name if description == name
+                                            else description, subtype)
+                            for name, description, subtype
+                            in data['subroutines']]
+
+    def set_summary(self, data):
+        """Sets module data other than the subroutines from a dictionary,
+        as returned by get_data()."""
+        self.test_module_name = data['test_module_name']
+        self.setup, self.teardown = data['setup'], data['teardown']
+        self.global_setup = data['global_setup']
+        self.global_teardown = data['global_teardown']
+        self.uses = data['uses']
+
+
+def scan_test_modules(text):
+    """Scans the text of a test file and returns a list of data
+    dictionaries (as for test_module.get_data()) for the modules it
+    defines. Only subroutines at the top level of each module are
+    considered, not those in interface blocks or contained in other
+    procedures. The description of a test subroutine is the comment on the
+    first non-blank line after the subroutine statement if there is one,
+    otherwise the subroutine name. The uses list for each module contains
+    the names of all non-intrinsic modules used in the file."""
+    modules, uses = [], []
+    data, depth = None, 0
+    text = '\n' + text + '\n'
+    lowered = text.lower()
+    if len(lowered) != len(text):  # only U+0130 lowercases to two chars
+        lowered = text.replace(u'\u0130', 'I').lower()
+    if 'function' in lowered:
+        pattern = test_function_statement_pattern
+    else:
+        pattern = test_statement_pattern
+    for match in pattern.finditer(lowered):
+        statement = match.lastgroup
+        if statement == 'following':
+            if data is not None and depth == 0:
+                name = text[match.start('subroutine'):
+                            match.end('subroutine')]
+                subtype = subroutine_type(name)
+                if subtype == 'test':
+                    line = text[match.start('following'):
+                                match.end('following')]
+                    comment_pos = line.find('!')
+                    if comment_pos >= 0:
+                        description = line[comment_pos+1:].strip()
+                    else:
+                        description = name
+                    data['subroutines'].append([name, description, subtype])
+                elif subtype in ['setup', 'teardown']:
+                    data[subtype] = name
+                elif subtype is not None:
+                    data[subtype.replace(' ', '_')] = True
+            depth += 1
+        elif statement == 'use':
+            name = match.group('use')
+            if match.group('nature') != 'intrinsic' and name not in uses:
+                uses.append(name)
+        elif statement in ['function', 'interface']:
+            depth += 1
+        elif statement == 'module':
+            if data is None:
+                data = {'test_module_name':
+                        text[match.start('module'):match.end('module')],
+                        'setup': None, 'teardown': None,
+                        'global_setup': False, 'global_teardown': False,
+                        'subroutines': [], 'uses': uses}
+                modules.append(data)
+                depth = 0
+        else:
+            end = match.group('end') or ''
+            if depth > 0 and end != 'module':
+                depth -= 1
+            elif end in ['', 'module']:
+                data, depth = None, 0
+    return modules
+
+
+def parse_test_module_data(test_filename):
+    """Parses test module file and returns its data dictionary. The whole
+    file is read and scanned at once. If it contains more than one module,
+    the first one containing test cases is used. (Defined at module level
+    so it can be used by a multiprocessing pool.)"""
+    with open(test_filename) as f:
+        modules = scan_test_modules(f.read())
+    if not modules:
+        raise ValueError("No module found in test file %s" % test_filename)
+    tested = [data for data in modules if data['subroutines']]
+    return (tested or modules)[0]
+
+
+def file_hash(filename):
+    """Returns SHA-1 hex digest of file contents."""
+    import hashlib
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def replace_file(source, destination):
+    """Renames source file to destination, replacing it if it exists."""
+    import os
+    try:
+        os.replace(source, destination)
+    except AttributeError:  # Python 2
+        if os.path.isfile(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+class parse_cache(object):
+
+    """On-disk cache of parsed test module data, stored in a JSON file.
+    Entries are keyed by absolute test file path. An entry is valid if the
+    file size and modification time are unchanged, or failing that, if the
+    file contents hash is unchanged. If there are more than max_entries
+    entries when the cache is saved, the least recently used ones are
+    evicted. Usage counters alone do not make the cache modified, so a
+    cache with only hits is not rewritten, and the counters are only
+    saved along with other changes."""
+
+    version = 3
+
+    def __init__(self, filename, max_entries=10000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hits, self.misses = 0, 0
+        self.load()
+
+    def __repr__(self):
+        return "%s: %d entries" % (self.filename, len(self.entries))
+
+    def load(self):
+        """Loads cache from file. A missing, unreadable or out of date cache
+        file gives an empty cache."""
+        import json
+        self.entries, self.counter = {}, 0
+        self.modified = False
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get('version') == self.version:
+            self.entries = data['entries']
+            self.counter = data['counter']
+
+    def save(self):
+        """Evicts excess entries and writes cache to file, if it has been
+        modified."""
+        import json
+        self.evict()
+        if self.modified:
+            tmpname = self.filename + '.tmp'
+            with open(tmpname, 'w') as f:
+                json.dump({'version': self.version, 'counter': self.counter,
+                           'entries': self.entries}, f)
+            replace_file(tmpname, self.filename)
+            self.modified = False
+
+    def evict(self):
+        """Removes least recently used entries in excess of max_entries."""
+        excess = len(self.entries) - self.max_entries
+        if excess > 0:
+            keys = sorted(self.entries,
+                          key=lambda k: self.entries[k]['used'])
+            for key in keys[:excess]:
+                del self.entries[key]
+            self.modified = True
+
+    def clear(self):
+        """Removes all cache entries."""
+        self.entries = {}
+        self.modified = True
+
+    def touch(self, entry):
+        """Marks cache entry as most recently used."""
+        self.counter += 1
+        entry['used'] = self.counter
+
+    def get(self, test_filename):
+        """Returns cached data for the specified test file, or None if there
+        is no valid entry for it."""
+        from os import stat
+        from os.path import abspath
+        entry = self.entries.get(abspath(test_filename))
+        if entry is not None:
+            st = stat(test_filename)
+            if st.st_size == entry['size']:
+                if st.st_mtime == entry['mtime']:
+                    self.touch(entry)
+                    self.hits += 1
+                    return entry['data']
+                elif file_hash(test_filename) == entry['hash']:
+                    entry['mtime'] = st.st_mtime
+                    self.touch(entry)
+                    self.modified = True
+                    self.hits += 1
+                    return entry['data']
+        self.misses += 1
+        return None
+
+    def put(self, test_filename, data):
+        """Adds data for the specified test file to the cache."""
+        from os import stat
+        from os.path import abspath
+        st = stat(test_filename)
+        entry = {'size': st.st_size, 'mtime': st.st_mtime,
+                 'hash': file_hash(test_filename), 'data': data}
+        self.touch(entry)
+        self.entries[abspath(test_filename)] = entry
+        self.modified = True
+
+
+def scan_fortran_dependencies(filename):
+    """Scans Fortran source file and returns a tuple of lists of the names
+    of modules it defines, modules it depends on (via use statements or as
+    the parent of a submodule) and files it includes."""
+    import io
+    with io.open(filename, encoding='utf-8', errors='replace') as f:
+        text = f.read()
+    modules = [name.lower() for name in module_pattern.findall(text)]
+    uses = [name.lower() for nature, name in
+            use_statement_pattern.findall(text)
+            if nature.lower() != 'intrinsic']
+    uses += [name.lower() for name in submodule_pattern.findall(text)]
+    includes = include_pattern.findall(text)
+    return modules, sorted(set(uses) - set(modules)), includes
+
+
+class module_graph(object):
+
+    """Graph of dependencies between Fortran source files, built from the
+    modules they define and use, and the files they include. Source files
+    can be added individually or by scanning directories."""
+
+    source_extensions = ['.f', '.for', '.f77', '.f90', '.f95', '.f03',
+                         '.f08']
+
+    def __init__(self, source_dirs=None, source_files=None):
+        self.defines, self.depends = {}, {}
+        self.module_files = {}
+        for source_dir in source_dirs or []:
+            self.add_dir(source_dir)
+        for source_file in source_files or []:
+            self.add_file(source_file)
+
+    def __repr__(self):
+        return "%d files, %d modules" % (len(self.defines),
+                                         len(self.module_files))
+
+    def add_dir(self, source_dir):
+        """Adds all Fortran source files in a directory (and its
+        subdirectories) to the graph."""
+        import os
+        for path, dirs, files in os.walk(source_dir):
+            for filename in sorted(files):
+                ext = os.path.splitext(filename)[1].lower()
+                if ext in self.source_extensions:
+                    self.add_file(os.path.join(path, filename))
+
+    def add_file(self, filename):
+        """Adds a Fortran source file to the graph (re-scanning it if it
+        has already been added)."""
+        from os.path import abspath, dirname, join
+        key = abspath(filename)
+        modules, uses, includes = scan_fortran_dependencies(filename)
+        self.add(key, modules, uses, [abspath(join(dirname(key), include))
+                                      for include in includes])
+
+    def add_test_module(self, mod):
+        """Adds the file for a parsed test_module to the graph, using its
+        module name and use statements."""
+        from os.path import abspath
+        self.add(abspath(mod.test_filename), [mod.test_module_name.lower()],
+                 mod.uses)
+
+    def add(self, filename, modules, uses, includes=None):
+        """Adds a file to the graph, with the modules it defines, modules it
+        uses and files it includes."""
+        self.defines[filename] = modules
+        for module_name in modules:
+            self.module_files[module_name] = filename
+        self.depends[filename] = (uses, includes or [])
+
+    def file_dependencies(self, filename):
+        """Returns set of files the specified file depends on directly, via
+        modules used (if their source files are in the graph) and included
+        files."""
+        from os.path import abspath
+        uses, includes = self.depends.get(abspath(filename), ([], []))
+        files = set([self.module_files[module_name] for module_name in uses
+                     if module_name in self.module_files])
+        return files | set(includes)
+
+    def dependencies(self, filename):
+        """Returns set of files the specified file depends on, directly or
+        indirectly."""
+        result, todo = set(), [filename]
+        while todo:
+            for dep in self.file_dependencies(todo.pop()):
+                if dep not in result:
+                    result.add(dep)
+                    todo.append(dep)
+        return result
+
+    def affected(self, changed_files):
+        """Returns set of files in the graph affected by changes to the
+        specified files, i.e. the changed files themselves and all files
+        depending on them directly or indirectly."""
+        from os.path import abspath
+        dependents = {}
+        for filename in self.depends:
+            for dep in self.file_dependencies(filename):
+                dependents.setdefault(dep, []).append(filename)
+        result = set([abspath(filename) for filename in changed_files])
+        todo = list(result)
+        while todo:
+            for filename in dependents.get(todo.pop(), []):
+                if filename not in result:
+                    result.add(filename)
+                    todo.append(filename)
+        return result
+
+
+class file_watcher(object):
+
+    """Watches files, and Fortran source files in directories (and their
+    subdirectories), for changes in size or modification time. Changes are
+    found by polling, but on Linux inotify is used (if available) to wake
+    up as soon as anything in the watched directories changes. Files and
+    directories in the ignore list (e.g. generated driver files) are not
+    watched."""
+
+    # inotify event mask: modify, attrib, close write, moved from, moved
+    # to, create and delete:
+    inotify_mask = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    inotify_isdir = 0x40000000
+
+    def __init__(self, filenames=None, dirs=None, interval=0.5,
+                 debounce=0.2, use_inotify=True, ignore=None):
+        import os
+        self.filenames = list(filenames or [])
+        self.dirs = list(dirs or [])
+        self.interval, self.debounce = interval, debounce
+        self.ignore = [os.path.abspath(path) for path in ignore or []]
+        self.inotify = None
+        if use_inotify:
+            self.start_inotify()
+        self.files = self.scan()
+
+    def __repr__(self):
+        return "%d files watched" % len(self.files)
+
+    def ignored(self, path):
+        """Returns True if the path is in the ignore list, or in a directory
+        in it."""
+        import os
+        path = os.path.abspath(path)
+        return any([path == ignore or path.startswith(ignore + os.sep)
+                    for ignore in self.ignore])
+
+    def walk(self, source_dir):
+        """Walks the directory tree as for os.walk(), skipping ignored
+        directories."""
+        import os
+        for path, dirs, names in os.walk(source_dir):
+            dirs[:] = [name for name in dirs
+                       if not self.ignored(os.path.join(path, name))]
+            yield path, dirs, names
+
+    def scan(self):
+        """Returns dictionary of (size, modification time) tuples for the
+        watched files, keyed by absolute path."""
+        import os
+        files = {}
+        filenames = list(self.filenames)
+        for source_dir in self.dirs:
+            for path, dirs, names in self.walk(source_dir):
+                filenames += [os.path.join(path, name) for name in names
+                              if os.path.splitext(name)[1].lower() in
+                              module_graph.source_extensions]
+        for filename in filenames:
+            if self.ignored(filename):
+                continue
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            files[os.path.abspath(filename)] = (st.st_size, st.st_mtime)
+        return files
+
+    def changes(self):
+        """Returns sorted list of files changed, added or removed since the
+        last check."""
+        files = self.scan()
+        changed = [filename for filename in set(files) | set(self.files)
+                   if files.get(filename) != self.files.get(filename)]
+        self.files = files
+        return sorted(changed)
+
+    def start_inotify(self):
+        """Starts watching the directories containing the watched files and
+        directories using inotify, if available."""
+        import ctypes
+        import ctypes.util
+        import os
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                               use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_init1.restype = ctypes.c_int
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                               ctypes.c_uint32]
+            libc.inotify_add_watch.restype = ctypes.c_int
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+        except (OSError, AttributeError, TypeError):
+            return
+        if fd < 0:
+            return
+        self.inotify, self.libc = fd, libc
+        self.watches, self.tree_watches = {}, set()
+        for path in set([os.path.dirname(os.path.abspath(filename))
+                         for filename in self.filenames]):
+            self.add_watch(path)
+        for source_dir in self.dirs:
+            self.watch_tree(source_dir)
+
+    def add_watch(self, path, tree=False):
+        """Adds an inotify watch for the directory. If tree is True, watches
+        are also added for any subdirectories created in it later."""
+        import os
+        wd = self.libc.inotify_add_watch(self.inotify,
+                                         os.path.abspath(path).encode(),
+                                         self.inotify_mask)
+        if wd >= 0:
+            self.watches[wd] = os.path.abspath(path)
+            if tree:
+                self.tree_watches.add(wd)
+
+    def watch_tree(self, source_dir):
+        """Adds inotify watches for the directory and its subdirectories."""
+        for path, dirs, names in self.walk(source_dir):
+            self.add_watch(path, True)
+
+    def read_events(self):
+        """Reads pending inotify events, adding watches for directories
+        created in (or moved into) watched directory trees."""
+        import os
+        import struct
+        import sys
+        header = struct.calcsize('iIII')
+        try:
+            while True:
+                data = os.read(self.inotify, 65536)
+                if not data:
+                    break
+                pos = 0
+                while pos + header <= len(data):
+                    wd, mask, cookie, length = struct.unpack_from(
+                        'iIII', data, pos)
+                    name = data[pos + header:pos + header + length]
+                    pos += header + length
+                    if mask & self.inotify_isdir and \
+                       mask & (0x80 | 0x100) and wd in self.tree_watches:
+                        name = name.rstrip(b'\0').decode(
+                            sys.getfilesystemencoding())
+                        path = os.path.join(self.watches[wd], name)
+                        if not self.ignored(path):
+                            self.watch_tree(path)
+        except OSError:
+            pass
+
+    def sleep(self, seconds):
+        """Waits for the specified time, or (if inotify is used) until
+        something in the watched directories changes."""
+        import select
+        import time
+        if self.inotify is None:
+            time.sleep(seconds)
+        elif select.select([self.inotify], [], [], seconds)[0]:
+            self.read_events()
+
+    def wait(self, timeout=None):
+        """Waits until any watched files change, and returns a sorted list
+        of the changed files. Once a change is found, further changes are
+        collected until none have been made for the debounce time (e.g.
+        while an editor saves several files). Returns an empty list if
+        there are no changes within the timeout (if specified)."""
+        import time
+        start = time.time()
+        changed = []
+        while not changed:
+            if timeout is not None and time.time() - start >= timeout:
+                return []
+            self.sleep(self.interval if timeout is None else
+                       min(self.interval, timeout))
+            changed = self.changes()
+        while True:
+            time.sleep(self.debounce)
+            more = self.changes()
+            if not more:
+                return changed
+            changed = sorted(set(changed) | set(more))
+
+    def close(self):
+        """Stops using inotify."""
+        import os
+        if self.inotify is not None:
+            os.close(self.inotify)
+            self.inotify = None
+
+
+class build_fingerprint(object):
+
+    """Fingerprint of the inputs to a driver build (build command and
+    content hashes of the driver source, test module sources and any other
+    dependency files), stored in a JSON file. File hashes are only
+    recomputed for files whose size or modification time have changed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.load()
+
+    def load(self):
+        """Loads fingerprint from file, if it exists."""
+        import json
+        self.build_command, self.files = None, {}
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+            self.build_command, self.files = data['build_command'], \
+                data['files']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        """Writes fingerprint to file."""
+        import json
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump({'build_command': self.build_command,
+                       'files': self.files}, f)
+        replace_file(tmpname, self.filename)
+
+    def remove(self):
+        """Removes fingerprint file, if it exists."""
+        from os import remove
+        from os.path import isfile
+        if isfile(self.filename):
+            remove(self.filename)
+
+    def update(self, build_command, filenames):
+        """Updates fingerprint for the specified build command (list) and
+        input files, and returns a list of reasons why it has changed
+        (empty if it is unchanged)."""
+        from os import stat
+        from os.path import abspath, isfile
+        if self.build_command is None:
+            reasons = ['no previous build fingerprint']
+        else:
+            reasons = []
+            if build_command != self.build_command:
+                reasons.append('build command changed')
+        files = {}
+        for filename in filenames:
+            key = abspath(filename)
+            if not isfile(filename):
+                reasons.append('missing: ' + filename)
+                continue
+            st = stat(filename)
+            old = self.files.get(key)
+            if old is not None and old[:2] == [st.st_size, st.st_mtime]:
+                digest = old[2]
+            else:
+                digest = file_hash(filename)
+            files[key] = [st.st_size, st.st_mtime, digest]
+            if self.build_command is not None:
+                if old is None:
+                    reasons.append('added: ' + filename)
+                elif old[2] != digest:
+                    reasons.append('changed: ' + filename)
+        if self.build_command is not None:
+            reasons += ['removed: ' + key for key in sorted(self.files)
+                        if key not in files]
+        self.build_command, self.files = build_command, files
+        return reasons
+
+
+class variant_manifest(object):
+
+    """Manifest of the configuration variants of a driver program (see
+    variant_name()) that have been built, stored in a JSON file. For each
+    variant it records the driver options, the driver source and
+    executable names, and the time of the last successful build."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.load()
+
+    def __repr__(self):
+        return ', '.join(sorted(self.variants))
+
+    def load(self):
+        """Loads manifest from file, if it exists."""
+        import json
+        self.variants = {}
+        try:
+            with open(self.filename) as f:
+                self.variants = json.load(f)['variants']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        """Writes manifest to file."""
+        import json
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump({'variants': self.variants}, f, indent=2,
+                      sort_keys=True)
+        replace_file(tmpname, self.filename)
+
+    def add(self, name, options, driver, exes):
+        """Records a successful build of the named variant, with the
+        specified driver options (dictionary), driver source name and list
+        of executables."""
+        import time
+        self.variants[name] = {'options': options, 'driver': driver,
+                               'exes': list(exes), 'built': time.time()}
+
+    def get(self, name):
+        """Returns manifest entry for the named variant, or None if it has
+        not been built."""
+        return self.variants.get(name)
+
+
+class fortran_build(object):
+
+    """Native build engine for FRUIT driver programs, which can be passed
+    to test_suite.build() (or build_run()) in place of a build command. The
+    driver, test module sources and any other sources (specified as files
+    or directories) are compiled in dependency order, in parallel using up
+    to the specified number of processes (by default the number of CPUs),
+    and linked. Object and module files for each source file are cached in
+    a subdirectory of cache_dir, keyed by a hash of the compiler and flags,
+    the contents of the source and any files it includes, and the keys of
+    the source files defining modules it uses. Unchanged sources are not
+    recompiled, even after switching between configurations. The
+    module_flag parameter is the compiler option for the module output
+    directory (e.g. '-module' for Intel Fortran)."""
+
+    def __init__(self, compiler='gfortran', flags=None, link_flags=None,
+                 sources=None, source_dirs=None, cache_dir='fruit_build',
+                 processes=None, module_flag='-J'):
+        import shlex
+        if not isinstance(compiler, list):
+            compiler = shlex.split(compiler)
+        self.compiler = compiler
+        self.flags, self.link_flags = list(flags or []), list(link_flags or [])
+        self.sources = list(sources or [])
+        self.source_dirs = list(source_dirs or [])
+        self.cache_dir = cache_dir
+        if processes is None:
+            from multiprocessing import cpu_count
+            processes = cpu_count()
+        self.processes = processes
+        self.module_flag = module_flag
+        self.compiled, self.reused, self.failed = [], [], None
+
+    def __repr__(self):
+        return ' '.join(self.signature)
+
+    def get_signature(self):
+        """Returns list of compiler command, flags and link flags, for
+        build fingerprints."""
+        return self.compiler + self.flags + [self.module_flag, '-o'] + \
+            self.link_flags
+    signature = property(get_signature)
+
+    def graph(self, driver, test_filenames):
+        """Returns module_graph of the driver, test module and other
+        source files."""
+        graph = module_graph(self.source_dirs, self.sources)
+        for filename in list(test_filenames) + [driver]:
+            graph.add_file(filename)
+        return graph
+
+    def source_files(self):
+        """Returns list of other source files (not including the driver
+        and test modules), for build fingerprints."""
+        from os.path import abspath
+        graph = module_graph(self.source_dirs, self.sources)
+        return sorted(set(graph.defines) |
+                      set([abspath(filename) for filename in self.sources]))
+
+    def units(self, graph):
+        """Returns dictionary of source files to be compiled in the graph
+        (i.e. those not included in other files), with the set of other
+        units each one uses modules from."""
+        included = set()
+        for uses, includes in graph.depends.values():
+            included |= set(includes)
+        units = {}
+        for filename in graph.defines:
+            if filename not in included:
+                units[filename] = set([dep for dep in
+                                       graph.file_dependencies(filename)
+                                       if dep in graph.defines and
+                                       dep not in included])
+        return units
+
+    def compile_flags(self, shared=False):
+        """Returns list of compiler flags, adding '-fPIC' for building a
+        shared library."""
+        if shared and '-fPIC' not in self.flags:
+            return self.flags + ['-fPIC']
+        return self.flags
+
+    def keys(self, graph, units, shared=False):
+        """Returns dictionary of cache keys for the units. Raises a
+        ValueError if there is a cycle in the module dependencies."""
+        import hashlib
+        from os.path import basename
+        keys, visiting = {}, set()
+        compile_command = '\0'.join(self.compiler +
+                                    self.compile_flags(shared) +
+                                    [self.module_flag])
+
+        def key(filename):
+            if filename in keys:
+                return keys[filename]
+            if filename in visiting:
+                raise ValueError("Module dependency cycle involving %s" %
+                                 filename)
+            visiting.add(filename)
+            h = hashlib.sha1(compile_command.encode('utf-8'))
+            h.update(basename(filename).encode('utf-8'))
+            h.update(file_hash(filename).encode('utf-8'))
+            for include in sorted(graph.depends[filename][1]):
+                h.update(include.encode('utf-8'))
+                try:
+                    h.update(file_hash(include).encode('utf-8'))
+                except (IOError, OSError):
+                    pass
+            for dep in sorted(units[filename]):
+                h.update(key(dep).encode('utf-8'))
+            visiting.remove(filename)
+            keys[filename] = h.hexdigest()
+            return keys[filename]
+
+        for filename in units:
+            key(filename)
+        return keys
+
+    def object_dir(self, key):
+        """Returns cache directory for the object and module files for a
+        cache key."""
+        from os.path import abspath, join
+        return abspath(join(self.cache_dir, key[:2], key))
+
+    def object_filename(self, filename, key):
+        """Returns cached object filename for a source file."""
+        from os.path import basename, join, splitext
+        return join(self.object_dir(key),
+                    splitext(basename(filename))[0] + '.o')
+
+    def compile_args(self, filename, key, dep_keys, output_dir,
+                     shared=False):
+        """Returns compile command for a source file, writing the object
+        and module files to output_dir."""
+        from os.path import abspath, basename, dirname, join, splitext
+        args = self.compiler + self.compile_flags(shared) + \
+            ['-c', abspath(filename), '-o',
+             join(output_dir, splitext(basename(filename))[0] + '.o'),
+             self.module_flag, output_dir, '-I' + dirname(abspath(filename))]
+        return args + ['-I' + self.object_dir(dep_key)
+                       for dep_key in sorted(set(dep_keys))]
+
+    def build(self, driver, test_filenames, exe, shared=False):
+        """Compiles and links the driver program to the executable exe (or
+        if shared is True, a shared library), and returns 0 if successful,
+        otherwise a non-zero status. The
+        sources compiled and reused from the cache are stored in the
+        compiled and reused properties, and the source that failed to
+        compile (if any) in the failed property."""
+        import os
+        import shutil
+        import tempfile
+        import time
+        from subprocess import Popen, call
+        self.compiled, self.reused, self.failed = [], [], None
+        graph = self.graph(driver, test_filenames)
+        units = self.units(graph)
+        try:
+            keys = self.keys(graph, units, shared)
+        except ValueError as e:
+            self.failed = str(e)
+            return 1
+        dep_keys = dict([(filename, [keys[dep] for dep in
+                                     graph.dependencies(filename)
+                                     if dep in keys])
+                         for filename in units])
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        pending = dict([(filename, set(deps))
+                        for filename, deps in units.items()])
+        done, running, status = set(), {}, 0
+
+        def ready():
+            if status != 0:
+                return []
+            return [filename for filename in sorted(pending)
+                    if not pending[filename] - done]
+
+        while True:
+            for filename in ready():
+                if len(running) >= self.processes:
+                    break
+                del pending[filename]
+                key = keys[filename]
+                if os.path.isdir(self.object_dir(key)):
+                    self.reused.append(filename)
+                    done.add(filename)
+                    continue
+                tmpdir = tempfile.mkdtemp(dir=os.path.abspath(self.cache_dir))
+                args = self.compile_args(filename, key, dep_keys[filename],
+                                         tmpdir, shared)
+                running[filename] = (Popen(args, cwd=tmpdir), tmpdir)
+            if not running:
+                if ready():
+                    continue
+                break
+            finished = [(filename, sp.returncode, tmpdir)
+                        for filename, (sp, tmpdir) in running.items()
+                        if sp.poll() is not None]
+            for filename, returncode, tmpdir in finished:
+                del running[filename]
+                if returncode == 0:
+                    object_dir = self.object_dir(keys[filename])
+                    try:
+                        if not os.path.isdir(os.path.dirname(object_dir)):
+                            os.makedirs(os.path.dirname(object_dir))
+                        os.rename(tmpdir, object_dir)
+                    except OSError:  # compiled concurrently elsewhere
+                        shutil.rmtree(tmpdir)
+                    self.compiled.append(filename)
+                    done.add(filename)
+                else:
+                    shutil.rmtree(tmpdir)
+                    if status == 0:
+                        self.failed, status = filename, returncode
+            if not finished:
+                time.sleep(0.01)
+        if status != 0:
+            return status
+        if pending:
+            self.failed = sorted(pending)[0]
+            return 1
+        objects = [self.object_filename(filename, keys[filename])
+                   for filename in sorted(units)]
+        return call(self.compiler + self.compile_flags(shared) + objects +
+                    self.link_flags + (['-shared'] if shared else []) +
+                    ['-o', exe])
+
+    def clear(self):
+        """Removes all cached object and module files."""
+        import shutil
+        from os.path import isdir
+        if isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+
+class results_history(object):
+
+    """Local history of test results, stored in an SQLite database. For each
+    recorded run, the outcome (failed or not) and duration of each test case
+    are stored, where known. Cases are identified by lower case module and
+    case names."""
+
+    def __init__(self, filename):
+        import sqlite3
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        with self.connection:
+            self.connection.execute(
+                'create table if not exists runs (id integer primary key '
+                'autoincrement, time real, success integer, asserts integer, '
+                'failed_asserts integer, label text)')
+            self.connection.execute(
+                'create table if not exists cases (run integer, module text, '
+                'name text, failed integer, seconds real)')
+            self.connection.execute(
+                'create index if not exists case_index on cases '
+                '(module, name)')
+
+    def __repr__(self):
+        return "%s: %d runs" % (self.filename, self.num_runs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Closes the database connection."""
+        self.connection.close()
+
+    def get_num_runs(self):
+        return self.connection.execute(
+            'select count(*) from runs').fetchone()[0]
+    num_runs = property(get_num_runs)
+
+    def record(self, suite, label=None):
+        """Records the results of the last run of a test suite, and returns
+        the run id. Case outcomes are known for all cases that ran if the
+        driver wrote case markers. Otherwise, cases with timings (if the
+        driver had timing instrumentation) are recorded, and cases found
+        to have failed from the failed assertion messages."""
+        import time
+        cases = OrderedDict()
+        for (module_name, name), seconds in suite.durations.items():
+            cases[(module_name.lower(), name.lower())] = [0, seconds]
+        for (module_name, name), failed in suite.case_failures.items():
+            key = (module_name.lower(), name.lower())
+            cases.setdefault(key, [0, None])[0] = int(failed > 0)
+        for module_name, name in suite.failed_case_names:
+            cases.setdefault((module_name.lower(), name.lower()),
+                             [0, None])[0] = 1
+        with self.connection:
+            cursor = self.connection.execute(
+                'insert into runs (time, success, asserts, failed_asserts, '
+                'label) values (?, ?, ?, ?, ?)',
+                (time.time(), int(suite.success), suite.asserts.total,
+                 suite.asserts.total - suite.asserts.success, label))
+            run = cursor.lastrowid
+            self.connection.executemany(
+                'insert into cases values (?, ?, ?, ?, ?)',
+                [(run, module_name, name, failed, seconds)
+                 for (module_name, name), (failed, seconds)
+                 in cases.items()])
+        return run
+
+    def first_run(self, last_runs=None):
+        """Returns id of the first of the specified number of most recent
+        runs (or of all runs, if last_runs is None)."""
+        if last_runs is None:
+            return 0
+        row = self.connection.execute(
+            'select min(id) from (select id from runs order by id desc '
+            'limit ?)', (last_runs,)).fetchone()
+        return row[0] or 0
+
+    def runs(self, last_runs=None):
+        """Returns list of (run id, time, success, asserts, failed asserts,
+        label) tuples for the specified number of most recent runs (or all
+        runs), most recent first."""
+        return self.connection.execute(
+            'select id, time, success, asserts, failed_asserts, label from '
+            'runs where id >= ? order by id desc',
+            (self.first_run(last_runs),)).fetchall()
+
+    def case_history(self, module_name, name, last_runs=None):
+        """Returns list of (run id, time, failed, seconds) tuples for the
+        specified test case over the specified number of most recent runs
+        (or all runs), most recent first. The duration is None if it is
+        not known."""
+        return [(run, t, bool(failed), seconds)
+                for run, t, failed, seconds in self.connection.execute(
+                    'select runs.id, runs.time, failed, seconds from cases '
+                    'join runs on cases.run = runs.id where module = ? and '
+                    'name = ? and runs.id >= ? order by runs.id desc',
+                    (module_name.lower(), name.lower(),
+                     self.first_run(last_runs)))]
+
+    def case_statistics(self, last_runs=None):
+        """Returns ordered dictionary of (number of runs, number of failed
+        runs, mean duration) tuples keyed by (module name, case name), over
+        the specified number of most recent runs (or all runs). The mean
+        duration is None if it is not known."""
+        return OrderedDict([
+            ((module_name, name), (runs, failures, seconds))
+            for module_name, name, runs, failures, seconds in
+            self.connection.execute(
+                'select module, name, count(*), sum(failed), avg(seconds) '
+                'from cases where run >= ? group by module, name order by '
+                'module, name', (self.first_run(last_runs),))])
+
+    def failure_rates(self, last_runs=None):
+        """Returns ordered dictionary of failure rates (between 0 and 1) of
+        test cases that have failed over the specified number of most
+        recent runs (or all runs), keyed by (module name, case name) and
+        sorted by decreasing rate."""
+        rates = [(key, failures / runs) for key, (runs, failures, seconds)
+                 in self.case_statistics(last_runs).items() if failures]
+        return OrderedDict(sorted(rates, key=lambda item: -item[1]))
+
+    def module_order(self, module_names, last_runs=10):
+        """Returns the specified module names sorted so that modules with
+        the most test case failures over the specified number of recent
+        runs come first, followed by the others in order of increasing
+        total mean case duration. Modules with no history are treated as
+        having zero duration, and ties keep their original order."""
+        failures, durations = {}, {}
+        for (module_name, name), (runs, failed, seconds) in \
+                self.case_statistics(last_runs).items():
+            failures[module_name] = failures.get(module_name, 0) + failed
+            durations[module_name] = durations.get(module_name, 0.) + \
+                (seconds or 0.)
+        return sorted(module_names,
+                      key=lambda name: (-failures.get(name.lower(), 0),
+                                        durations.get(name.lower(), 0.)))
 
 
 class test_result(object):
@@ -146,20 +1282,1110 @@ class test_result(object):
     percent = property(get_percent)
 
 
+class scaling_result(object):
+
+    """Results of an MPI scaling sweep: wall-clock times of repeated runs
+    of a test suite for different numbers of processes. Speedup and
+    parallel efficiency are calculated from the best (minimum) time for
+    each number of processes, relative to the smallest number of
+    processes in the sweep."""
+
+    def __init__(self):
+        self.times = OrderedDict()
+        self.success = OrderedDict()
+
+    def __repr__(self):
+        return self.table()
+
+    def add(self, num_procs, seconds, success):
+        """Adds time for a run with the specified number of processes."""
+        self.times.setdefault(num_procs, []).append(seconds)
+        self.success[num_procs] = self.success.get(num_procs, True) and \
+            success
+
+    def get_num_procs(self):
+        """Returns sorted list of numbers of processes in the sweep."""
+        return sorted(self.times)
+    num_procs = property(get_num_procs)
+
+    def best_time(self, num_procs):
+        """Returns minimum time for the specified number of processes."""
+        return min(self.times[num_procs])
+
+    def mean_time(self, num_procs):
+        """Returns mean time for the specified number of processes."""
+        return sum(self.times[num_procs]) / len(self.times[num_procs])
+
+    def speedup(self, num_procs):
+        """Returns speedup for the specified number of processes."""
+        try:
+            return self.best_time(self.num_procs[0]) / \
+                self.best_time(num_procs)
+        except ZeroDivisionError:
+            return 0.0
+
+    def efficiency(self, num_procs):
+        """Returns parallel efficiency for the specified number of
+        processes."""
+        return self.speedup(num_procs) * self.num_procs[0] / num_procs
+
+    def inefficient(self, min_efficiency):
+        """Returns list of numbers of processes with parallel efficiency
+        below the specified minimum."""
+        return [n for n in self.num_procs
+                if self.efficiency(n) < min_efficiency]
+
+    def table(self):
+        """Returns table of results as a string."""
+        lines = ["%6s %12s %12s %9s %11s %7s" %
+                 ("procs", "best (s)", "mean (s)", "speedup", "efficiency",
+                  "passed")]
+        for n in self.num_procs:
+            lines.append("%6d %12.4f %12.4f %9.2f %10.1f%% %7s" %
+                         (n, self.best_time(n), self.mean_time(n),
+                          self.speedup(n), self.efficiency(n) * 100,
+                          self.success[n]))
+        return '\n'.join(lines)
+
+    def get_data(self):
+        """Returns results as a list of dictionaries, e.g. for JSON
+        export."""
+        return [{'num_procs': n, 'times': self.times[n],
+                 'best_time': self.best_time(n),
+                 'mean_time': self.mean_time(n),
+                 'speedup': self.speedup(n), 'efficiency': self.efficiency(n),
+                 'success': self.success[n]} for n in self.num_procs]
+
+    def write(self, filename):
+        """Writes results to a JSON file."""
+        import json
+        with open(filename, 'w') as f:
+            json.dump(self.get_data(), f, indent=2)
+
+
+class resource_sampler(object):
+
+    """Samples the resource usage of a process and its descendants (e.g. a
+    driver program and its MPI ranks) from /proc (Linux only), at the
+    specified interval (in seconds) in a background thread. Each sample is
+    attributed to the test case running at the time, according to the case
+    markers parsed by an output_parser. The ranks are the processes
+    running the executable exe (or all processes in the tree, if none are
+    found), identified by their MPI rank environment variable if set,
+    otherwise by process ID order.
+
+    For each test case and rank, the peak resident memory (kB) and CPU time
+    (s) are stored in the cases dictionary, keyed by module and case names.
+    The peak memory is the highest resident memory sampled during the
+    case, or the process high water mark if that increased during the case
+    (so short-lived peaks between samples are not missed). The CPU time is
+    the user and system time used between the samples attributed to the
+    case.
+
+    The results are approximate: the CPU time used since the previous
+    sample is all charged to the case running at the current sample, even
+    if another case was running for part of the interval, and for MPI
+    output the case running is taken from the last case marker written by
+    any rank, so all ranks are assumed to run the cases in step."""
+
+    rank_variables = ['OMPI_COMM_WORLD_RANK', 'PMI_RANK', 'PMIX_RANK',
+                      'MV2_COMM_WORLD_RANK', 'SLURM_PROCID']
+
+    def __init__(self, pid, parser, interval=0.1, exe=None):
+        import os
+        self.pid, self.parser = pid, parser
+        self.interval = interval
+        self.exe = exe
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.cases = OrderedDict()
+        self.ranks, self.last = {}, {}
+        self.thread = None
+
+    def __repr__(self):
+        return "%d cases sampled" % len(self.cases)
+
+    def processes(self):
+        """Returns dictionary of (parent process ID, command name, CPU time
+        in seconds) tuples for all processes, keyed by process ID."""
+        import os
+        processes = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                try:
+                    with open('/proc/%s/stat' % name) as f:
+                        stat = f.read()
+                except (IOError, OSError):
+                    continue
+                comm = stat[stat.find('(') + 1: stat.rfind(')')]
+                fields = stat[stat.rfind(')') + 2:].split()
+                processes[int(name)] = (int(fields[1]), comm,
+                                        (int(fields[11]) + int(fields[12])) /
+                                        self.clock_ticks)
+        return processes
+
+    def tree(self, processes):
+        """Returns list of IDs of the sampled process and its
+        descendants."""
+        children = {}
+        for pid, (ppid, comm, cpu) in processes.items():
+            children.setdefault(ppid, []).append(pid)
+        result, todo = [], [self.pid]
+        while todo:
+            pid = todo.pop()
+            if pid in processes:
+                result.append(pid)
+                todo += children.get(pid, [])
+        return sorted(result)
+
+    def memory(self, pid):
+        """Returns tuple of resident memory and high water mark (kB) for a
+        process."""
+        rss, hwm = 0, 0
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+                elif line.startswith('VmHWM:'):
+                    hwm = int(line.split()[1])
+        return rss, hwm
+
+    def rank(self, pid):
+        """Returns rank of a process, from its MPI rank environment
+        variable if set, otherwise from its order of appearance."""
+        if pid not in self.ranks:
+            rank = None
+            try:
+                with open('/proc/%d/environ' % pid, 'rb') as f:
+                    environ = dict([item.split(b'=', 1) for item in
+                                    f.read().split(b'\0') if b'=' in item])
+                for name in self.rank_variables:
+                    if name.encode() in environ:
+                        rank = int(environ[name.encode()])
+                        break
+            except (IOError, OSError, ValueError):
+                pass
+            if rank is None:
+                rank = len(self.ranks)
+            self.ranks[pid] = rank
+        return self.ranks[pid]
+
+    def sample(self):
+        """Samples resource usage of the ranks, and attributes it to the
+        test case running."""
+        from os.path import basename
+        processes = self.processes()
+        pids = self.tree(processes)
+        if self.exe:
+            name = basename(self.exe)[:15]
+            pids = [pid for pid in pids if processes[pid][1] == name] or pids
+        case = self.parser.current_case
+        for pid in pids:
+            try:
+                rss, hwm = self.memory(pid)
+            except (IOError, OSError, ValueError):
+                continue
+            cpu = processes[pid][2]
+            last = self.last.get(pid)
+            if case is not None:
+                usage = self.cases.setdefault(case[1:], OrderedDict()). \
+                    setdefault(self.rank(pid), [0, 0.])
+                peak = hwm if last is not None and hwm > last[1] else rss
+                usage[0] = max(usage[0], peak)
+                if last is not None:
+                    usage[1] += cpu - last[0]
+            self.last[pid] = (cpu, hwm)
+
+    def start(self):
+        """Starts sampling in a background thread, until the sampled
+        process ends or stop() is called."""
+        import threading
+        self.stopping = threading.Event()
+
+        def run():
+            from os.path import isdir
+            while isdir('/proc/%d' % self.pid) and \
+                  not self.stopping.is_set():
+                self.sample()
+                self.stopping.wait(self.interval)
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops sampling."""
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+
+class output_parser(object):
+
+    """Single-pass parser for FRUIT driver output. It can be fed one line
+    at a time (e.g. while the driver is running), or used to parse a whole
+    sequence of lines. Only the parsed results are stored, not the output
+    itself. Failed assertion messages are collected from all message
+    blocks (e.g. from different ranks in MPI output), and the last summary
+    statistics in the output are used.
+
+    Output from drivers with case markers is also parsed to keep track of
+    the case currently running and the asserts failed in each completed
+    case, so results are still available if the driver does not finish."""
+
+    def __init__(self):
+        self.success = False
+        self.messages = []
+        self.asserts = test_result()
+        self.cases = test_result()
+        self.summary_parsed = False
+        self.timings = OrderedDict()
+        self.current_case = None
+        self.case_start_time = None
+        self.case_failures = OrderedDict()
+        self.failed_cases = []
+        self.marker_asserts = test_result()
+        self.in_messages = False
+
+    def feed(self, line):
+        """Parses a single line of output."""
+        if self.in_messages:
+            if "end of failed assertion messages." in line:
+                self.in_messages = False
+            else:
+                self.messages.append(line.strip())
+        elif marker_prefix in line:
+            self.parse_marker(line)
+        elif "SUCCESSFUL!" in line:
+            self.success = True
+        elif "Failed assertion messages:" in line:
+            self.in_messages = True
+        elif "Successful asserts / total asserts" in line:
+            self.asserts.success, self.asserts.total = \
+                parse_summary_line(line)
+            self.summary_parsed = True
+        elif "Successful cases   / total cases" in line:
+            self.cases.success, self.cases.total = parse_summary_line(line)
+
+    def parse_marker(self, line):
+        """Parses a marker line written by an instrumented driver (which may
+        follow assert progress markers on the same line)."""
+        for marker, parse in [(timing_marker, self.parse_timing),
+                              (case_start_marker, self.parse_case_start),
+                              (case_end_marker, self.parse_case_end)]:
+            pos = line.find(marker)
+            if pos >= 0:
+                try:
+                    parse(line[pos + len(marker):].split())
+                except (IndexError, ValueError):
+                    pass
+                break
+
+    def parse_timing(self, items):
+        """Parses timing marker items. For MPI output the maximum time over
+        all ranks is kept."""
+        key, seconds = tuple(items[:3]), float(items[3])
+        self.timings[key] = max(seconds, self.timings.get(key, 0.))
+
+    def parse_case_start(self, items):
+        """Parses case start marker items: case index, module and case
+        names."""
+        from time import time
+        self.current_case = (int(items[0]), items[1], items[2])
+        self.case_start_time = time()
+
+    def parse_case_end(self, items):
+        """Parses case end marker items: case index, module and case names,
+        number of failed asserts in the case, and cumulative numbers of
+        asserts and failed asserts."""
+        key = (items[1], items[2])
+        failed, total_asserts, failed_asserts = [int(item)
+                                                 for item in items[3:6]]
+        self.case_failures[key] = max(failed, self.case_failures.get(key, 0))
+        if failed > 0 and key not in self.failed_cases:
+            self.failed_cases.append(key)
+        self.marker_asserts = test_result(total_asserts - failed_asserts,
+                                          total_asserts)
+        self.current_case = None
+
+    def get_marker_cases(self):
+        """Returns test_result for cases completed according to case
+        markers."""
+        total = len(self.case_failures)
+        return test_result(total - len(self.failed_cases), total)
+    marker_cases = property(get_marker_cases)
+
+    def parse(self, lines):
+        """Parses an iterable of output lines, and returns the parser."""
+        feed = self.feed
+        for line in lines:
+            feed(line)
+        return self
+
+    def get_failure_messages(self):
+        """Returns failure messages (empty if all tests passed)."""
+        return [] if self.success else self.messages
+    failure_messages = property(get_failure_messages)
+
+
+class test_coordinator(object):
+
+    """Coordinator for running a test suite on worker processes (see
+    test_worker), possibly on other machines, connected over a socket. Each
+    test module containing test cases is a task, handed out to the next idle
+    worker, which runs it using its own prebuilt driver (written with
+    runtime selection enabled) and streams the output back. If a worker
+    disconnects before finishing a task, the task is re-queued, up to
+    retries times. The address is a (host, port) tuple for a TCP socket
+    (port 0 picks a free port, given by the address property once bound),
+    or a file name for a Unix socket. Messages are lines of JSON (see
+    send_message()), and are not authenticated, so the coordinator should
+    only be reachable from trusted hosts."""
+
+    def __init__(self, suite, address=('localhost', 0), retries=1):
+        import socket
+        self.suite = suite
+        self.retries = retries
+        if isinstance(address, tuple):
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            import os
+            import stat
+            if os.path.exists(address) and \
+               stat.S_ISSOCK(os.stat(address).st_mode):
+                os.remove(address)  # left over from a previous run
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(address)
+        self.server.listen(16)
+        self.address = self.server.getsockname()
+        self.tasks = [mod for mod in suite.test_modules if mod.subroutines]
+        self.results = [None] * len(self.tasks)
+        self.workers = OrderedDict()
+
+    def __repr__(self):
+        return "%s: %d tasks, %d workers" % (self.address, len(self.tasks),
+                                             len(self.workers))
+
+    def get_complete(self):
+        """Returns True if all tasks have results."""
+        return all([result is not None for result in self.results])
+    complete = property(get_complete)
+
+    def run(self, timeout=None, callback=None):
+        """Hands out the tasks to workers as they connect, until all have
+        been completed, then merges the task results into the suite results
+        and returns True if all tests passed. If timeout (in seconds) is
+        specified, tasks not completed by then are counted as failed, and
+        the suite's stopped property is set. If callback is specified, it is
+        called with each line of output from the workers. The results of
+        each task are stored in the results property (as a sub-suite), and
+        the number of tasks run by each worker in the workers property."""
+        import socket
+        import threading
+        import time
+        from collections import deque
+        self.pending = deque(range(len(self.tasks)))
+        self.attempts = [0] * len(self.tasks)
+        self.condition = threading.Condition()
+        self.closed, self.connections = False, []
+        self.server.settimeout(0.1)
+        start = time.time()
+        try:
+            while not self.complete:
+                if timeout is not None and time.time() - start > timeout:
+                    break
+                try:
+                    connection = self.server.accept()[0]
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                self.connections.append(connection)
+                thread = threading.Thread(target=self.serve,
+                                          args=(connection, callback))
+                thread.daemon = True
+                thread.start()
+        finally:
+            with self.condition:
+                self.closed = True
+                timed_out = not self.complete
+                for task, result in enumerate(self.results):
+                    if result is None:
+                        self.results[task] = self.lost_result(task,
+                                                              'timeout')
+                self.condition.notify_all()
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self.close()
+        self.suite.merge_results(self.results)
+        self.suite.crashes = []
+        for result in self.results:
+            self.suite.crashes += result.crashes
+        self.suite.stopped = 'timeout' if timed_out else None
+        return self.suite.success
+
+    def close(self):
+        """Closes the coordinator socket."""
+        import os
+        address = self.address
+        self.server.close()
+        if not isinstance(address, tuple) and os.path.exists(address):
+            os.remove(address)
+
+    def serve(self, connection, callback=None):
+        """Hands out tasks to the worker on the specified connection and
+        records their results, until there are none left."""
+        import socket
+        reader = connection.makefile('rb')
+        task, name = None, None
+        try:
+            message = receive_message(reader)
+            if message is None or message.get('type') != 'ready':
+                return
+            name = message.get('name')
+            with self.condition:
+                self.workers.setdefault(name, 0)
+            while True:
+                task = self.next_task()
+                if task is None:
+                    send_message(connection, {'type': 'done'})
+                    break
+                send_message(connection, {
+                    'type': 'run', 'task': task,
+                    'modules': [self.tasks[task].test_module_name.lower()]})
+                parser, lines = output_parser(), []
+                while True:
+                    message = receive_message(reader)
+                    if message is None or message['type'] == 'result':
+                        break
+                    line = message['line']
+                    parser.feed(line)
+                    lines.append(line)
+                    if callback is not None:
+                        callback(line)
+                if message is None:
+                    break
+                self.finish_task(task, parser, lines, message['returncode'],
+                                 name)
+                task = None
+        except (socket.error, IOError):
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            import logging
+            logging.getLogger(__name__).warning(
+                "Protocol error from worker %s: %s: %s", name,
+                type(e).__name__, e)
+        finally:
+            if task is not None:
+                self.requeue(task)
+            reader.close()
+            connection.close()
+
+    def next_task(self):
+        """Returns the next pending task, waiting if there are none pending
+        but others are still running (as they may be re-queued), or None if
+        there are none left."""
+        with self.condition:
+            while not self.pending and not self.complete and \
+                  not self.closed:
+                self.condition.wait(0.1)
+            if self.pending and not self.closed:
+                return self.pending.popleft()
+            return None
+
+    def finish_task(self, task, parser, lines, returncode, name):
+        """Records the results of a task from the worker output, given its
+        output_parser, output lines and the driver return code. If the
+        output contains test cases from other test modules, the task is
+        counted as failed."""
+        if self.own_cases(self.tasks[task], parser):
+            suite = self.suite.subsuite([self.tasks[task]])
+            suite.set_results(parser)
+            suite.built, suite.crashes = True, []
+            if not suite.finished:
+                suite.crashes.append(suite.record_crash(
+                    'signal %d' % -returncode if returncode < 0
+                    else 'exit status %d' % returncode,
+                    self.tasks[task].test_module_name))
+        else:
+            suite = self.lost_result(task, 'cases from other test modules')
+        suite.output_lines = lines
+        with self.condition:
+            if self.results[task] is None:
+                self.results[task] = suite
+                self.workers[name] = self.workers.get(name, 0) + 1
+            self.condition.notify_all()
+
+    def own_cases(self, mod, parser):
+        """Returns True if the test cases in the output of a task, according
+        to the case statistics and any case or timing markers, all belong to
+        its test module. They may not if the worker's driver was not written
+        with runtime selection enabled, so that it runs the whole suite."""
+        name = mod.test_module_name.lower()
+        names = [key[0] for key in parser.case_failures] + \
+            [key[1] for key in parser.timings if key[0] == 'case']
+        if parser.current_case is not None:
+            names.append(parser.current_case[1])
+        return parser.cases.total <= len(mod.subroutines) and \
+            all([case_module.lower() == name for case_module in names])
+
+    def requeue(self, task):
+        """Re-queues a task after its worker has disconnected, or if it has
+        been tried more than retries times, records it as failed."""
+        with self.condition:
+            if self.results[task] is None:
+                self.attempts[task] += 1
+                if self.attempts[task] > self.retries or self.closed:
+                    self.results[task] = self.lost_result(task,
+                                                          'worker lost')
+                else:
+                    self.pending.append(task)
+            self.condition.notify_all()
+
+    def lost_result(self, task, reason):
+        """Returns results for a task that could not be completed, with all
+        its test cases counted as failed."""
+        mod = self.tasks[task]
+        suite = self.suite.subsuite([mod])
+        suite.built = True
+        suite.crashes = [suite.record_crash(reason, mod.test_module_name)]
+        suite.cases.total = len(mod.subroutines)
+        return suite
+
+
+class test_worker(object):
+
+    """Worker for running the tasks (test modules) handed out by a
+    test_coordinator at the specified address, using a prebuilt driver
+    executable exe written with runtime selection enabled. The
+    run_command, num_procs, mpi and output_dir parameters are as for
+    test_suite.run(). The worker name (by default the host name and
+    process ID) identifies it to the coordinator."""
+
+    def __init__(self, address, exe, run_command=None, num_procs=1,
+                 mpi=False, output_dir='', name=None):
+        import os
+        import socket
+        self.address = address
+        suite = test_suite([])
+        suite.exe = exe
+        self.run = suite.run_args(run_command, num_procs, mpi)
+        self.output_dir = output_dir
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.tasks_run = 0
+
+    def __repr__(self):
+        return "%s: %d tasks run" % (self.name, self.tasks_run)
+
+    def serve(self):
+        """Connects to the coordinator and runs the tasks it hands out, until
+        there are none left. Returns the number of tasks run."""
+        import socket
+        family = socket.AF_INET if isinstance(self.address, tuple) \
+            else socket.AF_UNIX
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(self.address)
+        reader = sock.makefile('rb')
+        try:
+            send_message(sock, {'type': 'ready', 'name': self.name})
+            while True:
+                message = receive_message(reader)
+                if message is None or message.get('type') != 'run':
+                    break
+                returncode = self.run_task(sock, message['modules'])
+                send_message(sock, {'type': 'result',
+                                    'task': message['task'],
+                                    'returncode': returncode})
+                self.tasks_run += 1
+        finally:
+            reader.close()
+            sock.close()
+        return self.tasks_run
+
+    def run_task(self, sock, modules):
+        """Runs the driver for the specified test modules, sending its output
+        to the coordinator line by line. Returns the driver return code."""
+        import subprocess
+        if not modules or not all([re.match(r'^\w+$', name)
+                                   for name in modules]):
+            return 2  # not valid test module names
+        sp = subprocess.Popen(self.run + list(modules),
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT,
+                              cwd=self.output_dir or None)
+        try:
+            for raw_line in iter(sp.stdout.readline, b''):
+                line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+                send_message(sock, {'type': 'output', 'line': line})
+        except Exception:
+            sp.kill()
+            raise
+        finally:
+            sp.wait()
+        return sp.returncode
+
+
+def indent_lines(lines, indent='  '):
+    """Returns driver lines indented by the specified string (blank lines
+    are left blank)."""
+    return [indent + line if line else line for line in lines]
+
+
+def pattern_matches(pattern, names):
+    """Returns True if the pattern matches any of the names (ignoring
+    case). Patterns containing wildcard characters are matched as for
+    fnmatch, while other patterns match names containing them."""
+    from fnmatch import fnmatchcase
+    pattern = pattern.lower()
+    if any([c in pattern for c in '*?[']):
+        return any([fnmatchcase(name, pattern) for name in names])
+    else:
+        return any([pattern in name for name in names])
+
+
+def kill_process_group(sp):
+    """Kills process sp and, on POSIX systems, its process group (including
+    any child processes, e.g. MPI ranks). On POSIX systems the process must
+    have been started in a new session."""
+    import os
+    import signal
+    try:
+        if os.name == 'posix':
+            os.killpg(sp.pid, signal.SIGKILL)
+        else:
+            sp.kill()
+    except OSError:
+        pass
+
+
+def executable_name(driver):
+    """Returns driver executable name, based on driver source name."""
+    from os.path import splitext, basename
+    from sys import platform
+    exe = basename(splitext(driver)[0])
+    if platform == 'win32':
+        exe += ".exe"
+    return exe
+
+
+def update_file(filename, text):
+    """Writes text to file, only if the file does not exist or has
+    different contents. Returns True if the file was written."""
+    from os.path import isfile
+    if isfile(filename):
+        with open(filename) as f:
+            update = f.read() != text
+    else:
+        update = True
+    if update:
+        with open(filename, 'w') as f:
+            f.write(text)
+    return update
+
+
+def library_name(library_source):
+    """Returns shared library name, based on library interface source
+    name."""
+    from os.path import splitext, basename
+    from sys import platform
+    base = basename(splitext(library_source)[0])
+    if platform == 'win32':
+        return base + '.dll'
+    elif platform == 'darwin':
+        return 'lib' + base + '.dylib'
+    else:
+        return 'lib' + base + '.so'
+
+
+def mangled_names(module_name, name):
+    """Returns list of possible symbol names for a module procedure, as
+    mangled by different compilers (gfortran first, then Intel, NAG and
+    LLVM flang)."""
+    module_name, name = module_name.lower(), name.lower()
+    return ['__%s_MOD_%s' % (module_name, name),
+            '%s_mp_%s_' % (module_name, name),
+            '%s_MP_%s' % (module_name, name),
+            '_QM%sP%s' % (module_name, name)]
+
+
+def library_procedure(library, module_name, name):
+    """Returns ctypes function for a module procedure with no arguments in
+    a shared library, trying the symbol names for different compilers.
+    Raises an AttributeError if it is not found."""
+    for symbol in mangled_names(module_name, name):
+        try:
+            procedure = getattr(library, symbol)
+        except AttributeError:
+            continue
+        procedure.argtypes, procedure.restype = [], None
+        return procedure
+    raise AttributeError("Procedure %s not found for module %s in %s" %
+                         (name, module_name, library._name))
+
+
+def fortran_name(name):
+    """Returns name, shortened with a hash if needed to fit the Fortran name
+    length limit."""
+    import hashlib
+    if len(name) > 63:
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+        name = name[:54] + '_' + digest
+    return name
+
+
+def runner_name(module_name):
+    """Returns name of the runner subroutine for a test module in a split
+    driver."""
+    return fortran_name('fruitpy_run_' + module_name.lower())
+
+
+def support_module_name(driver):
+    """Returns name of the support module for a split driver, based on the
+    driver base name, so split drivers (e.g. shards or variants) built in
+    the same directory have distinct module files."""
+    from os.path import basename, splitext
+    base = re.sub(r'\W', '_', basename(splitext(driver)[0])).lower()
+    return fortran_name('fruitpy_support_' + base)
+
+
+def units_directory(driver):
+    """Returns directory for the other compilation units of a split
+    driver, formed by appending '_units' to the driver base name."""
+    from os.path import splitext
+    return splitext(driver)[0] + '_units'
+
+
+def variant_name(mpi=False, mpi_comm='MPI_COMM_WORLD', timing=False,
+                 selection=False, markers=False, resume=False, split=False,
+                 ordering=False):
+    """Returns name of the driver configuration variant for the specified
+    driver options, e.g. 'serial' or 'mpi_timing_selection'."""
+    parts = ['mpi' if mpi else 'serial']
+    if mpi and mpi_comm.upper() != 'MPI_COMM_WORLD':
+        parts.append(re.sub(r'\W+', '_', mpi_comm).strip('_').lower())
+    parts += [name for name, value in [('timing', timing),
+                                       ('selection', selection),
+                                       ('markers', markers),
+                                       ('resume', resume),
+                                       ('split', split),
+                                       ('ordering', ordering)] if value]
+    return '_'.join(parts)
+
+
+def variant_driver(driver, variant):
+    """Returns driver source name for the named configuration variant,
+    formed by appending the variant name to the driver base name."""
+    from os.path import splitext
+    base, ext = splitext(driver)
+    return base + '_' + variant + ext
+
+
+def socket_address(text):
+    """Returns socket address for a test_coordinator from a string, either
+    'host:port' for a TCP socket or a file name for a Unix socket."""
+    host, sep, port = text.rpartition(':')
+    if sep and port.isdigit():
+        return (host or 'localhost', int(port))
+    return text
+
+
+def send_message(sock, message):
+    """Sends a message (dictionary) over a socket, as a line of JSON."""
+    import json
+    sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+def receive_message(reader):
+    """Receives a message sent by send_message(), from a binary file object
+    for the socket. Returns None if the connection has been closed."""
+    import json
+    line = reader.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+# Contained procedures for reading runtime test selection in the driver
+# program:
+selection_procedure_lines = """  subroutine fruitpy_read_selection()
+    ! Reads test selection from command line arguments. Each argument is
+    ! a test module name, a module and case name separated by a colon, or
+    ! '@' followed by the name of a file containing such names, one per
+    ! line. If there are no arguments, all tests are selected. Arguments
+    ! starting with '--' are options, not part of the selection.
+    integer :: i, unit, ios
+    character(len=fruitpy_name_len) :: arg
+    fruitpy_num_selected = 0
+    allocate(fruitpy_selection(16))
+    fruitpy_select_all = .true.
+    do i = 1, command_argument_count()
+       call get_command_argument(i, arg)
+       if (arg(1:2) == '--') cycle
+       fruitpy_select_all = .false.
+       if (arg(1:1) == '@') then
+          open(newunit = unit, file = trim(arg(2:)), status = 'old', &
+               action = 'read')
+          do
+             read(unit, '(a)', iostat = ios) arg
+             if (ios /= 0) exit
+             if (len_trim(arg) > 0) call fruitpy_select(arg)
+          end do
+          close(unit)
+       else
+          call fruitpy_select(arg)
+       end if
+    end do
+  end subroutine fruitpy_read_selection
+
+  subroutine fruitpy_select(name)
+    ! Adds name to test selection.
+    character(len=*), intent(in) :: name
+    character(len=fruitpy_name_len), allocatable :: tmp(:)
+    if (fruitpy_num_selected == ubound(fruitpy_selection, 1)) then
+       allocate(tmp(2 * fruitpy_num_selected))
+       tmp(1:fruitpy_num_selected) = fruitpy_selection
+       call move_alloc(tmp, fruitpy_selection)
+    end if
+    fruitpy_num_selected = fruitpy_num_selected + 1
+    fruitpy_selection(fruitpy_num_selected) = adjustl(name)
+  end subroutine fruitpy_select
+
+  logical function fruitpy_selected(module_name, case_name)
+    ! Returns true if the specified test case is selected.
+    character(len=*), intent(in) :: module_name, case_name
+    integer :: i
+    fruitpy_selected = fruitpy_select_all
+    do i = 1, fruitpy_num_selected
+       if (fruitpy_selection(i) == module_name .or. &
+            fruitpy_selection(i) == module_name // ':' // case_name) then
+          fruitpy_selected = .true.
+          exit
+       end if
+    end do
+  end function fruitpy_selected
+
+  logical function fruitpy_module_selected(module_name)
+    ! Returns true if any test cases in the specified module are selected.
+    character(len=*), intent(in) :: module_name
+    integer :: i, n
+    n = len(module_name)
+    fruitpy_module_selected = fruitpy_select_all
+    do i = 1, fruitpy_num_selected
+       if (fruitpy_selection(i)(1:n + 1) == module_name // ':' .or. &
+            fruitpy_selection(i) == module_name) then
+          fruitpy_module_selected = .true.
+          exit
+       end if
+    end do
+  end function fruitpy_module_selected
+""".splitlines() + ['']
+
+
+# Contained procedures for writing case start and end markers in the driver
+# program:
+marker_procedure_lines = ("""  subroutine fruitpy_case_start(case_index, module_name, case_name)
+    ! Writes test case start marker.
+    use, intrinsic :: iso_fortran_env, only: output_unit
+    integer, intent(in) :: case_index
+    character(len=*), intent(in) :: module_name, case_name
+    call get_failed_count(fruitpy_failed_before)
+    write(output_unit, '(a, 1x, i0, 2(1x, a))') '%s', &
+         case_index, module_name, case_name
+    flush(output_unit)
+  end subroutine fruitpy_case_start
+
+  subroutine fruitpy_case_end(case_index, module_name, case_name)
+    ! Writes test case end marker, with number of asserts failed in the
+    ! case and cumulative numbers of asserts and failed asserts.
+    use, intrinsic :: iso_fortran_env, only: output_unit
+    integer, intent(in) :: case_index
+    character(len=*), intent(in) :: module_name, case_name
+    integer :: total_count, failed_count
+    call get_total_count(total_count)
+    call get_failed_count(failed_count)
+    write(output_unit, '(a, 1x, i0, 2(1x, a), 3(1x, i0))') '%s', &
+         case_index, module_name, case_name, &
+         failed_count - fruitpy_failed_before, total_count, failed_count
+    flush(output_unit)
+  end subroutine fruitpy_case_end
+""" % (case_start_marker, case_end_marker)).splitlines() + ['']
+
+# Contained procedure for reading the index of the test case to start from
+# in the driver program:
+resume_procedure_lines = """\
+  subroutine fruitpy_read_start()
+    ! Reads index of the first test case to run from a '--start=N'
+    ! command line argument (default 1).
+    integer :: i, ios
+    character(len=256) :: arg
+    fruitpy_start = 1
+    do i = 1, command_argument_count()
+       call get_command_argument(i, arg)
+       if (arg(1:8) == '--start=') then
+          read(arg(9:), *, iostat = ios) fruitpy_start
+          if (ios /= 0) fruitpy_start = 1
+       end if
+    end do
+  end subroutine fruitpy_read_start
+""".splitlines() + ['']
+
+# Contained procedure for reading the order in which to run the test modules
+# in the driver program:
+ordering_procedure_lines = """\
+  subroutine fruitpy_read_order(num_modules)
+    ! Reads the order in which to run the test modules from the file named
+    ! by an '--order=FILE' command line argument, containing module
+    ! numbers, one per line. Modules not listed run afterwards, in their
+    ! original order.
+    integer, intent(in) :: num_modules
+    integer :: i, j, n, unit, ios
+    logical :: listed(num_modules)
+    character(len=1024) :: arg
+    allocate(fruitpy_order(num_modules))
+    listed = .false.
+    n = 0
+    do i = 1, command_argument_count()
+       call get_command_argument(i, arg)
+       if (arg(1:8) == '--order=') then
+          open(newunit = unit, file = trim(arg(9:)), status = 'old', &
+               action = 'read')
+          do
+             read(unit, *, iostat = ios) j
+             if (ios /= 0) exit
+             if (j >= 1 .and. j <= num_modules) then
+                if (.not. listed(j)) then
+                   n = n + 1
+                   fruitpy_order(n) = j
+                   listed(j) = .true.
+                end if
+             end if
+          end do
+          close(unit)
+       end if
+    end do
+    do j = 1, num_modules
+       if (.not. listed(j)) then
+          n = n + 1
+          fruitpy_order(n) = j
+       end if
+    end do
+  end subroutine fruitpy_read_order
+""".splitlines() + ['']
+
+# Contained procedure for writing the elapsed time of a timed call in the
+# driver program:
+timing_procedure_lines = ("""\
+  subroutine fruitpy_timing(timing_kind, module_name, name)
+    ! Writes elapsed time for the last timed call.
+    character(len=*), intent(in) :: timing_kind, module_name, name
+    write(*, '(4(a, 1x), es16.8)') '%s', timing_kind, module_name, name, &
+         real(fruitpy_clock_end - fruitpy_clock_start, kind(1.d0)) / \
+fruitpy_clock_rate
+  end subroutine fruitpy_timing
+""" % timing_marker).splitlines() + ['']
+
+# Procedures in the library interface module, called via ctypes to run test
+# cases in a shared library (see test_suite.library_lines()):
+library_procedure_lines = """\
+  subroutine fruitpy_init() bind(c, name='fruitpy_init')
+    ! Initialises FRUIT.
+    call init_fruit
+  end subroutine fruitpy_init
+
+  subroutine fruitpy_run_case(test_case, case_index, module_name, &
+       case_name, description) bind(c, name='fruitpy_run_case')
+    ! Runs a test case, given its procedure pointer and index, and its
+    ! module name, case name and description as null-terminated strings,
+    ! writing case start and end markers.
+    type(c_funptr), value :: test_case
+    integer(c_int), value :: case_index
+    character(kind=c_char), intent(in) :: module_name(*), case_name(*), &
+         description(*)
+    procedure(fruitpy_test_case), pointer :: test_case_pointer
+    call c_f_procpointer(test_case, test_case_pointer)
+    call fruitpy_case_start(int(case_index), fruitpy_string(module_name), &
+         fruitpy_string(case_name))
+    call run_test_case(test_case_pointer, fruitpy_string(description))
+    call fruitpy_case_end(int(case_index), fruitpy_string(module_name), &
+         fruitpy_string(case_name))
+  end subroutine fruitpy_run_case
+
+  subroutine fruitpy_summary() bind(c, name='fruitpy_summary')
+    ! Writes FRUIT summary and finalises.
+    use, intrinsic :: iso_fortran_env, only: output_unit
+    call fruit_summary
+    call fruit_finalize
+    flush(output_unit)
+  end subroutine fruitpy_summary
+
+  function fruitpy_string(chars) result(string)
+    ! Converts null-terminated C string to Fortran string.
+    character(kind=c_char), intent(in) :: chars(*)
+    character(len=:), allocatable :: string
+    integer :: i, n
+    n = 0
+    do while (chars(n + 1) /= c_null_char)
+       n = n + 1
+    end do
+    allocate(character(len=n) :: string)
+    do i = 1, n
+       string(i:i) = chars(i)
+    end do
+  end function fruitpy_string
+""".splitlines() + ['']
+
+
+def parse_summary_line(line):
+    """Parses a summary line containing statistics on successful and total
+    numbers of asserts or cases."""
+    items = line.split()
+    slashpos = -(items[::-1].index('/') + 1)  # last occurrence of /
+    return int(items[slashpos - 1]), int(items[slashpos + 1])
+
+
 class test_suite(object):
 
     """Class for suite of FRUIT tests"""
 
-    def __init__(self, test_filenames):
+    def __init__(self, test_filenames, cache=None, processes=1, lazy=False):
+        """Creates test suite from a test filename or list of filenames.
+        The optional cache parameter is a parse_cache object (or its
+        filename) for storing parsed test module data between runs. If
+        processes > 1, files not found in the cache are parsed in parallel
+        using a pool of that many processes. If lazy is True, each test
+        file is only parsed (or its data read from the cache) when its
+        module data are first needed, e.g. for test selection or writing
+        the driver."""
         if isinstance(test_filenames, str):
             test_filenames = [test_filenames]
+        if isinstance(cache, str):
+            cache = parse_cache(cache)
         self.test_filenames = test_filenames
+        self.cache = cache
+        self.processes = processes
+        self.lazy = lazy
         self.test_modules = []
         self.driver = None
+        self.unit_files = []
         self.exe = None
         self.asserts = test_result()
         self.cases = test_result()
         self.built = False
+        self.success = False
+        self.finished = False
+        self.messages = []
+        self.output_lines = []
+        self.timings = OrderedDict()
+        self.resources = OrderedDict()
+        self.failed_cases = []
+        self.case_failures = OrderedDict()
+        self.flaky, self.persistent = [], []
+        self.rerun_build_failed = False
+        self.stopped, self.in_flight = None, None
+        self.crashes = []
         self.parse()
 
     def __repr__(self):
@@ -179,22 +2405,325 @@ class test_suite(object):
     global_teardown = property(get_global_teardown)
 
     def parse(self):
-        """Parses test F90 files containing test cases."""
-        for test_filename in self.test_filenames:
-            mod = test_module(test_filename)
-            self.test_modules.append(mod)
+        """Parses test F90 files containing test cases. Cached data are used
+        where available, and the remaining files are parsed (in parallel if
+        processes > 1) and added to the cache. For a lazy suite, the test
+        modules are only created, and parsed when needed."""
+        if self.lazy:
+            self.test_modules = [test_module(test_filename, lazy=True,
+                                             cache=self.cache)
+                                 for test_filename in self.test_filenames]
+            return
+        modules = {}
+        if self.cache is not None:
+            for test_filename in self.test_filenames:
+                cached = self.cache.get(test_filename)
+                if cached is not None:
+                    modules[test_filename] = test_module(test_filename,
+                                                         cached)
+        unparsed = [test_filename for test_filename in self.test_filenames
+                    if test_filename not in modules]
+        if self.processes > 1 and len(unparsed) > 1:
+            from multiprocessing import Pool
+            pool = Pool(min(self.processes, len(unparsed)))
+            try:
+                parsed = pool.map(parse_test_module_data, unparsed)
+            finally:
+                pool.close()
+                pool.join()
+        else:  # modules are created as each file is parsed
+            parsed = (parse_test_module_data(test_filename)
+                      for test_filename in unparsed)
+        for test_filename, mod_data in zip(unparsed, parsed):
+            if self.cache is not None:
+                self.cache.put(test_filename, mod_data)
+            modules[test_filename] = test_module(test_filename, mod_data)
+        if self.cache is not None:
+            self.cache.save()
+        self.test_modules = [modules[test_filename]
+                             for test_filename in self.test_filenames]
 
-    def parse_test_module_name(self, f):
-        """Parses test module name from file f."""
-        line = f.readline()
-        while 'module' not in line.lower():
-            line = f.readline()
-        imod = line.find('module')
-        self.test_module_name = line[imod:].strip().split()[1]
+    def subsuite(self, test_modules):
+        """Returns a new test suite (of the same class) containing the
+        specified (already parsed) test modules."""
+        suite = type(self)([])
+        suite.test_filenames = [mod.test_filename for mod in test_modules]
+        suite.test_modules = list(test_modules)
+        return suite
+
+    def shards(self, num_shards, split_modules=False):
+        """Partitions the test suite into at most num_shards sub-suites,
+        balanced by number of test cases. Test modules are kept whole unless
+        split_modules is True, in which case their cases may be spread
+        across shards. Modules with global setup or teardown routines are
+        included in every shard."""
+        from copy import copy
+        units = []
+        for imod, mod in enumerate(self.test_modules):
+            isubs = list(range(len(mod.subroutines)))
+            if split_modules:
+                units += [(imod, [isub]) for isub in isubs]
+            elif isubs:
+                units.append((imod, isubs))
+        loads = [0] * num_shards
+        assigned = [{} for i in range(num_shards)]
+        for imod, isubs in sorted(units, key=lambda unit: -len(unit[1])):
+            ishard = loads.index(min(loads))
+            assigned[ishard].setdefault(imod, []).extend(isubs)
+            loads[ishard] += len(isubs)
+        shards = []
+        for shard in [shard for shard in assigned if shard]:
+            modules = []
+            for imod, mod in enumerate(self.test_modules):
+                isubs = sorted(shard.get(imod, []))
+                if isubs or mod.global_setup or mod.global_teardown:
+                    if len(isubs) < len(mod.subroutines):
+                        mod = copy(mod)
+                        mod.subroutines = [mod.subroutines[isub]
+                                           for isub in isubs]
+                    modules.append(mod)
+            shards.append(self.subsuite(modules))
+        return shards
+
+    def case_subsuite(self, cases):
+        """Returns a sub-suite containing only the specified test cases,
+        given as (module name, case name) tuples, together with any modules
+        with global setup or teardown routines. Module setup and teardown
+        routines are kept."""
+        from copy import copy
+        cases = set([(module_name.lower(), name.lower())
+                     for module_name, name in cases])
+        modules = []
+        for mod in self.test_modules:
+            module_name = mod.test_module_name.lower()
+            subs = [sub for sub in mod.subroutines
+                    if (module_name, sub.name.lower()) in cases]
+            if subs or mod.global_setup or mod.global_teardown:
+                if len(subs) < len(mod.subroutines):
+                    mod = copy(mod)
+                    mod.subroutines = subs
+                modules.append(mod)
+        if not any([mod.subroutines for mod in modules]):
+            modules = []
+        return self.subsuite(modules)
+
+    def impacted(self, changed_files, source_dirs=None, source_files=None,
+                 graph=None):
+        """Returns a sub-suite containing only the test modules affected by
+        changes to the specified files, i.e. those whose test files depend,
+        directly or indirectly, on any of the changed files. Dependencies
+        are found from a module_graph of the test files and the source
+        files in the specified directories and files (or from the specified
+        graph, if any, which should already contain the test files).
+        Modules with global setup or teardown routines are included if any
+        other modules are."""
+        from os.path import abspath
+        if graph is None:
+            graph = module_graph(source_dirs, source_files)
+            for mod in self.test_modules:
+                graph.add_test_module(mod)
+        affected = graph.affected(changed_files)
+        modules = [mod for mod in self.test_modules
+                   if abspath(mod.test_filename) in affected]
+        if modules:
+            modules = [mod for mod in self.test_modules if mod in modules
+                       or mod.global_setup or mod.global_teardown]
+        return self.subsuite(modules)
+
+    def reparse(self, filenames):
+        """Re-parses those of the specified files which are test files in the
+        suite (e.g. after they have changed), updating the cache if there is
+        one. Returns list of the test modules re-parsed."""
+        from os.path import abspath
+        filenames = set([abspath(filename) for filename in filenames])
+        modules = []
+        for i, test_filename in enumerate(self.test_filenames):
+            if abspath(test_filename) in filenames:
+                data = parse_test_module_data(test_filename)
+                if self.cache is not None:
+                    self.cache.put(test_filename, data)
+                self.test_modules[i] = test_module(test_filename, data)
+                modules.append(self.test_modules[i])
+        if modules and self.cache is not None:
+            self.cache.save()
+        return modules
+
+    def merge_results(self, suites):
+        """Sets results of this test suite by merging results from the
+        specified other suites (e.g. shards)."""
+        self.built = len(suites) > 0 and all([s.built for s in suites])
+        self.success = self.built and all([s.success for s in suites])
+        self.finished = all([s.finished for s in suites])
+        self.messages, self.output_lines = [], []
+        self.asserts, self.cases = test_result(), test_result()
+        self.timings = OrderedDict()
+        self.resources = OrderedDict()
+        self.failed_cases, self.case_failures = [], OrderedDict()
+        for suite in suites:
+            self.messages += suite.messages
+            self.output_lines += suite.output_lines
+            self.timings.update(suite.timings)
+            self.resources.update(suite.resources)
+            self.failed_cases += suite.failed_cases
+            self.case_failures.update(suite.case_failures)
+            for result, suite_result in [(self.asserts, suite.asserts),
+                                         (self.cases, suite.cases)]:
+                result.success += suite_result.success
+                result.total += suite_result.total
+
+    def ordered_modules(self, history=None):
+        """Returns list of test modules, in the order given by the specified
+        results_history (or its filename), if any."""
+        if history is None:
+            return self.test_modules
+        if isinstance(history, str):
+            with results_history(history) as history:
+                return self.ordered_modules(history)
+        modules = OrderedDict([(mod.test_module_name, mod)
+                               for mod in self.test_modules])
+        return [modules[name] for name in history.module_order(modules)]
+
+    def record_history(self, history, label=None):
+        """Records the results of the last run in the specified
+        results_history (or its filename), and returns the run id."""
+        if isinstance(history, str):
+            with results_history(history) as history:
+                return history.record(self, label)
+        return history.record(self, label)
+
+    def timed_call_lines(self, call_line, kind, module_name, name, timing):
+        """Returns driver lines for a call, with timing instrumentation if
+        timing is True."""
+        if timing:
+            return ['  call system_clock(fruitpy_clock_start, '
+                    'fruitpy_clock_rate)',
+                    call_line,
+                    '  call system_clock(fruitpy_clock_end)',
+                    "  call fruitpy_timing('%s', '%s', &" %
+                    (kind, module_name),
+                    "       '%s')" % name]
+        else:
+            return [call_line]
+
+    def marked_case_lines(self, case_lines, index, module_name, name,
+                          markers):
+        """Returns driver lines for a test case, with case start and end
+        markers if markers is True."""
+        if markers:
+            args = ["  call fruitpy_case_%s(%s, '%s', &" %
+                    (kind, index, module_name) for kind in ['start', 'end']]
+            return [args[0], "       '%s')" % name] + case_lines + \
+                [args[1], "       '%s')" % name]
+        else:
+            return case_lines
+
+    def module_lines(self, mod, first_index, timing=False, selection=False,
+                     markers=False, resume=False, offset=False):
+        """Returns driver lines for running the test cases in a module, with
+        case indices starting from first_index + 1 (see driver_lines() for
+        the other options). If offset is True, the case indices are instead
+        relative to the fruitpy_offset variable, as in the module runners
+        of a split driver (see split_driver_sources())."""
+        name = mod.test_module_name
+        num_cases = len(mod.subroutines)
+        if offset:
+            indices = ['fruitpy_offset + %d' % (i + 1)
+                       for i in range(num_cases)]
+        else:
+            indices = [str(first_index + i + 1) for i in range(num_cases)]
+        mod_lines = []
+        if mod.setup:
+            mod_lines += self.timed_call_lines('  call ' + mod.setup,
+                                               'setup', name, mod.setup,
+                                               timing)
+        for sub, index in zip(mod.subroutines, indices):
+            case_lines = self.timed_call_lines(
+                '  call run_test_case(' + sub.name + ',"' +
+                sub.description + '")', 'case', name, sub.name, timing)
+            case_lines = self.marked_case_lines(case_lines, index, name,
+                                                sub.name, markers)
+            if resume:
+                case_lines = ['  if (fruitpy_start <= %s) then' % index] + \
+                    indent_lines(case_lines) + ['  end if']
+            if selection:
+                case_lines = ["  if (fruitpy_selected('%s', &" %
+                              name.lower(),
+                              "       '%s')) then" % sub.name.lower()] + \
+                    indent_lines(case_lines) + ['  end if']
+            mod_lines += case_lines
+        if mod.teardown:
+            mod_lines += self.timed_call_lines(
+                '  call ' + mod.teardown, 'teardown', name, mod.teardown,
+                timing)
+        if resume:
+            mod_lines = ['  if (fruitpy_start <= %s) then' % indices[-1]] + \
+                indent_lines(mod_lines) + ['  end if']
+        if selection:
+            mod_lines = ["  if (fruitpy_module_selected('%s')) then" %
+                         name.lower()] + indent_lines(mod_lines) + \
+                ['  end if']
+        return mod_lines
 
-    def driver_lines(self, mpi=False, mpi_comm='MPI_COMM_WORLD'):
-        """Creates lines for driver program to write to file."""
+    def support_declaration_lines(self, timing=False, selection=False,
+                                  markers=False, resume=False,
+                                  ordering=False):
+        """Returns driver lines declaring the variables used by the timing,
+        selection, marker, resume and ordering procedures."""
+        lines = []
+        if timing:
+            lines.append('  integer, parameter :: fruitpy_ik = '
+                         'selected_int_kind(18)')
+            lines.append('  integer(fruitpy_ik) :: fruitpy_clock_start, '
+                         'fruitpy_clock_end, fruitpy_clock_rate')
+        if selection:
+            lines.append('  integer, parameter :: fruitpy_name_len = 256')
+            lines.append('  character(len=fruitpy_name_len), allocatable :: '
+                         'fruitpy_selection(:)')
+            lines.append('  integer :: fruitpy_num_selected')
+            lines.append('  logical :: fruitpy_select_all')
+        if markers:
+            lines.append('  integer :: fruitpy_failed_before')
+        if resume:
+            lines.append('  integer :: fruitpy_start')
+        if ordering:
+            lines.append('  integer, allocatable :: fruitpy_order(:)')
+        return lines
 
+    def support_procedure_lines(self, timing=False, selection=False,
+                                markers=False, resume=False, ordering=False):
+        """Returns driver lines for the timing, selection, marker, resume and
+        ordering procedures."""
+        lines = []
+        if selection:
+            lines += selection_procedure_lines
+        if markers:
+            lines += marker_procedure_lines
+        if resume:
+            lines += resume_procedure_lines
+        if ordering:
+            lines += ordering_procedure_lines
+        if timing:
+            lines += timing_procedure_lines
+        return lines
+
+    def driver_lines(self, mpi=False, mpi_comm='MPI_COMM_WORLD',
+                     timing=False, selection=False, markers=False,
+                     ordering=False, resume=False):
+        """Creates lines for driver program to write to file. If timing is
+        True, the driver measures the wall-clock time of each test case
+        and module setup and teardown, and writes it to the output. If
+        selection is True, the driver only runs the tests selected by its
+        command line arguments (see select()). If markers is True, the
+        driver writes markers to the output at the start and end of each
+        test case, for monitoring progress while it runs. If ordering is
+        True, the driver runs the test modules in the order given by an
+        '--order=FILE' command line argument (see run()), so they can be
+        reordered without changing the driver. If resume is True, the driver
+        only runs the test cases from the index given by a '--start=N'
+        command line argument onwards (so a run can be resumed after a
+        crash), and case markers are also written."""
+
+        if resume: markers = True
         lines = []
         lines.append('program tests')
         lines.append('')
@@ -219,8 +2748,16 @@ class test_suite(object):
         lines.append('  integer :: failed_count')
         if mpi:
             lines.append('  integer :: size, rank, ierr')
+        lines += self.support_declaration_lines(timing, selection, markers,
+                                                resume, ordering)
+        if ordering:
+            lines.append('  integer :: fruitpy_i, fruitpy_offset')
         lines.append('')
 
+        if selection:
+            lines.append('  call fruitpy_read_selection')
+        if resume:
+            lines.append('  call fruitpy_read_start')
         lines.append('  call init_fruit')
         if self.global_setup:
             lines.append('  call setup')
@@ -231,19 +2768,21 @@ class test_suite(object):
             lines.append('  call MPI_COMM_RANK(' + mpi_comm + ', rank, ierr)')
             lines.append('')
 
+        index, blocks = 0, []
         for mod in self.test_modules:
             if mod.subroutines:
+                block = []
                 if self.num_test_modules > 1:
-                    lines.append('  ! ' + mod.test_filename.strip() + ':')
-                if mod.setup:
-                    lines.append('  call ' + mod.setup)
-                for sub in mod.subroutines:
-                    lines.append('  call run_test_case(' +
-                                 sub.name + ',"' + sub.description + '")')
-                if mod.teardown:
-                    lines.append('  call ' + mod.teardown)
-                if mod.setup or mod.teardown or mod.subroutines:
-                    lines.append('')
+                    block.append('  ! ' + mod.test_filename.strip() + ':')
+                block += self.module_lines(mod, index, timing, selection,
+                                           markers, resume, ordering)
+                blocks.append((block, len(mod.subroutines)))
+                index += len(mod.subroutines)
+        if ordering:
+            lines += self.ordering_lines(blocks) + ['']
+        else:
+            for block, num_cases in blocks:
+                lines += block + ['']
 
         lines.append('  call get_failed_count(failed_count)')
         if mpi:
@@ -258,61 +2797,450 @@ class test_suite(object):
 
         lines.append('  if (failed_count > 0) stop 1')
         lines.append('')
+
+        if timing or selection or markers or ordering:
+            lines.append('contains')
+            lines.append('')
+        lines += self.support_procedure_lines(timing, selection, markers,
+                                              resume, ordering)
         lines.append('end program tests')
 
         return lines
 
-    def write(self, driver, mpi=False, mpi_comm='MPI_COMM_WORLD'):
-        """Writes driver program to file."""
-        from os.path import isfile
+    def ordering_lines(self, blocks):
+        """Returns driver lines for running blocks of driver lines (one for
+        each test module containing test cases, given with its number of
+        test cases) in the order read at runtime by fruitpy_read_order,
+        keeping the index offset of the next test case in
+        fruitpy_offset."""
+        lines = ['  call fruitpy_read_order(%d)' % len(blocks),
+                 '  fruitpy_offset = 0',
+                 '  do fruitpy_i = 1, %d' % len(blocks),
+                 '    select case (fruitpy_order(fruitpy_i))']
+        for i, (block, num_cases) in enumerate(blocks):
+            lines.append('    case (%d)' % (i + 1))
+            lines += indent_lines(block + [
+                '  fruitpy_offset = fruitpy_offset + %d' % num_cases],
+                '    ')
+        lines += ['    end select', '  end do']
+        return lines
+
+    def write(self, driver, mpi=False, mpi_comm='MPI_COMM_WORLD',
+              timing=False, selection=False, markers=False, ordering=False,
+              resume=False, split=False):
+        """Writes driver program to file. Returns True if the file has
+        changed. The parse cache (if any) is also saved, as test modules
+        in a lazy suite may have been parsed. If split is True, the driver
+        is split into a thin main program and separate compilation units
+        for each test module (see write_split()), which can be compiled in
+        parallel."""
         self.driver = driver
-        lines = '\n'.join(self.driver_lines(mpi, mpi_comm))
-        if isfile(self.driver):
-            with open(self.driver) as f:
-                oldlines = ''.join([line for line in f])
-            update = oldlines != lines
+        if split:
+            update = self.write_split(driver, mpi, mpi_comm, timing,
+                                      selection, markers, ordering, resume)
         else:
-            update = True
-        if update:
-            with open(self.driver, 'w') as f:
-                f.write(lines)
+            self.unit_files = []
+            update = update_file(self.driver, '\n'.join(
+                self.driver_lines(mpi, mpi_comm, timing, selection, markers,
+                                  ordering, resume)))
+        if self.cache is not None:
+            self.cache.save()
         return update
 
-    def build(self, build_command, output_dir='', update=True):
+    def split_driver_sources(self, driver, mpi=False,
+                             mpi_comm='MPI_COMM_WORLD', timing=False,
+                             selection=False, markers=False, ordering=False,
+                             resume=False):
+        """Returns an ordered dictionary of source file names and lines for a
+        driver split into separate compilation units (see write()): a
+        support module, a runner subroutine for each test module containing
+        test cases, and the main program (the driver itself). The runners
+        number their test cases relative to an offset passed by the main
+        program, so they do not change when the test modules are reordered
+        or other modules are added or removed. If ordering is True, the main
+        program runs the modules in the order read at runtime (see
+        driver_lines()). The support module and
+        runners are in the units directory of the driver (see
+        units_directory())."""
+        from os.path import join, splitext
+        if resume: markers = True
+        options = (timing, selection, markers, resume)
+        support_options = options + (ordering,)
+        ext = splitext(driver)[1]
+        directory = units_directory(driver)
+        support = support_module_name(driver)
+        sources = OrderedDict()
+        lines = ['module ' + support, '',
+                 '  ! Support module for split FRUIT driver program.', '',
+                 '  ! Generated by FRUITPy.', '', '  use fruit', '',
+                 '  implicit none']
+        lines += self.support_declaration_lines(*support_options)
+        lines += ['', 'contains', '']
+        lines += self.support_procedure_lines(*support_options)
+        lines.append('end module ' + support)
+        sources[join(directory, 'support' + ext)] = lines
+
+        calls = []
+        index = 0
+        for mod in self.test_modules:
+            if mod.subroutines:
+                name = runner_name(mod.test_module_name)
+                lines = ['subroutine %s(fruitpy_offset)' % name, '',
+                         '  ! Runs FRUIT unit tests in:',
+                         '  ! ' + mod.test_filename.strip(), '',
+                         '  ! Generated by FRUITPy.', '', '  use fruit',
+                         '  use ' + support,
+                         '  use ' + mod.test_module_name, '',
+                         '  implicit none',
+                         '  integer, intent(in) :: fruitpy_offset', '']
+                lines += self.module_lines(mod, index, *options, offset=True)
+                lines += ['', 'end subroutine %s' % name]
+                filename = join(directory, 'run_' +
+                                mod.test_module_name.lower() + ext)
+                sources[filename] = lines
+                calls.append((['  call %s(%s)' % (
+                    name, 'fruitpy_offset' if ordering else index)],
+                    len(mod.subroutines)))
+                index += len(mod.subroutines)
+
+        lines = ['program tests', '',
+                 '  ! Driver program for FRUIT unit tests in:']
+        for mod in self.test_modules:
+            if mod.subroutines:
+                lines.append('  ! ' + mod.test_filename.strip())
+        lines += ['', '  ! Split into separate compilation units, in:']
+        lines += ['  ! ' + filename for filename in sources]
+        lines += ['', '  ! Generated by FRUITPy.', '', '  use fruit']
+        if mpi:
+            lines.append('  use fruit_mpi')
+        lines.append('  use ' + support)
+        for mod in self.test_modules:
+            if mod.global_setup or mod.global_teardown:
+                lines.append('  use ' + mod.test_module_name)
+        lines += ['', '  implicit none', '  integer :: failed_count']
+        if mpi:
+            lines.append('  integer :: size, rank, ierr')
+        if ordering:
+            lines.append('  integer :: fruitpy_i, fruitpy_offset')
+        lines.append('')
+        if selection:
+            lines.append('  call fruitpy_read_selection')
+        if resume:
+            lines.append('  call fruitpy_read_start')
+        lines.append('  call init_fruit')
+        if self.global_setup:
+            lines.append('  call setup')
+        lines.append('')
+        if mpi:
+            lines.append('  call MPI_COMM_SIZE(' + mpi_comm + ', size, ierr)')
+            lines.append('  call MPI_COMM_RANK(' + mpi_comm + ', rank, ierr)')
+            lines.append('')
+        if ordering:
+            lines += self.ordering_lines(calls)
+        else:
+            lines += [block[0] for block, num_cases in calls]
+        lines += ['', '  call get_failed_count(failed_count)']
+        if mpi:
+            lines.append('  call fruit_summary_mpi(size, rank)')
+            lines.append('  call fruit_finalize_mpi(size, rank)')
+        else:
+            lines.append('  call fruit_summary')
+            lines.append('  call fruit_finalize')
+        if self.global_teardown:
+            lines.append('  call teardown')
+        lines += ['  if (failed_count > 0) stop 1', '', 'end program tests']
+        sources[driver] = lines
+        return sources
+
+    def write_split(self, driver, mpi=False, mpi_comm='MPI_COMM_WORLD',
+                    timing=False, selection=False, markers=False,
+                    ordering=False, resume=False):
+        """Writes driver split into separate compilation units (see
+        split_driver_sources()), and returns True if any of the files has
+        changed. Only files whose contents have changed are written, so
+        build tools can recompile just those units. The names of the units
+        other than the main program are stored in the unit_files property,
+        and in a file with the driver base name and a '.units' extension
+        (one per line, e.g. for inclusion in a makefile). Unit files from
+        the previous split of the same driver that are no longer needed are
+        deleted. Raises a ValueError if any of the units would overwrite a
+        test module file."""
+        from os.path import splitext, isfile, isdir, abspath, dirname
+        from os import remove, makedirs
+        sources = self.split_driver_sources(driver, mpi, mpi_comm, timing,
+                                            selection, markers, ordering,
+                                            resume)
+        test_files = set([abspath(filename)
+                          for filename in self.test_filenames])
+        for filename in sources:
+            if abspath(filename) in test_files:
+                raise ValueError("Split driver unit %s would overwrite a "
+                                 "test module file" % filename)
+        directory = units_directory(driver)
+        if not isdir(directory):
+            makedirs(directory)
+        changed = [update_file(filename, '\n'.join(lines))
+                   for filename, lines in sources.items()]
+        self.unit_files = list(sources)[:-1]
+        units_filename = splitext(driver)[0] + '.units'
+        if isfile(units_filename):
+            with open(units_filename) as f:
+                previous = f.read().split()
+            for filename in previous:
+                if filename not in sources and isfile(filename) and \
+                   abspath(dirname(filename)) == abspath(directory):
+                    remove(filename)
+        update_file(units_filename, '\n'.join(self.unit_files) + '\n')
+        return any(changed)
+
+    def library_lines(self):
+        """Creates lines for the library interface module, which is built
+        into a shared library together with the test modules, for running
+        the test cases via ctypes (see run_library())."""
+        lines = ['module fruitpy_library', '']
+        lines.append('  ! Library interface for FRUIT unit tests in:')
+        for mod in self.test_modules:
+            if mod.subroutines:
+                lines.append('  ! ' + mod.test_filename.strip())
+        lines += ['', '  ! Generated by FRUITPy.', '',
+                  '  use, intrinsic :: iso_c_binding', '  use fruit', '',
+                  '  implicit none', '  private',
+                  '  public :: fruitpy_init, fruitpy_run_case, '
+                  'fruitpy_summary',
+                  '  integer :: fruitpy_failed_before', '',
+                  '  abstract interface',
+                  '     subroutine fruitpy_test_case()',
+                  '     end subroutine fruitpy_test_case',
+                  '  end interface', '', 'contains', '']
+        lines += library_procedure_lines + marker_procedure_lines
+        lines.append('end module fruitpy_library')
+        return lines
+
+    def write_library(self, library_source):
+        """Writes library interface module to file. Returns True if the
+        file has changed."""
+        self.library_source = library_source
+        return update_file(library_source, '\n'.join(self.library_lines()))
+
+    def build(self, build_command, output_dir='', update=True,
+              incremental=False, dependencies=None):
         """Compiles and links FRUIT driver program. Returns True if
-        the build was successful. The output_dir parameter specifies
-        the directory for the executable (same as source by default).
-        Setting the update parameter to True forces the executable to
-        be rebuilt."""
+        the build was successful. In the build command, '{driver}' and
+        '{exe}' are replaced by the driver source and executable names,
+        and a '{units}' argument by the other source files of a split
+        driver (see write()), if any.
+        The output_dir parameter specifies the directory for the
+        executable (same as source by default). Setting the update
+        parameter to True forces the executable to be rebuilt.
+
+        If incremental is True, the build is skipped altogether if the
+        executable exists and the build fingerprint (see
+        build_fingerprint) is unchanged since the last successful build.
+        The fingerprint includes the build command, driver source, test
+        module sources and any other dependency files specified (e.g.
+        sources for the code under test). The fingerprint is stored in a
+        file with the driver base name and a '.fingerprint' extension. The
+        reasons for rebuilding are stored in the rebuild_reasons property
+        (empty if the build was skipped).
+
+        Instead of a build command, a fortran_build object can be given,
+        to compile and link the driver using FRUITPy's own build engine."""
         from subprocess import call
-        from os.path import isfile, splitext, split, join
+        from os.path import join
+        build_command = self.start_build(build_command, output_dir, update,
+                                         incremental, dependencies)
+        if isinstance(build_command, fortran_build):
+            self.finish_build(build_command.build(
+                self.driver, self.test_filenames + self.unit_files,
+                join(output_dir, self.exe)), output_dir, incremental)
+        elif build_command is not None:
+            self.finish_build(call(build_command), output_dir, incremental)
+        return self.built
+
+    def start_build(self, build_command, output_dir='', update=True,
+                    incremental=False, dependencies=None):
+        """Prepares to build the driver program (see build()), and returns
+        the build command as a list (or the fortran_build object), or None
+        if the build is to be skipped."""
+        from os.path import isfile, splitext, join
         from os import remove
         import shlex
-        from sys import platform
-        self.exe, ext = splitext(self.driver)
-        source_path, self.exe = split(self.exe)
-        if platform == 'win32':
-            self.exe += ".exe"
+        driver_base, ext = splitext(self.driver)
+        self.exe = executable_name(self.driver)
         pathexe = join(output_dir, self.exe)
+        if isinstance(build_command, fortran_build):
+            signature = build_command.signature
+            dependencies = list(dependencies or []) + \
+                build_command.source_files()
+        else:
+            if not isinstance(build_command, list):
+                build_command = shlex.split(build_command)
+            args = []
+            for arg in build_command:
+                if arg == '{units}':
+                    args += self.unit_files
+                else:
+                    args.append(arg.replace('{driver}', self.driver).
+                                replace('{exe}', self.exe))
+            build_command = args
+            signature = build_command
+        if incremental:
+            self.fingerprint = build_fingerprint(driver_base + '.fingerprint')
+            self.rebuild_reasons = self.fingerprint.update(
+                signature, [self.driver] + self.unit_files +
+                self.test_filenames + list(dependencies or []))
+            if not isfile(pathexe):
+                self.rebuild_reasons.append('executable missing')
+            if not self.rebuild_reasons:
+                self.built = True
+                return None
+            self.fingerprint.remove()
         if isfile(pathexe) and update:
             remove(pathexe)
-        if not isinstance(build_command, list):
-            build_command = shlex.split(build_command)
-        ret = call(build_command)
-        self.built = ret == 0 and isfile(pathexe)
-        return self.built
+        return build_command
+
+    def finish_build(self, returncode, output_dir='', incremental=False):
+        """Records whether the build was successful, given the return code
+        of the build command."""
+        from os.path import isfile, join
+        self.built = returncode == 0 and isfile(join(output_dir, self.exe))
+        if incremental and self.built:
+            self.fingerprint.save()
 
-    def run(self, run_command=None, num_procs=1, output_dir='', mpi=False):
+    def run(self, run_command=None, num_procs=1, output_dir='', mpi=False,
+            stream=False, tee=None, callback=None, max_output_lines=None,
+            include=None, exclude=None, timeout=None, case_timeout=None,
+            fail_fast=False, resume=0, profile=None, order=None):
         """Runs test suite, and returns True if all tests passed. An
-        optional run command may be specified. If num_procs > 1, or
-        mpi is True, the suite will be run using in parallel using MPI."""
+        optional run command may be specified, in which '{exe}' is replaced
+        by the executable name. If num_procs > 1, or mpi is True, the suite
+        will be run using in parallel using MPI. If stream is True, output
+        is read and parsed line by line as the tests run, rather than all
+        at once at the end (see parse_stream() for the tee, callback and
+        max_output_lines parameters). If include or exclude patterns are
+        specified, only the selected tests are run (see select()), which
+        requires the driver to have been written with selection enabled.
+        If order (a list of test module names) is specified, the test
+        modules are run in that order, with any others afterwards, which
+        requires the driver to have been written with ordering enabled.
+
+        The run is stopped (killing the driver and any child processes,
+        e.g. MPI ranks) if it takes longer than timeout seconds, if any test
+        case takes longer than case_timeout seconds, or, if fail_fast is
+        True, as soon as any test case fails. The latter two options require
+        the driver to have been written with case markers enabled. The
+        reason for stopping is stored in the stopped property, and the case
+        running at the time (if any) in the in_flight property, as a
+        (case index, module name, case name) tuple.
+
+        If a driver written with case markers crashes during a test case
+        (i.e. ends without writing the FRUIT summary, and was not stopped),
+        the crash is recorded in the crashes property (see run_library())
+        and the case is counted as failed. If the driver was written with
+        resume enabled, it is then relaunched from the next test case, up
+        to resume times, and the results of all the launches are
+        merged.
+
+        If profile is specified (Linux only), the driver's resource usage
+        is sampled at intervals of profile seconds while it runs (see
+        resource_sampler), and the peak memory and CPU time of each test
+        case on each rank are stored in the resources property. This
+        requires the driver to have been written with case markers
+        enabled."""
+        import os
+        from copy import copy
+        run = self.run_args(run_command, num_procs, mpi)
+        selection_filename = self.write_selection(include, exclude)
+        if selection_filename is not None:
+            run.append('@' + selection_filename)
+        order_filename = self.write_order(order)
+        if order_filename is not None:
+            run.append('--order=' + order_filename)
+        self.crashes, launches, start = [], [], None
+        try:
+            while True:
+                returncode = self.launch(
+                    run + (['--start=%d' % start] if start else []),
+                    output_dir, stream, tee, callback, max_output_lines,
+                    timeout, case_timeout, fail_fast, profile)
+                crashed = self.stopped is None and not self.finished and \
+                    self.in_flight is not None
+                if crashed:
+                    self.crashes.append(self.record_crash(
+                        'signal %d' % -returncode if returncode < 0
+                        else 'exit status %d' % returncode))
+                if crashed or launches:
+                    launches.append(copy(self))
+                if not crashed or len(launches) > resume:
+                    break
+                start = self.in_flight[0] + 1
+        finally:
+            for filename in [selection_filename, order_filename]:
+                if filename is not None:
+                    os.remove(filename)
+        if len(launches) > 1:
+            self.merge_results(launches)
+        return self.success
+
+    def launch(self, run, output_dir='', stream=False, tee=None,
+               callback=None, max_output_lines=None, timeout=None,
+               case_timeout=None, fail_fast=False, profile=None):
+        """Launches the driver program with the specified command (list)
+        and parses its output (see run()). Returns the driver return
+        code."""
         import os
-        import shlex
         import subprocess
+        import sys
+        import threading
+        watched = timeout is not None or case_timeout is not None or \
+            fail_fast
+        popen_args = {'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT,
+                      'cwd': output_dir or None}
+        if watched and os.name == 'posix':
+            # run in new process group so child processes can be killed:
+            if sys.version_info[0] >= 3:
+                popen_args['start_new_session'] = True
+            else:
+                popen_args['preexec_fn'] = os.setsid
+        self.stopped, self.in_flight = None, None
+        self.resources = OrderedDict()
+        profile = profile if os.path.isdir('/proc') else None
+        sp = subprocess.Popen(run, **popen_args)
+        if stream or watched or profile is not None:
+            parser = output_parser()
+            if profile is not None:
+                sampler = resource_sampler(sp.pid, parser, profile, self.exe)
+                sampler.start()
+            if watched:
+                self.stop_lock = threading.Lock()
+                watchdog = threading.Thread(target=self.watch,
+                                            args=(sp, parser, timeout,
+                                                  case_timeout))
+                watchdog.daemon = True
+                watchdog.start()
+                if fail_fast:
+                    callback = self.fail_fast_callback(sp, parser, callback)
+            self.parse_stream(sp.stdout, tee, callback, max_output_lines,
+                              parser)
+            sp.wait()
+            if profile is not None:
+                sampler.stop()
+                self.resources = sampler.cases
+            if watched:
+                watchdog.join()
+                if self.stopped is not None:
+                    self.success = False
+        else:
+            output = sp.communicate()[0]
+            self.parse_output(output)
+        return sp.returncode
+
+    def run_args(self, run_command=None, num_procs=1, mpi=False):
+        """Returns command (as a list) for running the driver program (see
+        run())."""
+        import os
+        import shlex
         if num_procs > 1: mpi = True
-        if output_dir != '':
-            orig_dir = os.getcwd()
-            os.chdir(output_dir)
         if run_command is None:
             if mpi:
                 run = ['mpirun', '-np', str(num_procs), self.exe]
@@ -322,15 +3250,159 @@ class test_suite(object):
         else:
             if not isinstance(run_command, list):
                 run_command = shlex.split(run_command)
+            run_command = [arg.replace('{exe}', self.exe or '')
+                           for arg in run_command]
             if mpi:
                 run_command = ['-np', str(num_procs)] + run_command
             run = run_command
-        sp = subprocess.Popen(run, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        output = sp.communicate()[0]
-        self.parse_output(output)
-        if output_dir != '':
-            os.chdir(orig_dir)
-        return self.success
+        return run
+
+    def write_selection(self, include=None, exclude=None):
+        """Writes runtime selection of test cases (see select()) to a
+        temporary file, and returns its name, or None if no include or
+        exclude patterns are specified. The caller should remove the file
+        after use."""
+        import os
+        import tempfile
+        if include is None and exclude is None:
+            return None
+        fd, filename = tempfile.mkstemp(suffix='.selection')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(self.select(include, exclude)) + '\n')
+        return filename
+
+    def write_order(self, order=None):
+        """Writes the order in which to run the test modules (a list of test
+        module names, see run()) to a temporary file, as the numbers of the
+        test modules in the driver (counting those containing test cases),
+        and returns its name, or None if no order is specified. The caller
+        should remove the file after use."""
+        import os
+        import tempfile
+        if order is None:
+            return None
+        numbers = dict([(mod.test_module_name.lower(), i + 1)
+                        for i, mod in enumerate([
+                            mod for mod in self.test_modules
+                            if mod.subroutines])])
+        fd, filename = tempfile.mkstemp(suffix='.order')
+        with os.fdopen(fd, 'w') as f:
+            for name in order:
+                if name.lower() in numbers:
+                    f.write('%d\n' % numbers[name.lower()])
+        return filename
+
+    def scaling_sweep(self, proc_counts, repeats=3, run_command=None,
+                      output_dir='', timeout=None):
+        """Runs the (already built) MPI test driver repeatedly for each of
+        the specified numbers of processes, and returns a scaling_result
+        containing the wall-clock times of the runs. The driver must have
+        been built with MPI enabled (e.g. using build_run() with mpi =
+        True). The test results of the last run are kept."""
+        import time
+        result = scaling_result()
+        for num_procs in proc_counts:
+            for i in range(repeats):
+                start = time.time()
+                success = self.run(run_command, num_procs, output_dir,
+                                   mpi=True, timeout=timeout)
+                result.add(num_procs, time.time() - start, success)
+        return result
+
+    def run_distributed(self, address=('localhost', 0), retries=1,
+                        timeout=None, callback=None):
+        """Runs the test suite on worker processes (see test_worker), which
+        connect to a test_coordinator at the specified address and run the
+        test modules it hands out using their own prebuilt drivers. Returns
+        True if all tests passed. The retries, timeout and callback
+        parameters are as for test_coordinator."""
+        coordinator = test_coordinator(self, address, retries)
+        return coordinator.run(timeout, callback)
+
+    def stop(self, sp, reason, parser):
+        """Stops running driver process sp, recording the reason and the
+        test case running at the time."""
+        with self.stop_lock:
+            if self.stopped is None and sp.poll() is None:
+                self.stopped = reason
+                self.in_flight = parser.current_case
+                kill_process_group(sp)
+
+    def watch(self, sp, parser, timeout=None, case_timeout=None,
+              interval=0.05):
+        """Watches running driver process sp, stopping it if the total
+        timeout or the timeout for the current test case is exceeded."""
+        import time
+        start = time.time()
+        while sp.poll() is None and self.stopped is None:
+            now = time.time()
+            if timeout is not None and now - start > timeout:
+                self.stop(sp, 'timeout', parser)
+            elif case_timeout is not None and \
+                 parser.current_case is not None and \
+                 now - parser.case_start_time > case_timeout:
+                self.stop(sp, 'case timeout', parser)
+            time.sleep(interval)
+
+    def fail_fast_callback(self, sp, parser, callback=None):
+        """Returns output callback for stopping running driver process sp
+        when a test case has failed, after calling the specified
+        callback."""
+        def fail_fast(line):
+            if callback is not None:
+                callback(line)
+            if parser.failed_cases and self.stopped is None:
+                self.stop(sp, 'fail fast', parser)
+        return fail_fast
+
+    def select(self, include=None, exclude=None):
+        """Returns runtime selection of test cases matching any of the
+        include patterns (or all cases, if include is None) and none of the
+        exclude patterns. Patterns are matched against test case names,
+        test module names and names of the form 'module:case' (see
+        pattern_matches()). The selection is a list of lower-case test
+        module names (for modules with all cases selected) and
+        'module:case' names."""
+        if isinstance(include, str):
+            include = [include]
+        if isinstance(exclude, str):
+            exclude = [exclude]
+        selection = []
+        for mod in self.test_modules:
+            module_name = mod.test_module_name.lower()
+            cases = []
+            for sub in mod.subroutines:
+                case = module_name + ':' + sub.name.lower()
+                names = [sub.name.lower(), module_name, case]
+                if (include is None or any([pattern_matches(pattern, names)
+                                            for pattern in include])) and \
+                   not any([pattern_matches(pattern, names)
+                            for pattern in exclude or []]):
+                    cases.append(case)
+            if cases:
+                if len(cases) == len(mod.subroutines):
+                    selection.append(module_name)
+                else:
+                    selection += cases
+        return selection
+
+    def get_failed_case_names(self):
+        """Returns list of (module name, case name) tuples for the test cases
+        that failed in the last run. These are found from case markers if
+        the driver wrote them, otherwise by matching the case descriptions
+        in the failed assertion messages."""
+        if self.failed_cases:
+            return list(self.failed_cases)
+        failed = []
+        descriptions = set([message[1:].split(']:', 1)[0]
+                            for message in self.messages
+                            if message.startswith('[') and ']:' in message])
+        for mod in self.test_modules:
+            for sub in mod.subroutines:
+                if sub.description in descriptions:
+                    failed.append((mod.test_module_name, sub.name))
+        return failed
+    failed_case_names = property(get_failed_case_names)
 
     def parse_output(self, output):
         """Parses output."""
@@ -338,53 +3410,162 @@ class test_suite(object):
             self.output_lines = output.decode().splitlines()
         except AttributeError:
             self.output_lines = output.splitlines()
-        self.get_success()
-        self.get_messages()
-        self.get_statistics()
+        self.set_results(output_parser().parse(self.output_lines))
+
+    def parse_stream(self, stream, tee=None, callback=None,
+                     max_output_lines=None, parser=None):
+        """Parses output line by line from a binary stream, e.g. the stdout
+        of the driver process. If tee is specified (a file name or binary
+        file object), the output is also written to it. If callback is
+        specified, it is called with each line of output, e.g. for
+        displaying progress. If max_output_lines is specified, only that
+        many of the last output lines are kept in output_lines. An
+        output_parser may be passed in (e.g. for monitoring progress from
+        another thread), otherwise a new one is created."""
+        from collections import deque
+        if parser is None:
+            parser = output_parser()
+        self.output_lines = deque(maxlen=max_output_lines)
+        teefile = open(tee, 'wb') if isinstance(tee, str) else tee
+        try:
+            for raw_line in iter(stream.readline, b''):
+                if teefile is not None:
+                    teefile.write(raw_line)
+                line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+                parser.feed(line)
+                self.output_lines.append(line)
+                if callback is not None:
+                    callback(line)
+        finally:
+            if isinstance(tee, str):
+                teefile.close()
+        self.output_lines = list(self.output_lines)
+        self.set_results(parser)
+
+    def set_results(self, parser):
+        """Sets test results from an output_parser."""
+        self.success = parser.success
+        self.messages = parser.failure_messages
+        if parser.summary_parsed or not parser.case_failures:
+            self.asserts, self.cases = parser.asserts, parser.cases
+        else:  # driver did not finish- use results from case markers
+            self.asserts, self.cases = parser.marker_asserts, \
+                parser.marker_cases
+        self.timings = parser.timings
+        self.failed_cases = parser.failed_cases
+        self.case_failures = parser.case_failures
+        self.finished = parser.summary_parsed
+        self.in_flight = parser.current_case
+
+    def record_crash(self, reason, module_name=None):
+        """Records a crash of the driver (or a library worker process) with
+        the specified reason in the results. The case running at the time
+        (the in_flight property), if any, is counted as failed. Returns a
+        (module name, case name, reason) tuple, for the crashes property
+        (see run_library())."""
+        case_name = None
+        if self.in_flight is not None:
+            module_name, case_name = self.in_flight[1:]
+            key = (module_name, case_name)
+            self.failed_cases.append(key)
+            self.case_failures[key] = 1
+            self.cases.total += 1
+        self.messages.append('[%s]:crashed (%s)' %
+                             (case_name or module_name, reason))
+        self.success = False
+        return (module_name, case_name, reason)
 
     def get_output(self):
         """Gets output from output_lines, in a form suitable for display."""
         return ''.join(self.output_lines)
     output = property(get_output)
 
+    def parse_summary_line(self, line):
+        """Parses a summary line containing statistics on successful and total
+        numbers of asserts or cases."""
+        return parse_summary_line(line)
+
     def get_success(self):
         """Determines whether all tests ran successfully, by parsing the
-        output."""
-        self.success = any(["SUCCESSFUL!" in line
-                            for line in self.output_lines])
+        output. Deprecated: the output is parsed by parse_output()."""
+        import warnings
+        warnings.warn("get_success() is deprecated, use parse_output()",
+                      DeprecationWarning, stacklevel=2)
+        self.success = output_parser().parse(self.output_lines).success
 
     def get_messages(self):
-        """Parses output failure messages."""
-        self.messages = []
-        if not self.success:
-            for i, line in enumerate(self.output_lines):
-                if "Failed assertion messages:" in line:
-                    for j in range(i + 1, len(self.output_lines)):
-                        msg = self.output_lines[j]
-                        if "end of failed assertion messages." in msg:
-                            break
-                        else:
-                            self.messages.append(msg.strip())
-                    break
-
-    def parse_summary_line(self, line):
-        """Parses a summary line containing statistics on successful and total
-        numbers of asserts or cases."""
-        items = line.split()
-        slashpos = -(items[::-1].index('/') + 1)  # last occurrence of /
-        return int(items[slashpos - 1]), int(items[slashpos + 1])
+        """Parses output failure messages. Deprecated: the output is parsed
+        by parse_output()."""
+        import warnings
+        warnings.warn("get_messages() is deprecated, use parse_output()",
+                      DeprecationWarning, stacklevel=2)
+        self.messages = output_parser().parse(
+            self.output_lines).failure_messages
 
     def get_statistics(self):
-        """Parses output success / failure statistics."""
-        for i, line in enumerate(self.output_lines):
-            if "Successful asserts / total asserts" in line:
-                self.asserts.success, self.asserts.total = \
-                    self.parse_summary_line(line)
-                self.cases.success, self.cases.total = \
-                    self.parse_summary_line(self.output_lines[i + 1])
-
-    def summary(self):
-        """Prints a summary of the test results."""
+        """Parses output success / failure statistics. Deprecated: the
+        output is parsed by parse_output()."""
+        import warnings
+        warnings.warn("get_statistics() is deprecated, use parse_output()",
+                      DeprecationWarning, stacklevel=2)
+        parser = output_parser().parse(self.output_lines)
+        self.asserts, self.cases = parser.asserts, parser.cases
+
+    def get_durations(self):
+        """Returns ordered dictionary of test case durations (in seconds),
+        keyed by test module and case names. Durations are only available
+        if the driver was written with timing instrumentation."""
+        return OrderedDict([((module_name, name), seconds)
+                            for (kind, module_name, name), seconds
+                            in self.timings.items() if kind == 'case'])
+    durations = property(get_durations)
+
+    def slowest(self, num=10):
+        """Returns list of (module name, case name, duration) tuples for the
+        num slowest test cases."""
+        cases = sorted(self.durations.items(), key=lambda item: -item[1])
+        return [(module_name, name, seconds)
+                for (module_name, name), seconds in cases[:num]]
+
+    def largest(self, num=10):
+        """Returns list of (module name, case name, peak memory, CPU time)
+        tuples for the num test cases with the highest peak memory (kB) on
+        any rank, with the total CPU time (s) over all ranks. These are
+        only available if the run was profiled (see run()), and are
+        approximate, as they are sampled (see resource_sampler)."""
+        cases = [(module_name, name,
+                  max([usage[0] for usage in ranks.values()]),
+                  sum([usage[1] for usage in ranks.values()]))
+                 for (module_name, name), ranks in self.resources.items()]
+        return sorted(cases, key=lambda case: -case[2])[:num]
+
+    def write_resources(self, filename):
+        """Writes peak memory (kB) and CPU time (s) of each test case on
+        each rank to a JSON file."""
+        import json
+        resources = [{'module': module_name, 'name': name, 'rank': rank,
+                      'peak_memory_kb': usage[0], 'cpu_seconds': usage[1]}
+                     for (module_name, name), ranks
+                     in self.resources.items()
+                     for rank, usage in ranks.items()]
+        with open(filename, 'w') as f:
+            json.dump(resources, f, indent=2)
+
+    def write_timings(self, filename):
+        """Writes test case and module setup / teardown timings to a JSON
+        file."""
+        import json
+        timings = [{'kind': kind, 'module': module_name, 'name': name,
+                    'seconds': seconds}
+                   for (kind, module_name, name), seconds
+                   in self.timings.items()]
+        with open(filename, 'w') as f:
+            json.dump(timings, f, indent=2)
+
+    def summary(self, slowest=10):
+        """Prints a summary of the test results, including the slowest
+        test cases if timings are available, and those with the highest
+        peak memory if the run was profiled."""
         if not self.built:
             print('Test driver could not be built.')
             return
@@ -398,10 +3579,45 @@ class test_suite(object):
         print("Hit rate:")
         print("  asserts: ", self.asserts)
         print("  cases  : ", self.cases)
+        if self.stopped is not None:
+            print("Run stopped (%s)" % self.stopped +
+                  (" during test case: %s: %s" % self.in_flight[1:]
+                   if self.in_flight else "") + ".")
+        if self.crashes:
+            print("Crashed test modules:")
+            for module_name, name, reason in self.crashes:
+                print("  %s: %s (%s)" % (module_name, name or '-', reason))
+        if self.flaky:
+            print("Flaky test cases (passed on rerun):")
+            for module_name, name in self.flaky:
+                print("  %s: %s" % (module_name, name))
+        if self.persistent:
+            print("Persistently failing test cases:")
+            for module_name, name in self.persistent:
+                print("  %s: %s" % (module_name, name))
+        if self.rerun_build_failed:
+            print("Rerun driver build failed: failed test cases not "
+                  "classified.")
+        cases = self.slowest(slowest)
+        if cases:
+            print("Slowest test cases:")
+            for module_name, name, seconds in cases:
+                print("  %10.3f s: %s: %s" % (seconds, module_name, name))
+        cases = self.largest(slowest)
+        if cases:
+            print("Test cases with highest peak memory:")
+            for module_name, name, peak, cpu in cases:
+                print("  %10.1f MB %10.3f s CPU: %s: %s" %
+                      (peak / 1024., cpu, module_name, name))
 
     def build_run(self, driver, build_command=['make'], run_command=None,
                   num_procs=1, output_dir='', mpi_comm='MPI_COMM_WORLD',
-                  mpi=False):
+                  mpi=False, shards=1, split_modules=False,
+                  incremental=False, dependencies=None, timing=False,
+                  selection=False, include=None, exclude=None,
+                  markers=False, timeout=None, case_timeout=None,
+                  fail_fast=False, reruns=0, history=None, variants=False,
+                  resume=0, profile=None, split=False):
         """Writes, builds and runs test suite. Returns True if the
         build and all tests were successful.
         The parameters are:
@@ -420,35 +3636,688 @@ class test_suite(object):
         - 'mpi' (Boolean): set True to force using MPI. Only needed for
         num_procs = 1. Can be used to avoid having to rebuild the test
         executable between runs with 1 processor and multiple processors.
+        - 'shards' (integer): set > 1 to partition the suite into that many
+        shards, each with its own driver, and run them concurrently (see
+        build_run_shards())
+        - 'split_modules' (Boolean): set True to allow the cases in a test
+        module to be split across shards
+        - 'incremental' (Boolean): set True to skip the build if nothing
+        affecting it has changed since the last successful build (see
+        build())
+        - 'dependencies' (list): files the build depends on, other than the
+        driver and test module sources, for incremental builds
+        - 'timing' (Boolean): set True to add timing instrumentation to the
+        driver program, so durations of test cases are available after the
+        run (see the durations property)
+        - 'selection' (Boolean): set True to write a driver program that can
+        run a selection of the tests, specified at runtime (so running a
+        different selection does not need a rebuild)
+        - 'include', 'exclude' (list or str): patterns for selecting tests to
+        run (see select()). Specifying either of these implies selection =
+        True.
+        - 'markers' (Boolean): set True to write a driver program that marks
+        the start and end of each test case in its output
+        - 'timeout' (float): time limit (in seconds) for the whole run
+        - 'case_timeout' (float): time limit (in seconds) for each test case.
+        Specifying this implies markers = True.
+        - 'fail_fast' (Boolean): set True to stop the run as soon as a test
+        case fails. This implies markers = True.
+        - 'reruns' (integer): if > 0 and any tests fail, rerun the failed
+        cases up to this many times, to find which failures are flaky (see
+        rerun_failed()). The return value and test results are still those
+        of the original run.
+        - 'history' (results_history or str): results history (or its
+        filename) for ordering the test modules so that recently failing and
+        fast modules run first, and for recording the results of the run.
+        The driver program is written with ordering enabled, and the order
+        passed at runtime, so reordering does not need a rebuild.
+        - 'variants' (Boolean): set True to keep a separate driver source
+        and executable for each configuration variant (see variant_name()),
+        named by appending the variant name to the driver base name, so
+        switching between variants that are already built does not need the
+        driver to be rewritten or recompiled from scratch. The build command
+        should use '{driver}' and '{exe}'. The build is still run each time
+        unless incremental is also True. Built variants are recorded in a
+        manifest file (see variant_manifest) with the driver base name and
+        a '.variants' extension.
+        - 'resume' (integer): if > 0, write a driver program that can be
+        resumed from any test case, and if it crashes during a test case,
+        relaunch it from the next case, up to this many times (see run()).
+        This implies markers = True.
+        - 'profile' (float): interval (in seconds) for sampling the peak
+        memory and CPU time of each test case while the driver runs (see
+        run()). This implies markers = True.
+        - 'split' (Boolean): set True to split the driver program into a
+        thin main program and a separate compilation unit for each test
+        module, which are only rewritten when they change (see write()).
+        The build command should then also build the other units (e.g.
+        using '{units}', see build()).
         """
+        if include is not None or exclude is not None: selection = True
+        if case_timeout is not None or fail_fast or resume > 0 or \
+           profile is not None: markers = True
+        order = None
+        if history is not None:
+            order = [mod.test_module_name
+                     for mod in self.ordered_modules(history)]
+        driver_options = {'timing': timing, 'selection': selection,
+                          'markers': markers, 'ordering': order is not None,
+                          'resume': resume > 0, 'split': split}
+        run_options = {'include': include, 'exclude': exclude,
+                       'timeout': timeout, 'case_timeout': case_timeout,
+                       'fail_fast': fail_fast, 'resume': resume,
+                       'profile': profile, 'order': order}
+        if num_procs > 1: mpi = True
+        if variants:
+            from os.path import splitext
+            variant = variant_name(mpi, mpi_comm, timing, selection, markers,
+                                   resume > 0, split, order is not None)
+            manifest = variant_manifest(splitext(driver)[0] + '.variants')
+            driver = variant_driver(driver, variant)
+        if shards > 1:
+            self.build_run_shards(driver, shards, build_command, run_command,
+                                  num_procs, output_dir, mpi_comm, mpi,
+                                  split_modules, incremental, dependencies,
+                                  driver_options, run_options)
+        elif self.num_test_modules > 0:
+            update = self.write(driver, mpi, mpi_comm, **driver_options)
+            if self.build(build_command, output_dir, update, incremental,
+                          dependencies):
+                self.run(run_command, num_procs, output_dir, mpi,
+                         **run_options)
+        if variants and self.built:
+            from os.path import join
+            suites = self.shard_suites if shards > 1 else [self]
+            manifest.add(variant, {'mpi': mpi, 'mpi_comm': mpi_comm,
+                                   'timing': timing, 'selection': selection,
+                                   'markers': markers, 'resume': resume > 0,
+                                   'split': split,
+                                   'ordering': order is not None},
+                         driver,
+                         [join(output_dir, suite.exe) for suite in suites])
+            manifest.save()
+        if self.built and history is not None:
+            self.record_history(history)
+        if self.built and not self.success and reruns > 0:
+            self.rerun_failed(driver, build_command, run_command, num_procs,
+                              output_dir, mpi_comm, mpi, reruns,
+                              driver_options, {'timeout': timeout,
+                                               'case_timeout': case_timeout})
+        return self.built and self.success
+
+    def build_run_shards(self, driver, num_shards, build_command=None,
+                         run_command=None, num_procs=1, output_dir='',
+                         mpi_comm='MPI_COMM_WORLD', mpi=False,
+                         split_modules=False, incremental=False,
+                         dependencies=None, driver_options=None,
+                         run_options=None):
+        """Partitions test suite into shards, then writes and builds a driver
+        for each shard and runs the shard drivers concurrently. Shard driver
+        names are formed by appending '_0', '_1' etc. to the driver name.
+        The build command is run for each shard, so it should either contain
+        '{driver}' or '{exe}' (to be replaced by the shard driver source or
+        executable name) or build all the shard drivers. The driver_options
+        and run_options dictionaries contain additional keyword arguments
+        for write() and run(). The shard results are merged into the results
+        for the whole suite, and the shard suites are stored in the
+        shard_suites property. Returns True if the build and all tests were
+        successful. If running any shard raises an exception, it is raised
+        again once all the shards have finished."""
+        from os.path import splitext
+        import threading
+        if build_command is None:
+            build_command = ['make']
+        driver_options, run_options = driver_options or {}, run_options or {}
+        if num_procs > 1: mpi = True
+        self.shard_suites = self.shards(num_shards, split_modules)
+        base, ext = splitext(driver)
+        for i, shard in enumerate(self.shard_suites):
+            update = shard.write(base + '_%d' % i + ext, mpi, mpi_comm,
+                                 **driver_options)
+            if not shard.build(build_command, output_dir, update,
+                               incremental, dependencies):
+                break
+        else:
+            errors = []
+
+            def run_shard(shard):
+                try:
+                    shard.run(run_command, num_procs, output_dir, mpi,
+                              **run_options)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=run_shard, args=(shard,))
+                       for shard in self.shard_suites]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+        self.merge_results(self.shard_suites)
+        return self.success
+
+    def rerun_failed(self, driver, build_command=None, run_command=None,
+                     num_procs=1, output_dir='', mpi_comm='MPI_COMM_WORLD',
+                     mpi=False, reruns=3, driver_options=None,
+                     run_options=None):
+        """Reruns the test cases that failed in the last run, up to reruns
+        times, to distinguish flaky failures from persistent ones. For each
+        rerun a driver containing only the cases still failing (with their
+        module setup and teardown routines, and any global setup and
+        teardown) is written, with case markers, built and run. Its name is
+        formed by appending '_rerun' to the driver name, so the build
+        command should either contain '{driver}' or '{exe}' or also build
+        the rerun driver. The driver_options and run_options dictionaries
+        contain additional keyword arguments for write() and run(). Cases
+        passing in a rerun are stored in the flaky property, and those
+        still failing (or not completed) after all reruns in the persistent
+        property. If a rerun driver fails to build, the rerun_build_failed
+        property is set, and the cases not yet found to be flaky are left
+        unclassified (in neither property). Returns True if there were no
+        persistent failures and no build failures."""
+        from os.path import splitext
+        if build_command is None:
+            build_command = ['make']
+        if num_procs > 1: mpi = True
+        base, ext = splitext(driver)
+        rerun_driver = base + '_rerun' + ext
+        driver_options = dict(driver_options or {}, markers=True)
+        run_options = run_options or {}
+        self.flaky, failing = [], self.failed_case_names
+        self.rerun_build_failed = False
+        for i in range(reruns):
+            if not failing:
+                break
+            suite = self.case_subsuite(failing)
+            update = suite.write(rerun_driver, mpi, mpi_comm,
+                                 **driver_options)
+            if not suite.build(build_command, output_dir, update):
+                self.rerun_build_failed = True
+                self.persistent = []
+                return False
+            suite.run(run_command, num_procs, output_dir, mpi, **run_options)
+            passed = [(module_name, name) for (module_name, name), failed
+                      in suite.case_failures.items() if failed == 0]
+            passed = set([(module_name.lower(), name.lower())
+                          for module_name, name in passed])
+            self.flaky += [case for case in failing
+                           if (case[0].lower(), case[1].lower()) in passed]
+            failing = [case for case in failing if case not in self.flaky]
+        self.persistent = failing
+        return not self.persistent
+
+    def watch_build_run(self, driver, build_command=None,
+                        run_command=None, num_procs=1, output_dir='',
+                        mpi_comm='MPI_COMM_WORLD', mpi=False,
+                        source_dirs=None, dependencies=None, interval=0.5,
+                        debounce=0.2, callback=None, max_cycles=None,
+                        timing=False, markers=False, timeout=None):
+        """Builds and runs the test suite, then watches the test files,
+        Fortran sources in the source directories and any other dependency
+        files, and whenever any of them change, re-parses the changed test
+        modules, rewrites the driver (only if its content has changed),
+        rebuilds and runs the test modules affected by the changes (or all
+        of them, if no test modules are affected, e.g. if a build file has
+        changed). Changes are detected as for file_watcher, with the
+        specified polling interval and debounce time. The driver is written
+        with runtime selection enabled. After each run, the callback
+        function (if specified) is called with the suite and the list of
+        changed files (None for the initial run). Watching continues until
+        max_cycles runs have been done (if specified), or the process is
+        interrupted."""
+        from os.path import abspath, splitext
+        if build_command is None:
+            build_command = ['make']
         if num_procs > 1: mpi = True
+        driver_options = {'timing': timing, 'selection': True,
+                          'markers': markers}
+        generated = [driver, units_directory(driver),
+                     splitext(driver)[0] + '.fingerprint']
+        watcher = file_watcher(self.test_filenames + list(dependencies or []),
+                               source_dirs, interval, debounce,
+                               ignore=generated)
+        graph = module_graph(source_dirs)
+        for mod in self.test_modules:
+            graph.add_test_module(mod)
+        test_files = set([abspath(filename)
+                          for filename in self.test_filenames])
+        changed, cycles = None, 0
+        try:
+            while max_cycles is None or cycles < max_cycles:
+                include = None
+                if cycles > 0:
+                    changed = watcher.wait()
+                    for mod in self.reparse([filename for filename in changed
+                                             if filename in watcher.files]):
+                        graph.add_test_module(mod)
+                    for filename in changed:
+                        if filename in watcher.files and \
+                           filename not in test_files and \
+                           splitext(filename)[1].lower() in \
+                           module_graph.source_extensions:
+                            graph.add_file(filename)
+                    modules = self.impacted(changed, graph=graph).test_modules
+                    include = [mod.test_module_name + ':*'
+                               for mod in modules] or None
+                update = self.write(driver, mpi, mpi_comm, **driver_options)
+                if self.build(build_command, output_dir, update):
+                    self.run(run_command, num_procs, output_dir, mpi,
+                             include=include, timeout=timeout)
+                cycles += 1
+                if callback is not None:
+                    callback(self, changed)
+        finally:
+            watcher.close()
+        return self.built and self.success
+
+    def build_library(self, build_command, output_dir='', update=True):
+        """Builds the shared library for running the test suite via ctypes
+        (see run_library()) from the library interface module written by
+        write_library(), the test modules and FRUIT. The build command is
+        as for build(), with '{driver}' and '{exe}' replaced by the library
+        interface source and shared library names (see library_name()), or
+        a fortran_build object. Returns True if the build was
+        successful."""
+        from os import remove
+        from os.path import isfile, join
+        from subprocess import call
+        import shlex
+        name = library_name(self.library_source)
+        self.library = join(output_dir, name)
+        if isinstance(build_command, fortran_build):
+            returncode = build_command.build(self.library_source,
+                                             self.test_filenames,
+                                             self.library, shared=True)
+        else:
+            if not isinstance(build_command, list):
+                build_command = shlex.split(build_command)
+            build_command = [arg.replace('{driver}', self.library_source).
+                             replace('{exe}', name) for arg in build_command]
+            if isfile(self.library) and update:
+                remove(self.library)
+            returncode = call(build_command)
+        self.built = returncode == 0 and isfile(self.library)
+        return self.built
+
+    def library_calls(self, include=None, exclude=None):
+        """Returns list of calls for running the selected test cases (see
+        select()) from the shared library. Each call is a tuple of the
+        test module and list of (case index, test subroutine) tuples."""
+        selection = set(self.select(include, exclude))
+        calls, index = [], 0
+        for mod in self.test_modules:
+            module_name = mod.test_module_name.lower()
+            cases = []
+            for sub in mod.subroutines:
+                index += 1
+                if module_name in selection or \
+                   module_name + ':' + sub.name.lower() in selection:
+                    cases.append((index, sub))
+            if cases:
+                calls.append((mod, cases))
+        return calls
+
+    def call_library(self, calls):
+        """Loads the shared library and runs the specified calls (see
+        library_calls()), with global setup and teardown."""
+        import ctypes
+        from os.path import abspath
+        library = ctypes.CDLL(abspath(self.library))
+        for name in ['fruitpy_init', 'fruitpy_summary']:
+            getattr(library, name).argtypes = []
+            getattr(library, name).restype = None
+        run_case = library.fruitpy_run_case
+        run_case.argtypes = [ctypes.c_void_p, ctypes.c_int] + \
+            [ctypes.c_char_p] * 3
+        run_case.restype = None
+        library.fruitpy_init()
+        for mod in self.test_modules:
+            if mod.global_setup:
+                library_procedure(library, mod.test_module_name, 'setup')()
+        for mod, cases in calls:
+            if mod.setup:
+                library_procedure(library, mod.test_module_name,
+                                  mod.setup)()
+            for index, sub in cases:
+                procedure = library_procedure(library, mod.test_module_name,
+                                              sub.name)
+                run_case(ctypes.cast(procedure, ctypes.c_void_p), index,
+                         mod.test_module_name.encode('utf-8'),
+                         sub.name.encode('utf-8'),
+                         sub.description.encode('utf-8'))
+            if mod.teardown:
+                library_procedure(library, mod.test_module_name,
+                                  mod.teardown)()
+        library.fruitpy_summary()
+        for mod in self.test_modules:
+            if mod.global_teardown:
+                library_procedure(library, mod.test_module_name,
+                                  'teardown')()
+
+    def call_library_isolated(self, calls, fd):
+        """Runs the specified calls (see library_calls()) in a forked
+        worker process, with its output written to the file descriptor
+        fd. Returns None if the worker finished normally, otherwise a
+        string describing how it ended."""
+        import os
+        import sys
+        import traceback
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                try:  # crashes are reported by the parent process
+                    import faulthandler
+                    faulthandler.disable()
+                except ImportError:  # Python 2
+                    pass
+                os.dup2(fd, 1)
+                os.dup2(fd, 2)
+                self.call_library(calls)
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                sys.stderr.flush()
+                os._exit(status)
+        status = os.waitpid(pid, 0)[1]
+        if os.WIFSIGNALED(status):
+            return 'signal %d' % os.WTERMSIG(status)
+        elif os.WEXITSTATUS(status) != 0:
+            return 'exit status %d' % os.WEXITSTATUS(status)
+        return None
+
+    def call_library_captured(self, calls, fd):
+        """Runs the specified calls (see library_calls()) in this process,
+        with its output redirected to the file descriptor fd."""
+        import os
+        import sys
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = [os.dup(1), os.dup(2)]
+        try:
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            self.call_library(calls)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for i, saved_fd in enumerate(saved):
+                os.dup2(saved_fd, i + 1)
+                os.close(saved_fd)
+
+    def run_library(self, isolate=True, include=None, exclude=None):
+        """Runs the test suite from the shared library built by
+        build_library(), loading it via ctypes and calling the test cases
+        directly, instead of running a driver executable. Only the cases
+        matching the include and exclude patterns are run (see select()).
+
+        If isolate is True (POSIX only), each test module is run in its own
+        forked worker process, which loads the library, so a crashing test
+        case only loses the results of the rest of its module and the
+        other modules still run, without rebuilding. Global setup and
+        teardown routines are called in each worker. Modules that did not
+        finish are recorded in the crashes property, as a list of (module
+        name, case name, reason) tuples (with case name None if the crash
+        was not in a test case), and the crashed cases are counted as
+        failed. If isolate is False, all the tests are run in this
+        process. Output is captured and parsed as for run(). Returns True
+        if all tests passed."""
+        import os
+        import tempfile
+        calls = self.library_calls(include, exclude)
+        isolate = isolate and hasattr(os, 'fork')
+        suites, self.crashes = [], []
+        for unit in [[call] for call in calls] if isolate else [calls]:
+            fd, output_filename = tempfile.mkstemp(suffix='.out')
+            try:
+                if isolate:
+                    reason = self.call_library_isolated(unit, fd)
+                else:
+                    reason = self.call_library_captured(unit, fd)
+                with open(output_filename) as f:
+                    lines = f.read().splitlines()
+            finally:
+                os.close(fd)
+                os.remove(output_filename)
+            parser = output_parser().parse(lines)
+            suite = self.subsuite([mod for mod, cases in unit])
+            suite.built, suite.output_lines = True, lines
+            suite.set_results(parser)
+            if reason is not None or not suite.finished:
+                self.crashes.append(suite.record_crash(
+                    reason or 'did not finish', unit[0][0].test_module_name))
+            suites.append(suite)
+        self.merge_results(suites)
+        return self.success
+
+    def build_run_library(self, library_source, build_command=None,
+                          output_dir='', isolate=True, include=None,
+                          exclude=None):
+        """Writes the library interface module, builds the shared library
+        and runs the test suite from it (see run_library()). Returns True
+        if the build and all tests were successful."""
+        if build_command is None:
+            build_command = ['make']
         if self.num_test_modules > 0:
-            update = self.write(driver, mpi, mpi_comm)
-            if self.build(build_command, output_dir, update):
-                return self.run(run_command, num_procs, output_dir, mpi)
-        return False
+            update = self.write_library(library_source)
+            if self.build_library(build_command, output_dir, update):
+                self.run_library(isolate, include, exclude)
+        return self.built and self.success
 
 
 if __name__ == '__main__':
-    from sys import argv
+    from sys import argv, exit
     from argparse import ArgumentParser
     parser = ArgumentParser()
-    parser.add_argument('command', choices=['build_run', 'write'], help=
-                        """
+    parser.add_argument('command',
+                        choices=['build_run', 'write', 'run', 'sweep',
+                                 'watch', 'library', 'coordinate',
+                                 'worker'],
+                        help="""
                         command to be executed,
                         build_run - write driver file, build and execute tests,
-                        write - write driver file
+                        write - write driver file,
+                        run - execute tests using existing driver executable,
+                        sweep - run existing MPI driver executable for
+                        different numbers of processes,
+                        watch - build and execute tests, then rebuild and
+                        execute affected tests whenever files change,
+                        library - build tests into a shared library and run
+                        them via ctypes, each module in its own process,
+                        coordinate - run tests on workers connecting to the
+                        coordinator address,
+                        worker - run tests handed out by the coordinator at
+                        the address, using existing driver executable (built
+                        with selection)
                         """)
-    parser.add_argument('file', nargs='+',
+    parser.add_argument('file', nargs='*',
                         help="Fortran module(s) defining test cases")
     parser.add_argument('-d', '--driver', default="fruit_driver.f90",
                         help="driver file name, default: %(default)s")
     parser.add_argument('-b', '--build', default="make",
                         help="build command, default: %(default)s")
+    parser.add_argument('--compiler', default=None,
+                        help="Fortran compiler for building with the native "
+                        "build engine instead of the build command")
+    parser.add_argument('--flags', default='',
+                        help="compiler flags for the native build engine")
+    parser.add_argument('--link-flags', default='',
+                        help="link flags (e.g. libraries) for the native "
+                        "build engine")
+    parser.add_argument('--sources', nargs='*', default=[],
+                        help="other source files to compile with the native "
+                        "build engine (as well as those in --source-dirs)")
+    parser.add_argument('-c', '--cache', default=None,
+                        help="parse cache file name, default: no cache")
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help="number of processes for parsing test files, "
+                        "default: %(default)s")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="skip build if its inputs are unchanged")
+    parser.add_argument('--depends', nargs='*', default=[],
+                        help="other files the build depends on")
+    parser.add_argument('-t', '--timing', action='store_true',
+                        help="time test cases and show the slowest ones")
+    parser.add_argument('--timing-file', default=None,
+                        help="JSON file for writing test case timings")
+    parser.add_argument('--profile', type=float, default=None,
+                        help="interval (s) for sampling peak memory and CPU "
+                        "time of test cases, default: no profiling")
+    parser.add_argument('--profile-file', default=None,
+                        help="JSON file for writing test case peak memory "
+                        "and CPU time")
+    parser.add_argument('-s', '--shards', type=int, default=1,
+                        help="number of shards to run concurrently, "
+                        "default: %(default)s")
+    parser.add_argument('--selection', action='store_true',
+                        help="write driver supporting runtime test selection")
+    parser.add_argument('--timeout', type=float, default=None,
+                        help="time limit (s) for the whole run")
+    parser.add_argument('--case-timeout', type=float, default=None,
+                        help="time limit (s) for each test case")
+    parser.add_argument('-x', '--fail-fast', action='store_true',
+                        help="stop the run at the first failed test case")
+    parser.add_argument('-k', '--include', action='append', default=None,
+                        help="pattern for selecting tests to run")
+    parser.add_argument('-e', '--exclude', action='append', default=None,
+                        help="pattern for excluding tests from the run")
+    parser.add_argument('--changed', nargs='*', default=None,
+                        help="only run tests affected by these changed files")
+    parser.add_argument('--source-dirs', nargs='*', default=[],
+                        help="directories of source code under test, "
+                        "for finding tests affected by changed files")
+    parser.add_argument('-n', '--procs', type=int, nargs='*',
+                        default=[1, 2, 4],
+                        help="numbers of processes for scaling sweep, "
+                        "default: %(default)s")
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help="number of runs for each number of processes "
+                        "in scaling sweep, default: %(default)s")
+    parser.add_argument('--sweep-file', default=None,
+                        help="JSON file for writing scaling sweep results")
+    parser.add_argument('--reruns', type=int, default=0,
+                        help="number of times to rerun failed test cases, "
+                        "default: %(default)s")
+    parser.add_argument('--resume', type=int, default=0,
+                        help="number of times to resume the run after the "
+                        "driver crashes, default: %(default)s")
+    parser.add_argument('--history', default=None,
+                        help="SQLite results history file, for recording "
+                        "results and running recently failing and fast test "
+                        "modules first")
+    parser.add_argument('--split', action='store_true',
+                        help="split driver into separate compilation units "
+                        "for each test module")
+    parser.add_argument('--variants', action='store_true',
+                        help="keep a separate driver and executable for each "
+                        "configuration variant")
+    parser.add_argument('--address', default='localhost:50070',
+                        help="coordinator address for distributed runs, "
+                        "host:port or Unix socket file, default: "
+                        "%(default)s")
+    parser.add_argument('--retries', type=int, default=1,
+                        help="number of times to re-queue a test module in a "
+                        "distributed run if its worker is lost, default: "
+                        "%(default)s")
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help="polling interval (s) for watching files, "
+                        "default: %(default)s")
+    parser.add_argument('--min-efficiency', type=float, default=None,
+                        help="minimum parallel efficiency (0-1) for scaling "
+                        "sweep to pass")
     args = parser.parse_args(argv[1:])
-    ts = test_suite(args.file)
+    if not args.file and args.command != 'worker':
+        parser.error("at least one test module file is required")
+    if args.compiler is not None:
+        import shlex
+        args.build = fortran_build(args.compiler, shlex.split(args.flags),
+                                   shlex.split(args.link_flags), args.sources,
+                                   args.source_dirs)
+    ts = test_suite(args.file, args.cache, args.processes)
+    if args.changed is not None:
+        ts = ts.impacted(args.changed, args.source_dirs)
     if args.command == "build_run":
-        ts.build_run(args.driver, args.build)
+        ts.build_run(args.driver, args.build, shards=args.shards,
+                     incremental=args.incremental, dependencies=args.depends,
+                     timing=args.timing or args.timing_file is not None,
+                     selection=args.selection, include=args.include,
+                     exclude=args.exclude, timeout=args.timeout,
+                     case_timeout=args.case_timeout,
+                     fail_fast=args.fail_fast, reruns=args.reruns,
+                     history=args.history, variants=args.variants,
+                     resume=args.resume, profile=args.profile,
+                     split=args.split)
+    elif args.command in ["write", "run"]:
+        markers = args.case_timeout is not None or args.fail_fast or \
+            args.resume > 0 or args.profile is not None
+        selection = args.selection or args.include is not None or \
+            args.exclude is not None
+        if args.variants:
+            args.driver = variant_driver(args.driver, variant_name(
+                timing=args.timing, selection=selection, markers=markers,
+                resume=args.resume > 0, split=args.split,
+                ordering=args.history is not None))
+    if args.command == "write":
+        ts.write(args.driver, timing=args.timing, selection=selection,
+                 markers=markers, ordering=args.history is not None,
+                 resume=args.resume > 0, split=args.split)
+    elif args.command == "run":
+        ts.exe, ts.built = executable_name(args.driver), True
+        order = None
+        if args.history:
+            order = [mod.test_module_name
+                     for mod in ts.ordered_modules(args.history)]
+        ts.run(include=args.include, exclude=args.exclude,
+               timeout=args.timeout, case_timeout=args.case_timeout,
+               fail_fast=args.fail_fast, resume=args.resume,
+               profile=args.profile, order=order)
+        if args.history:
+            ts.record_history(args.history)
+    elif args.command == "sweep":
+        ts.exe, ts.built = executable_name(args.driver), True
+        result = ts.scaling_sweep(args.procs, args.repeats,
+                                  timeout=args.timeout)
+        print(result.table())
+        if args.sweep_file:
+            result.write(args.sweep_file)
+        if args.min_efficiency is not None:
+            inefficient = result.inefficient(args.min_efficiency)
+            if inefficient:
+                print("Parallel efficiency below minimum for processes:",
+                      ' '.join([str(n) for n in inefficient]))
+                exit(1)
+    elif args.command == "watch":
+        def show(suite, changed):
+            if changed:
+                print("Changed:", ' '.join(changed))
+            suite.summary()
+        try:
+            ts.watch_build_run(args.driver, args.build,
+                               source_dirs=args.source_dirs,
+                               dependencies=args.depends,
+                               interval=args.interval, callback=show,
+                               timing=args.timing, timeout=args.timeout)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "library":
+        from os.path import splitext
+        base, ext = splitext(args.driver)
+        ts.build_run_library(base + '_library' + ext, args.build,
+                             include=args.include, exclude=args.exclude)
+    elif args.command == "coordinate":
+        ts.run_distributed(socket_address(args.address), args.retries,
+                           args.timeout)
+    elif args.command == "worker":
+        test_worker(socket_address(args.address),
+                    executable_name(args.driver)).serve()
+    if args.command in ["build_run", "run", "library", "coordinate"]:
         ts.summary()
-    elif args.command == "write":
-        ts.write(args.driver)
+        if args.timing_file:
+            ts.write_timings(args.timing_file)
+        if args.profile_file:
+            ts.write_resources(args.profile_file)
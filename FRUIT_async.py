@@ -0,0 +1,142 @@
+"""Asynchronous interface for building and running FRUIT test suites using
+asyncio (Python 3.5 or later), so that many suites (e.g. different build
+configurations, or serial and MPI variants) can be built and run
+concurrently from one event loop.
+
+Copyright 2014 University of Auckland.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import os
+from collections import deque
+
+from FRUIT import (test_suite, output_parser, kill_process_group,
+                   fortran_build)
+
+
+async def gather(*coroutines, max_concurrent=None):
+    """Runs coroutines concurrently as for asyncio.gather(), but with at
+    most max_concurrent of them running at any one time (if specified).
+    Returns list of results."""
+    if max_concurrent is None:
+        return await asyncio.gather(*coroutines)
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[limited(coroutine)
+                                  for coroutine in coroutines])
+
+
+class async_test_suite(test_suite):
+
+    """Test suite with asynchronous methods for building and running. All
+    subprocesses are started with their working directory set explicitly,
+    so no process-wide state is changed."""
+
+    async def async_build(self, build_command, output_dir='', update=True,
+                          incremental=False, dependencies=None):
+        """Asynchronous version of build()."""
+        build_command = self.start_build(build_command, output_dir, update,
+                                         incremental, dependencies)
+        if isinstance(build_command, fortran_build):
+            returncode = await asyncio.get_event_loop().run_in_executor(
+                None, build_command.build, self.driver,
+                self.test_filenames + self.unit_files,
+                os.path.join(output_dir, self.exe))
+            self.finish_build(returncode, output_dir, incremental)
+        elif build_command is not None:
+            process = await asyncio.create_subprocess_exec(*build_command)
+            self.finish_build(await process.wait(), output_dir, incremental)
+        return self.built
+
+    async def async_run(self, run_command=None, num_procs=1, output_dir='',
+                        mpi=False, callback=None, max_output_lines=None,
+                        include=None, exclude=None, timeout=None):
+        """Asynchronous version of run(). Output is parsed line by line as
+        it is produced (see parse_stream() for the callback and
+        max_output_lines parameters). If the run takes longer than timeout
+        seconds, it is stopped, killing the driver program and any child
+        processes. They are also killed if the run is cancelled."""
+        run = self.run_args(run_command, num_procs, mpi)
+        selection_filename = self.write_selection(include, exclude)
+        if selection_filename is not None:
+            run.append('@' + selection_filename)
+        self.stopped, self.in_flight = None, None
+        parser = output_parser()
+        self.output_lines = deque(maxlen=max_output_lines)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *run, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT, cwd=output_dir or None,
+                start_new_session=os.name == 'posix', limit=1 << 24)
+            try:
+                await asyncio.wait_for(self.read_output(process.stdout,
+                                                        parser, callback),
+                                       timeout)
+            except asyncio.TimeoutError:
+                self.stopped = 'timeout'
+                self.in_flight = parser.current_case
+                kill_process_group(process)
+            except asyncio.CancelledError:
+                kill_process_group(process)
+                await process.wait()
+                raise
+            await process.wait()
+        finally:
+            if selection_filename is not None:
+                os.remove(selection_filename)
+        self.output_lines = list(self.output_lines)
+        self.set_results(parser)
+        if self.stopped is not None:
+            self.success = False
+        return self.success
+
+    async def read_output(self, stream, parser, callback=None):
+        """Reads and parses driver output from an asyncio stream."""
+        while True:
+            raw_line = await stream.readline()
+            if not raw_line:
+                break
+            line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+            parser.feed(line)
+            self.output_lines.append(line)
+            if callback is not None:
+                callback(line)
+
+    async def async_build_run(self, driver, build_command=None,
+                              run_command=None, num_procs=1, output_dir='',
+                              mpi_comm='MPI_COMM_WORLD', mpi=False,
+                              incremental=False, dependencies=None,
+                              timing=False, selection=False, include=None,
+                              exclude=None, markers=False, timeout=None):
+        """Asynchronous version of build_run(), with the same parameters
+        (apart from those for sharding and per-case timeouts)."""
+        if build_command is None:
+            build_command = ['make']
+        if include is not None or exclude is not None: selection = True
+        if num_procs > 1: mpi = True
+        if self.num_test_modules > 0:
+            update = self.write(driver, mpi, mpi_comm, timing, selection,
+                                markers)
+            if await self.async_build(build_command, output_dir, update,
+                                      incremental, dependencies):
+                return await self.async_run(run_command, num_procs,
+                                            output_dir, mpi, include=include,
+                                            exclude=exclude, timeout=timeout)
+        return False
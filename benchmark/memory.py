@@ -0,0 +1,108 @@
+"""Benchmarks the memory used by the FRUITPy test suite model for a large
+synthetic suite of test modules, comparing the slotted test module and
+subroutine classes (eagerly parsed, and lazily created from a cache, with
+only the global setup and teardown flags read, or with some of the modules
+loaded) against equivalent dictionary-backed classes. The lazy figures
+include the memory used by the cache. Requires tracemalloc (Python 3.4 or
+later)."""
+
+from __future__ import (absolute_import, division, print_function)
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import FRUIT
+from synthetic import write_test_modules
+
+
+class dict_subroutine(object):
+    """Dictionary-backed test subroutine, for comparison."""
+
+    def __init__(self, name, description, subtype):
+        self.name = name
+        self.description = description
+        self.subtype = subtype
+
+
+class dict_module(object):
+    """Dictionary-backed test module, for comparison."""
+
+    def __init__(self, test_filename):
+        self.test_filename = test_filename
+        data = FRUIT.parse_test_module_data(test_filename)
+        self.test_module_name = data['test_module_name']
+        for name in ['setup', 'teardown', 'global_setup', 'global_teardown']:
+            setattr(self, name, data[name])
+        self.subroutines = [dict_subroutine(*sub)
+                            for sub in data['subroutines']]
+        self.uses = data['uses']
+
+
+def retained_memory(function):
+    """Returns memory (bytes) still allocated to the result of calling
+    function, after garbage collection."""
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    gc.collect()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def lazy_suite(filenames, cache_filename, fraction):
+    """Returns lazy test suite using the specified cache, after checking for
+    global setup (as when writing the driver for a sub-suite) and loading
+    the specified fraction of its modules."""
+    suite = FRUIT.test_suite(filenames, cache_filename, lazy=True)
+    suite.global_setup
+    num_loaded = int(fraction * len(suite.test_modules))
+    for mod in suite.test_modules[:num_loaded]:
+        mod.load()
+    return suite
+
+
+def benchmark(num_modules, num_cases, fraction):
+    """Returns list of (name, memory) pairs for the suite models."""
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = write_test_modules(directory, num_modules, num_cases, 0)
+        cache_filename = os.path.join(directory, 'cache.json')
+        FRUIT.test_suite(filenames, cache_filename).cache.save()
+        models = [('dict', lambda: [dict_module(f) for f in filenames]),
+                  ('slots', lambda: FRUIT.test_suite(filenames)),
+                  ('slots, lazy (flags read)',
+                   lambda: lazy_suite(filenames, cache_filename, 0.)),
+                  ('slots, lazy (%d%% loaded)' % (100 * fraction),
+                   lambda: lazy_suite(filenames, cache_filename,
+                                      fraction))]
+        return [(name, retained_memory(function))
+                for name, function in models]
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-m', '--modules', type=int, default=2000,
+                        help="number of test modules, default: %(default)s")
+    parser.add_argument('-c', '--cases', type=int, default=50,
+                        help="number of test cases per module, "
+                        "default: %(default)s")
+    parser.add_argument('-f', '--fraction', type=float, default=0.1,
+                        help="fraction of modules loaded in lazy suite, "
+                        "default: %(default)s")
+    args = parser.parse_args()
+    results = benchmark(args.modules, args.cases, args.fraction)
+    base = results[0][1]
+    print("%-28s %14s %8s" % ("model", "memory (kB)", "ratio"))
+    for name, memory in results:
+        print("%-28s %14.1f %8.2f" % (name, memory / 1024, memory / base))
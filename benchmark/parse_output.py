@@ -0,0 +1,48 @@
+"""Benchmarks parsing of FRUIT output by the FRUITPy output parser, using
+synthetic outputs of increasing size. The time per line should stay roughly
+constant (linear total time), and the peak memory allocated while parsing a
+stream of lines should not grow with the output size."""
+
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import FRUIT
+from synthetic import fruit_output, peak_memory
+
+asserts_per_case = 40
+
+
+def synthetic_output(num_lines):
+    """Returns synthetic FRUIT output without markers, with approximately
+    the specified number of lines (two per test case: test output and assert
+    progress markers)."""
+    return fruit_output(1, num_lines // 2, asserts_per_case, markers=False,
+                        timing=False)
+
+
+def benchmark(sizes):
+    """Parses outputs of the specified sizes (numbers of lines) and prints
+    time and peak memory for each."""
+    print("%12s %10s %14s %14s" % ("lines", "time (s)", "us per line",
+                                   "peak mem (kB)"))
+    for num_lines in sizes:
+        start = time.time()
+        parser = FRUIT.output_parser().parse(synthetic_output(num_lines))
+        elapsed = time.time() - start
+        assert parser.asserts.total == num_lines // 2 * asserts_per_case
+        peak = peak_memory(lambda: FRUIT.output_parser().parse(
+            synthetic_output(num_lines)))
+        peak = '-' if peak is None else '%.1f' % (peak / 1024)
+        print("%12d %10.3f %14.3f %14s" % (num_lines, elapsed,
+                                           elapsed / num_lines * 1.e6, peak))
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or \
+        [125000, 250000, 500000, 1000000, 2000000, 4000000]
+    benchmark(sizes)
@@ -0,0 +1,163 @@
+"""Benchmarks the main stages of FRUITPy (parsing test modules, generating
+and writing the driver, and parsing driver output) on a synthetic suite of
+test modules, recording the time and peak memory allocated for each stage.
+Results can optionally be saved as a baseline file and later runs compared
+against it, to detect performance regressions. Baseline times are only
+meaningful on the machine they were measured on, so baselines are not
+distributed. No Fortran compiler is needed."""
+
+from __future__ import (absolute_import, division, print_function)
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import FRUIT
+from synthetic import write_test_modules, fruit_output, peak_memory
+
+
+def best_time(function, repeats):
+    """Returns best wall-clock time (s) for calling function over the
+    specified number of repeats."""
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def stages(directory, config):
+    """Returns list of (name, function) pairs for the benchmark stages,
+    writing synthetic test modules to the specified directory."""
+    filenames = write_test_modules(directory, config['modules'],
+                                   config['cases'], config['comment_lines'])
+    cache_filename = os.path.join(directory, 'cache.json')
+    FRUIT.test_suite(filenames, cache=cache_filename)
+    suite = FRUIT.test_suite(filenames)
+    driver = os.path.join(directory, 'driver.f90')
+    options = {'timing': True, 'selection': True, 'markers': True}
+
+    def write():
+        if os.path.isfile(driver):
+            os.remove(driver)
+        suite.write(driver, **options)
+
+    def parse_output(num_procs):
+        return lambda: FRUIT.output_parser().parse(
+            fruit_output(config['modules'], config['cases'],
+                         num_procs=num_procs))
+
+    return [('parse', lambda: FRUIT.test_suite(filenames)),
+            ('parse (cached)',
+             lambda: FRUIT.test_suite(filenames, cache=cache_filename)),
+            ('driver_lines', lambda: suite.driver_lines(**options)),
+            ('driver_lines (mpi)',
+             lambda: suite.driver_lines(mpi=True, **options)),
+            ('write', write),
+            ('parse_output', parse_output(1)),
+            ('parse_output (mpi)', parse_output(config['procs']))]
+
+
+def benchmark(config, repeats=5, memory=True):
+    """Runs the benchmark stages and returns a dictionary of results,
+    containing time (s) and peak memory (bytes) for each stage."""
+    results = OrderedDict()
+    directory = tempfile.mkdtemp()
+    try:
+        for name, function in stages(directory, config):
+            peak = peak_memory(function) if memory else None
+            results[name] = {'time': best_time(function, repeats),
+                             'memory': peak}
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints results compared with the baseline, and returns a list of
+    stages whose time or memory exceeds the baseline by more than the
+    specified fractional tolerance."""
+    regressions = []
+    print("%-20s %10s %10s %8s %14s %14s" %
+          ("stage", "time (s)", "base (s)", "ratio", "peak mem (kB)",
+           "base (kB)"))
+    for name, result in results.items():
+        base = baseline.get(name, {})
+        ratio = result['time'] / base['time'] if base.get('time') else None
+        if ratio is not None and ratio > 1. + tolerance:
+            regressions.append(name)
+        memory, base_memory = result['memory'], base.get('memory')
+        if memory and base_memory and \
+           memory > base_memory * (1. + tolerance):
+            if name not in regressions:
+                regressions.append(name)
+        print("%-20s %10.3f %10s %8s %14s %14s" %
+              (name, result['time'],
+               '-' if not base.get('time') else '%.3f' % base['time'],
+               '-' if ratio is None else '%.2f' % ratio,
+               '-' if memory is None else '%.1f' % (memory / 1024),
+               '-' if base_memory is None else
+               '%.1f' % (base_memory / 1024)))
+    return regressions
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-m', '--modules', type=int, default=2000,
+                        help="number of test modules, default: %(default)s")
+    parser.add_argument('-c', '--cases', type=int, default=10,
+                        help="number of test cases per module, "
+                        "default: %(default)s")
+    parser.add_argument('--comment-lines', type=int, default=10,
+                        help="number of comment lines before each test "
+                        "case, default: %(default)s")
+    parser.add_argument('-n', '--procs', type=int, default=4,
+                        help="number of MPI ranks in synthetic MPI output, "
+                        "default: %(default)s")
+    parser.add_argument('-r', '--repeats', type=int, default=5,
+                        help="number of repeats for timing each stage, "
+                        "default: %(default)s")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="do not measure peak memory")
+    parser.add_argument('-b', '--baseline', metavar='FILE',
+                        help="baseline results file to compare against "
+                        "(or save to)")
+    parser.add_argument('--save', action='store_true',
+                        help="save results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="fractional increase over baseline reported "
+                        "as a regression, default: %(default)s")
+    args = parser.parse_args()
+    if args.save and not args.baseline:
+        parser.error("--save requires --baseline")
+    if args.baseline and not args.save and not os.path.isfile(args.baseline):
+        parser.error("baseline file %s not found" % args.baseline)
+    config = {'modules': args.modules, 'cases': args.cases,
+              'comment_lines': args.comment_lines, 'procs': args.procs}
+    results = benchmark(config, args.repeats, not args.no_memory)
+    baseline = {}
+    if args.baseline and os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            data = json.load(f)
+        if data['config'] == config:
+            baseline = data['results']
+        else:
+            print("Baseline configuration %s differs, not comparing." %
+                  data['config'])
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2,
+                      sort_keys=True)
+            f.write('\n')
+    elif regressions:
+        print("Regressions: %s" % ', '.join(regressions))
+        sys.exit(1)
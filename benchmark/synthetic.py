@@ -0,0 +1,116 @@
+"""Generators of synthetic FRUIT test modules and driver outputs, for
+benchmarking FRUITPy on large test suites without a Fortran compiler, and
+helpers shared by the benchmark scripts."""
+
+from __future__ import (absolute_import, division, print_function)
+
+import os
+
+
+def test_module_source(index, num_cases, comment_lines=10,
+                       comment_length=100):
+    """Returns source of a synthetic test module with the specified number
+    of test cases, each preceded by a block of long comment lines, plus
+    setup and teardown routines and some non-test subroutines."""
+    name = 'synthetic_%05d' % index
+    comment = '! ' + ('x' * (comment_length - 2))
+    lines = ['module %s_test' % name, '',
+             '  use fruit', '  use %s_module' % name,
+             '  use, intrinsic :: iso_fortran_env, only: real64', '',
+             '  implicit none', '', '  contains', '',
+             '    subroutine setup', '      call init_%s()' % name,
+             '    end subroutine setup', '',
+             '    subroutine teardown', '      call finalise_%s()' % name,
+             '    end subroutine teardown', '']
+    for i in range(num_cases):
+        lines += [comment] * comment_lines
+        lines += ['    subroutine test_case_%d(  )' % i, '',
+                  '      ! Synthetic test case %d of module %s' % (i, name),
+                  '      real(real64) :: x', '',
+                  '      x = %d._real64' % i,
+                  '      call assert_equals(%d._real64, x, &' % i,
+                  "           'case %d subroutine value')" % i, '',
+                  '    end subroutine test_case_%d' % i, '']
+        if i % 5 == 0:
+            lines += ['    subroutine helper_%d(x)' % i,
+                      '      real(real64), intent(in out) :: x',
+                      '      x = x + 1',
+                      '    end subroutine helper_%d' % i, '']
+    lines += ['end module %s_test' % name, '']
+    return '\n'.join(lines)
+
+
+def write_test_modules(directory, num_modules, cases_per_module,
+                       comment_lines=10, comment_length=100):
+    """Writes synthetic test module files to the specified directory, and
+    returns a list of their filenames."""
+    filenames = []
+    for index in range(num_modules):
+        filename = os.path.join(directory, 'synthetic_%05d_test.F90' % index)
+        with open(filename, 'w') as f:
+            f.write(test_module_source(index, cases_per_module,
+                                       comment_lines, comment_length))
+        filenames.append(filename)
+    return filenames
+
+
+def fruit_output(num_modules, cases_per_module, asserts_per_case=10,
+                 num_failures=100, num_procs=1, markers=True, timing=True):
+    """Generates lines of synthetic output from a driver for the synthetic
+    test modules, optionally with case markers and timing markers (written
+    by every rank for MPI output). For MPI output (num_procs > 1) the
+    ranks' lines are interleaved, and each rank writes its own failed
+    assertion message block, as with FRUIT's MPI routines."""
+    from FRUIT import marker_prefix as prefix
+    yield " Test module initialized"
+    yield ""
+    yield "    . : successful assert,   F : failed assert"
+    index, total, failed = 0, 0, 0
+    for imod in range(num_modules):
+        name = 'synthetic_%05d_test' % imod
+        for icase in range(cases_per_module):
+            index += 1
+            case = 'test_case_%d' % icase
+            case_failed = int(index <= num_failures)
+            total += asserts_per_case
+            failed += case_failed
+            for rank in range(num_procs):
+                if markers:
+                    yield prefix + 'case start: %d %s %s' % (index, name,
+                                                             case)
+                yield ' Rank %d output from %s: x = %12.5e' % \
+                    (rank, case, index * 0.5)
+                yield '.' * (asserts_per_case - case_failed) + \
+                    'F' * case_failed
+                if timing:
+                    yield prefix + 'timing: case %s %s %16.8e' % \
+                        (name, case, 1.e-3 * (rank + 1))
+                if markers:
+                    yield prefix + 'case end: %d %s %s %d %d %d' % \
+                        (index, name, case, case_failed, total, failed)
+    for rank in range(num_procs):
+        yield "     Start of FRUIT summary:"
+        yield " Some tests failed!" if failed else " SUCCESSFUL!"
+        yield "   -- Failed assertion messages:"
+        for i in range(failed):
+            yield "   [test_case_%d]:Expected [4], Got [3]" % i
+        yield "   -- end of failed assertion messages."
+    yield " Successful asserts / total asserts : [ %d / %d ]" % \
+        (total - failed, total)
+    yield " Successful cases   / total cases   : [ %d / %d ]" % \
+        (index - failed, index)
+    yield "   -- end of FRUIT summary"
+
+
+def peak_memory(function):
+    """Returns peak memory (bytes) allocated while calling function, if
+    tracemalloc is available, otherwise None."""
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
@@ -2,8 +2,14 @@
 
 from __future__ import (absolute_import, division, print_function)
 
+import sys
 from setuptools import setup
 
+# The asyncio interface needs Python 3.5 or later:
+modules = ['FRUIT']
+if sys.version_info >= (3, 5):
+    modules.append('FRUIT_async')
+
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
@@ -23,5 +29,5 @@ setup(name='FRUITPy',
           "Operating System :: OS Independent",
       ],
       python_requires='>=2.7',
-      py_modules=['FRUIT']
+      py_modules=modules
       )
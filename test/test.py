@@ -2,9 +2,82 @@
 
 from __future__ import (absolute_import, division, print_function)
 
+import os
+import sys
 import unittest
 import FRUIT
 
+try:
+    from shutil import which
+except ImportError:  # Python 2
+    from distutils.spawn import find_executable as which
+
+# Minimal FRUIT module, for testing builds without the FRUIT library:
+fruit_source = """module fruit
+  implicit none
+  integer :: asserts = 0, failed = 0, cases = 0, failed_cases = 0
+contains
+  subroutine init_fruit
+  end subroutine init_fruit
+  subroutine run_test_case(test, description)
+    interface
+       subroutine test
+       end subroutine test
+    end interface
+    character(*), intent(in) :: description
+    integer :: failed_before
+    failed_before = failed
+    call test
+    cases = cases + 1
+    if (failed > failed_before) failed_cases = failed_cases + 1
+  end subroutine run_test_case
+  subroutine assert_equals(expected, actual, tol, message)
+    real, intent(in) :: expected, actual, tol
+    character(*), intent(in) :: message
+    asserts = asserts + 1
+    if (abs(expected - actual) > tol) failed = failed + 1
+  end subroutine assert_equals
+  subroutine get_failed_count(count)
+    integer, intent(out) :: count
+    count = failed
+  end subroutine get_failed_count
+  subroutine get_total_count(count)
+    integer, intent(out) :: count
+    count = asserts
+  end subroutine get_total_count
+  subroutine fruit_summary
+    if (failed == 0) then
+       write(*, '(a)') ' SUCCESSFUL!'
+    else
+       write(*, '(a)') ' Some tests failed!'
+    end if
+    write(*, '(a, i0, a, i0, a)') ' Successful asserts / total asserts : [ ', &
+         asserts - failed, ' / ', asserts, ' ]'
+    write(*, '(a, i0, a, i0, a)') ' Successful cases   / total cases   : [ ', &
+         cases - failed_cases, ' / ', cases, ' ]'
+  end subroutine fruit_summary
+  subroutine fruit_finalize
+  end subroutine fruit_finalize
+end module fruit
+"""
+
+# Test module with a crashing test case:
+crash_test_source = """module crash_test_module
+  use fruit
+  implicit none
+contains
+  subroutine test_ok
+    call assert_equals(1., 1., 0., 'ok')
+  end subroutine test_ok
+  subroutine test_crash
+    call abort
+  end subroutine test_crash
+  subroutine test_after
+    call assert_equals(1., 2., 0., 'after')
+  end subroutine test_after
+end module crash_test_module
+"""
+
 
 class FRUITPyTestCase(unittest.TestCase):
 
@@ -103,6 +176,128 @@ class FRUITPyTestCase(unittest.TestCase):
         self.subroutine_test(mod.subroutines[1],
                              "test_2", "Test 2 with setup")
 
+        # deprecated line-by-line parsing methods:
+        import warnings
+        mod = FRUIT.test_module(files[0], lazy=True)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with open(files[0]) as f:
+                mod.parse_test_module_name(f)
+                mod.parse_subroutines(f)
+                mod.parse_subroutine(f, '  subroutine test_2\n')
+                description = mod.parse_subroutine_description(f, 'test_2')
+        self.assertEqual(4, len(caught))
+        self.assertTrue(all([issubclass(w.category, DeprecationWarning)
+                             for w in caught]))
+        self.assertEqual('adder_setup_test', mod.test_module_name)
+        self.module_test(mod, setup='local_setup', teardown='teardown_adder',
+                         global_setup=False, global_teardown=False,
+                         num_subroutines=2)
+        self.assertEqual('Test 2 with setup', description)
+
+    def test_scan_test_modules(self):
+        """Tests scanning test module text."""
+        text = "\n".join([
+            "module helper_module",
+            "  interface",
+            "    subroutine test_interface(x)",
+            "    end subroutine test_interface",
+            "  end interface",
+            "end module helper_module",
+            "",
+            "MODULE scan_test",
+            "  use helper_module",
+            "  use, intrinsic :: iso_fortran_env",
+            "  use :: fruit",
+            "contains",
+            "  subroutine local_setup",
+            "  end subroutine local_setup",
+            "  recursive subroutine test_a(x, &",
+            "       y)  ! not the description",
+            "",
+            "    ! Description of a",
+            "    call check('subroutine test_string')",
+            "  contains",
+            "    subroutine test_internal",
+            "    end subroutine test_internal",
+            "  end subroutine test_a",
+            "  real(kind=8) function f(x)",
+            "  contains",
+            "    subroutine test_in_function()",
+            "    end subroutine test_in_function",
+            "  end function f",
+            "  SUBROUTINE TEST_B()",
+            "    call test_a(1, 2)",
+            "  END",
+            "end module scan_test"])
+        modules = FRUIT.scan_test_modules(text)
+        self.assertEqual(['helper_module', 'scan_test'],
+                         [data['test_module_name'] for data in modules])
+        self.assertEqual([], modules[0]['subroutines'])
+        data = modules[1]
+        self.assertEqual('local_setup', data['setup'])
+        self.assertEqual([['test_a', 'Description of a', 'test'],
+                          ['TEST_B', 'TEST_B', 'test']],
+                         data['subroutines'])
+        self.assertEqual(['helper_module', 'fruit'], data['uses'])
+
+        # statements in string literals, and Windows line endings:
+        text = "\r\n".join([
+            "module string_test",
+            "contains",
+            "  subroutine test_one",
+            "    ! Test one, with \"quotes\"",
+            "    character(len=80) :: msg = \" function f(x) is odd\"",
+            "    character(len=80) :: msg2 = 'it''s &",
+            "         & function g(y) too'",
+            "  end subroutine test_one",
+            "  subroutine test_two",
+            "  end subroutine test_two",
+            "end module string_test", ""])
+        modules = FRUIT.scan_test_modules(text)
+        self.assertEqual(['string_test'],
+                         [data['test_module_name'] for data in modules])
+        self.assertEqual([['test_one', 'Test one, with "quotes"', 'test'],
+                          ['test_two', 'test_two', 'test']],
+                         modules[0]['subroutines'])
+
+        # upper case statements, and a comment changing length when
+        # lower-cased:
+        text = "\n".join([
+            "MODULE Upper_Test",
+            u"  ! \u0130",
+            "CONTAINS",
+            "  SUBROUTINE Test_One(x)",
+            "    ! Test One",
+            "  END SUBROUTINE Test_One",
+            "END MODULE Upper_Test", ""])
+        modules = FRUIT.scan_test_modules(text)
+        self.assertEqual(['Upper_Test'],
+                         [data['test_module_name'] for data in modules])
+        self.assertEqual([['Test_One', 'Test One', 'test']],
+                         modules[0]['subroutines'])
+
+    def fruit_output(self, asserts=(14, 16), cases=(2, 4),
+                     messages=["[TEST_ABC]:Expected [4], Got [3]",
+                               "[TEST_DEF]:Expected [3], Got [4]"]):
+        """Returns example FRUIT output."""
+        output  = " Test module initialized\n\n"
+        output += "    . : successful assert,   F : failed assert\n\n"
+        output += ".......F.......F\n\n"
+        output += "     Start of FRUIT summary:\n\n"
+        if messages:
+            output += " Some tests failed!\n\n"
+            output += "   -- Failed assertion messages:\n"
+            for msg in messages:
+                output += "   " + msg + "\n"
+            output += "   -- end of failed assertion messages.\n\n"
+        else:
+            output += " SUCCESSFUL!\n\n"
+        output += " Successful asserts / total asserts : [ %12d / %11d  ]\n" % asserts
+        output += " Successful cases   / total cases   : [ %12d / %11d  ]\n" % cases
+        output += "   -- end of FRUIT summary"
+        return output
+
     def test_parse_output(self):
         """Tests parsing of FRUIT output."""
 
@@ -133,6 +328,1172 @@ class FRUITPyTestCase(unittest.TestCase):
         self.assertEqual("[TEST_ABC]:Expected [4], Got [3]", suite.messages[0])
         self.assertEqual("[TEST_DEF]:Expected [3], Got [4]", suite.messages[1])
 
+    def test_parse_cache(self):
+        """Tests caching of parsed test module data."""
+
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            test_filename = os.path.join(tmpdir, 'adder_test.F90')
+            shutil.copy('adder_test.F90', test_filename)
+            cache_filename = os.path.join(tmpdir, 'cache.json')
+
+            suite = FRUIT.test_suite([test_filename], cache_filename)
+            self.assertEqual(0, suite.cache.hits)
+            self.assertEqual(1, suite.cache.misses)
+
+            mtime = os.path.getmtime(cache_filename)
+            suite = FRUIT.test_suite([test_filename], cache_filename)
+            self.assertEqual(1, suite.cache.hits)
+            self.assertFalse(suite.cache.modified)
+            self.assertEqual(mtime, os.path.getmtime(cache_filename))
+            mod = suite.test_modules[0]
+            self.module_test(mod, setup=None, teardown=None,
+                             global_setup=False, global_teardown=False,
+                             num_subroutines=5)
+            self.subroutine_test(mod.subroutines[1],
+                                 "test_add2", "Adder test with comment")
+
+            with open(test_filename, 'a') as f:
+                f.write('\n')
+            suite = FRUIT.test_suite([test_filename], cache_filename)
+            self.assertEqual(1, suite.cache.misses)
+
+            shutil.copy('setup.F90', tmpdir)
+            files = [test_filename, os.path.join(tmpdir, 'setup.F90')]
+            cache = FRUIT.parse_cache(cache_filename, max_entries=1)
+            suite = FRUIT.test_suite(files, cache, processes=2)
+            self.assertEqual(2, suite.num_test_modules)
+            self.assertTrue(suite.global_setup)
+            self.assertEqual(1, len(FRUIT.parse_cache(cache_filename).entries))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_lazy_suite(self):
+        """Tests lazy parsing of test modules."""
+
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            files = []
+            for filename in ['adder_test.F90', 'setup.F90']:
+                shutil.copy(filename, tmpdir)
+                files.append(os.path.join(tmpdir, filename))
+            cache_filename = os.path.join(tmpdir, 'cache.json')
+
+            suite = FRUIT.test_suite(files, cache_filename, lazy=True)
+            self.assertEqual(2, len(suite.test_modules))
+            self.assertFalse(any([mod.loaded for mod in suite.test_modules]))
+            mod = suite.test_modules[0]
+            self.assertEqual('adder_test_module', mod.test_module_name)
+            self.assertEqual([True, False],
+                             [mod.loaded for mod in suite.test_modules])
+            self.assertEqual(1, suite.cache.misses)
+            self.assertRaises(AttributeError, getattr, mod, 'missing')
+
+            driver = os.path.join(tmpdir, 'test_driver.F90')
+            suite.write(driver)
+            self.assertTrue(suite.global_setup)
+            self.assertEqual(2, len(FRUIT.parse_cache(cache_filename).entries))
+
+            suite = FRUIT.test_suite(files, cache_filename, lazy=True)
+            self.assertTrue(suite.global_setup)
+            self.assertIn('adder_module', suite.test_modules[0].uses)
+            self.assertFalse(any([mod.loaded for mod in suite.test_modules]))
+            self.assertEqual(2, suite.cache.hits)
+            self.assertEqual(5, sum([len(mod.subroutines)
+                                     for mod in suite.test_modules]))
+            self.assertEqual(4, suite.cache.hits)
+            self.assertEqual(0, suite.cache.misses)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_output_parser(self):
+        """Tests single-pass output parser, on MPI-style output with
+        multiple failed assertion message blocks."""
+
+        output = self.fruit_output(messages=["[rank 0] [TEST_ABC]:failed"])
+        output += "\n" + self.fruit_output(messages=["[rank 1] [TEST_DEF]:failed"])
+        parser = FRUIT.output_parser()
+        for line in output.splitlines():
+            parser.feed(line)
+        self.assertFalse(parser.success)
+        self.assertEqual(["[rank 0] [TEST_ABC]:failed",
+                          "[rank 1] [TEST_DEF]:failed"], parser.messages)
+        self.assertEqual((14, 16), (parser.asserts.success,
+                                    parser.asserts.total))
+        self.assertEqual((2, 4), (parser.cases.success, parser.cases.total))
+
+        parser = FRUIT.output_parser().parse(iter(self.fruit_output(
+            (7, 7), (2, 2), []).splitlines()))
+        self.assertTrue(parser.success)
+        self.assertEqual([], parser.failure_messages)
+        self.assertEqual((7, 7), (parser.asserts.success, parser.asserts.total))
+
+        # test output resembling summary lines is ignored:
+        parser = FRUIT.output_parser().parse(
+            [" Checking total cases: 3/4 done",
+             " total asserts so far / expected"] +
+            self.fruit_output((7, 7), (2, 2), []).splitlines())
+        self.assertEqual((2, 2), (parser.cases.success, parser.cases.total))
+
+        # deprecated multi-pass methods:
+        import warnings
+        suite = FRUIT.test_suite([])
+        suite.output_lines = self.fruit_output().splitlines()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            suite.get_success()
+            suite.get_messages()
+            suite.get_statistics()
+        self.assertEqual(3, len(caught))
+        self.assertFalse(suite.success)
+        self.assertEqual(2, len(suite.messages))
+        self.assertEqual((14, 16), (suite.asserts.success,
+                                    suite.asserts.total))
+        self.assertEqual((2, 4), (suite.cases.success, suite.cases.total))
+
+    def test_shards(self):
+        """Tests partitioning of suite into shards."""
+
+        files = ['setup.F90', 'adder_test.F90', 'adder_setup_test.F90']
+        suite = FRUIT.test_suite(files)
+
+        shards = suite.shards(2)
+        self.assertEqual(2, len(shards))
+        self.assertEqual(['setup.F90', 'adder_test.F90'],
+                         shards[0].test_filenames)
+        self.assertEqual(['setup.F90', 'adder_setup_test.F90'],
+                         shards[1].test_filenames)
+        for shard in shards:
+            self.assertTrue(shard.global_setup)
+            self.assertTrue(shard.global_teardown)
+
+        shards = suite.shards(3, split_modules=True)
+        self.assertEqual([3, 2, 2],
+                         [sum([len(mod.subroutines)
+                               for mod in shard.test_modules])
+                          for shard in shards])
+        self.assertEqual(5, len(suite.test_modules[1].subroutines))
+
+        self.assertEqual(1, len(suite.shards(4)[0].shards(4)))
+
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            build_command = [sys.executable, '-c',
+                             "open(%r + '/{exe}', 'w')" % tmpdir]
+            self.assertRaises(OSError, suite.build_run,
+                              os.path.join(tmpdir, 'driver.F90'),
+                              build_command, [os.path.join(tmpdir, 'none')],
+                              output_dir=tmpdir, shards=2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_merge_results(self):
+        """Tests merging of results from multiple suites."""
+
+        suites = [FRUIT.test_suite([]), FRUIT.test_suite([])]
+        suites[0].parse_output(self.fruit_output())
+        suites[1].parse_output(self.fruit_output((5, 5), (3, 3), []))
+        for s in suites:
+            s.built = True
+        suite = FRUIT.test_suite([])
+        suite.merge_results(suites)
+        self.assertFalse(suite.success)
+        self.assertEqual(2, len(suite.messages))
+        self.assertEqual((19, 21), (suite.asserts.success, suite.asserts.total))
+        self.assertEqual((5, 7), (suite.cases.success, suite.cases.total))
+        suite.merge_results(suites[1:])
+        self.assertTrue(suite.success)
+
+    def test_parse_stream(self):
+        """Tests incremental parsing of streamed FRUIT output."""
+
+        import io
+        output = self.fruit_output()
+        lines = []
+        tee = io.BytesIO()
+        suite = FRUIT.test_suite([])
+        suite.parse_stream(io.BytesIO(output.encode()), tee=tee,
+                           callback=lines.append, max_output_lines=3)
+        self.assertEqual(output.splitlines(), lines)
+        self.assertEqual(output.encode(), tee.getvalue())
+        self.assertEqual(output.splitlines()[-3:], suite.output_lines)
+        self.assertFalse(suite.success)
+        self.assertEqual(2, len(suite.messages))
+        self.assertEqual((14, 16), (suite.asserts.success, suite.asserts.total))
+        self.assertEqual((2, 4), (suite.cases.success, suite.cases.total))
+
+        suite.parse_stream(io.BytesIO(self.fruit_output(
+            (5, 5), (3, 3), []).encode()))
+        self.assertTrue(suite.success)
+        self.assertEqual([], suite.messages)
+        self.assertEqual((3, 3), (suite.cases.success, suite.cases.total))
+
+        script = "print(%r)" % self.fruit_output((5, 5), (3, 3), [])
+        self.assertTrue(suite.run([sys.executable, '-c', script],
+                                  stream=True))
+        self.assertEqual((5, 5), (suite.asserts.success, suite.asserts.total))
+
+    def test_incremental_build(self):
+        """Tests skipping of builds with unchanged fingerprint."""
+
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            dep = os.path.join(tmpdir, 'adder.F90')
+            shutil.copy('adder.F90', dep)
+            log = os.path.join(tmpdir, 'build.log')
+            script = "open(%r + '/{exe}', 'w'); open(%r, 'a').write('x')" % \
+                (tmpdir, log)
+            build_command = [sys.executable, '-c', script]
+            driver = os.path.join(tmpdir, 'driver.F90')
+
+            def build():
+                suite = FRUIT.test_suite(['adder_test.F90'])
+                update = suite.write(driver)
+                built = suite.build(build_command, tmpdir, update,
+                                    incremental=True, dependencies=[dep])
+                self.assertTrue(built)
+                with open(log) as f:
+                    return f.read().count('x'), suite.rebuild_reasons
+
+            self.assertEqual((1, ['no previous build fingerprint',
+                                  'executable missing']), build())
+            self.assertEqual((1, []), build())
+            with open(dep, 'a') as f:
+                f.write('! changed\n')
+            self.assertEqual((2, ['changed: ' + dep]), build())
+            self.assertEqual((2, []), build())
+            os.remove(os.path.join(tmpdir, 'driver'))
+            self.assertEqual((3, ['executable missing']), build())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_variants(self):
+        """Tests keeping drivers for configuration variants."""
+
+        import shutil
+        import tempfile
+        self.assertEqual('serial', FRUIT.variant_name())
+        self.assertEqual('mpi_my_comm_selection',
+                         FRUIT.variant_name(True, 'MY_COMM', selection=True))
+        self.assertEqual('serial_split', FRUIT.variant_name(split=True))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            log = os.path.join(tmpdir, 'build.log')
+            script = "open(%r + '/{exe}', 'w'); open(%r, 'a').write('x')" % \
+                (tmpdir, log)
+            build_command = [sys.executable, '-c', script]
+            run_command = [sys.executable, '-c', "print(%r)" %
+                           self.fruit_output((5, 5), (3, 3), [])]
+            driver = os.path.join(tmpdir, 'driver.F90')
+
+            def build_run(timing, incremental=True):
+                suite = FRUIT.test_suite(['adder_test.F90'])
+                self.assertTrue(suite.build_run(driver, build_command,
+                                                run_command, output_dir=tmpdir,
+                                                timing=timing, variants=True,
+                                                incremental=incremental))
+                with open(log) as f:
+                    return f.read().count('x')
+
+            self.assertEqual(1, build_run(False))
+            self.assertEqual(2, build_run(True))
+            self.assertEqual(2, build_run(False))
+            self.assertEqual(2, build_run(True))
+            self.assertEqual(3, build_run(True, incremental=False))
+            manifest = FRUIT.variant_manifest(os.path.join(tmpdir,
+                                                           'driver.variants'))
+            self.assertEqual(['serial', 'serial_timing'],
+                             sorted(manifest.variants))
+            entry = manifest.get('serial_timing')
+            self.assertEqual(os.path.join(tmpdir, 'driver_serial_timing.F90'),
+                             entry['driver'])
+            self.assertEqual([os.path.join(tmpdir, 'driver_serial_timing')],
+                             entry['exes'])
+            self.assertTrue(entry['options']['timing'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(which('gfortran'), "requires gfortran")
+    def test_fortran_build(self):
+        """Tests native build engine."""
+
+        import shutil
+        import tempfile
+        from subprocess import call
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fruit = os.path.join(tmpdir, 'fruit.f90')
+            with open(fruit, 'w') as f:
+                f.write(fruit_source)
+            src = os.path.join(tmpdir, 'src')
+            os.mkdir(src)
+            adder = os.path.join(src, 'adder.F90')
+            shutil.copy('adder.F90', adder)
+            test_filename = os.path.join(tmpdir, 'adder_test.F90')
+            shutil.copy('adder_test.F90', test_filename)
+            driver = os.path.join(tmpdir, 'driver.F90')
+            engine = FRUIT.fortran_build(
+                'gfortran', sources=[fruit], source_dirs=[src],
+                cache_dir=os.path.join(tmpdir, 'cache'), processes=2)
+
+            def build():
+                suite = FRUIT.test_suite([test_filename])
+                suite.write(driver)
+                built = suite.build(engine, tmpdir)
+                if built:
+                    self.assertEqual(0, call([os.path.join(tmpdir,
+                                                           suite.exe)]))
+                return built, sorted([os.path.basename(filename) for
+                                      filename in engine.compiled])
+
+            self.assertEqual((True, ['adder.F90', 'adder_test.F90',
+                                     'driver.F90', 'fruit.f90']), build())
+            self.assertEqual((True, []), build())
+            self.assertEqual(4, len(engine.reused))
+            with open(adder, 'a') as f:
+                f.write('! changed\n')
+            self.assertEqual((True, ['adder.F90', 'adder_test.F90',
+                                     'driver.F90']), build())
+            with open(adder, 'a') as f:
+                f.write('syntax error\n')
+            self.assertEqual((False, []), build())
+            self.assertEqual(adder, engine.failed)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_split_driver(self):
+        """Tests driver split into separate compilation units."""
+
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            driver = os.path.join(tmpdir, 'driver.F90')
+            units = os.path.join(tmpdir, 'driver_units')
+            runner = os.path.join(units, 'run_adder_setup_test.F90')
+            test_filenames = ['setup.F90', 'adder_test.F90',
+                              'adder_setup_test.F90']
+            suite = FRUIT.test_suite(test_filenames)
+            self.assertTrue(suite.write(driver, markers=True, split=True))
+            self.assertEqual([os.path.join(units, filename) for filename in
+                              ['support.F90', 'run_adder_test_module.F90',
+                               'run_adder_setup_test.F90']],
+                             suite.unit_files)
+            with open(os.path.join(tmpdir, 'driver.units')) as f:
+                self.assertEqual(suite.unit_files, f.read().split())
+            with open(runner) as f:
+                source = f.read()
+            self.assertIn('subroutine fruitpy_run_adder_setup_test'
+                          '(fruitpy_offset)', source)
+            self.assertIn('use fruitpy_support_driver\n', source)
+            self.assertIn('call fruitpy_case_start(fruitpy_offset + 2, '
+                          "'adder_setup_test'", source)
+            with open(driver) as f:
+                source = f.read()
+            self.assertIn('use setup_module', source)
+            self.assertNotIn('use adder_test_module', source)
+            self.assertIn('call fruitpy_run_adder_setup_test(5)', source)
+            self.assertFalse(suite.write(driver, markers=True, split=True))
+
+            mtime = os.path.getmtime(runner)
+            suite = FRUIT.test_suite(test_filenames[::-1])
+            self.assertTrue(suite.write(driver, markers=True, split=True))
+            self.assertEqual(mtime, os.path.getmtime(runner))
+            with open(driver) as f:
+                self.assertIn('call fruitpy_run_adder_test_module(2)',
+                              f.read())
+
+            suite = FRUIT.test_suite(test_filenames[:2])
+            self.assertTrue(suite.write(driver, markers=True, split=True))
+            self.assertFalse(os.path.isfile(runner))
+            self.assertEqual(['support.F90', 'run_adder_test_module.F90'],
+                             [os.path.basename(filename)
+                              for filename in suite.unit_files])
+            self.assertTrue(suite.write(driver))
+            self.assertEqual([], suite.unit_files)
+
+            # units must not overwrite test module files:
+            test_filename = os.path.join(units, 'run_adder_test_module.F90')
+            suite = FRUIT.test_suite(['adder_test.F90'])
+            suite.test_filenames = [test_filename]
+            self.assertRaises(ValueError, suite.write, driver, split=True)
+            self.assertEqual('fruitpy_support_driver_0',
+                             FRUIT.support_module_name('tmp/Driver-0.F90'))
+
+            name = FRUIT.runner_name('m' * 60)
+            self.assertEqual(63, len(name))
+            self.assertNotEqual(name, FRUIT.runner_name('m' * 61))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(which('gfortran'), "requires gfortran")
+    def test_split_driver_build(self):
+        """Tests building split driver with native build engine."""
+
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fruit = os.path.join(tmpdir, 'fruit.f90')
+            with open(fruit, 'w') as f:
+                f.write(fruit_source)
+            engine = FRUIT.fortran_build(
+                'gfortran', sources=[fruit, 'adder.F90'],
+                cache_dir=os.path.join(tmpdir, 'cache'), processes=2)
+            driver = os.path.join(tmpdir, 'driver.F90')
+
+            def build_run(test_filenames):
+                suite = FRUIT.test_suite(test_filenames)
+                success = suite.build_run(driver, engine, output_dir=tmpdir,
+                                          selection=True, split=True)
+                return success, suite.cases.total, \
+                    sorted([os.path.basename(filename)
+                            for filename in engine.compiled])
+
+            self.assertEqual((True, 5, ['adder.F90', 'adder_test.F90',
+                                        'driver.F90', 'fruit.f90',
+                                        'run_adder_test_module.F90',
+                                        'setup.F90', 'support.F90']),
+                             build_run(['setup.F90', 'adder_test.F90']))
+            self.assertEqual((True, 7, ['adder_setup_test.F90', 'driver.F90',
+                                        'run_adder_setup_test.F90']),
+                             build_run(['setup.F90', 'adder_test.F90',
+                                        'adder_setup_test.F90']))
+            self.assertEqual((True, 5, []),
+                             build_run(['setup.F90', 'adder_test.F90']))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(which('gfortran') and os.name == 'posix',
+                         "requires gfortran and POSIX")
+    def test_run_library(self):
+        """Tests running test cases from a shared library."""
+
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fruit = os.path.join(tmpdir, 'fruit.f90')
+            crash_test = os.path.join(tmpdir, 'crash_test.F90')
+            for filename, source in [(fruit, fruit_source),
+                                     (crash_test, crash_test_source)]:
+                with open(filename, 'w') as f:
+                    f.write(source)
+            engine = FRUIT.fortran_build(
+                'gfortran', sources=[fruit, 'adder.F90'],
+                cache_dir=os.path.join(tmpdir, 'cache'))
+            suite = FRUIT.test_suite(['adder_test.F90', crash_test])
+            library_source = os.path.join(tmpdir, 'tests_library.F90')
+            self.assertFalse(suite.build_run_library(library_source, engine,
+                                                     tmpdir))
+            self.assertTrue(suite.built)
+            self.assertEqual([('crash_test_module', 'test_crash',
+                               'signal 6')], suite.crashes)
+            self.assertEqual((16, 16), (suite.asserts.success,
+                                        suite.asserts.total))
+            self.assertEqual((6, 7), (suite.cases.success, suite.cases.total))
+            self.assertEqual([('crash_test_module', 'test_crash')],
+                             suite.failed_cases)
+
+            self.assertTrue(suite.run_library(isolate=False,
+                                              exclude='crash_test_module'))
+            self.assertEqual([], suite.crashes)
+            self.assertEqual((5, 5), (suite.cases.success, suite.cases.total))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_timing(self):
+        """Tests timing instrumentation and parsing of timings."""
+
+        import json
+        import tempfile
+        suite = FRUIT.test_suite(['adder_setup_test.F90'])
+        lines = suite.driver_lines(timing=True)
+        self.assertEqual(4, len([line for line in lines
+                                 if 'call fruitpy_timing' in line]))
+        self.assertFalse(any(['fruitpy' in line
+                              for line in suite.driver_lines()]))
+
+        output = "...FRUITPy timing: case adder_setup_test test_1 0.15\n"
+        output += "FRUITPy timing: setup adder_setup_test local_setup 2.\n"
+        output += "..FRUITPy timing: case adder_setup_test test_2 0.3\n"
+        output += "..FRUITPy timing: case adder_setup_test test_2 0.2\n"
+        suite.parse_output(output + self.fruit_output())
+        self.assertEqual([('adder_setup_test', 'test_2', 0.3),
+                          ('adder_setup_test', 'test_1', 0.15)],
+                         suite.slowest())
+        self.assertEqual([('adder_setup_test', 'test_2', 0.3)],
+                         suite.slowest(1))
+        self.assertEqual(2, len(suite.durations))
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            suite.write_timings(filename)
+            with open(filename) as f:
+                timings = json.load(f)
+        finally:
+            os.remove(filename)
+        self.assertEqual(3, len(timings))
+        self.assertEqual({'kind': 'setup', 'module': 'adder_setup_test',
+                          'name': 'local_setup', 'seconds': 2.0}, timings[1])
+
+    def test_select(self):
+        """Tests runtime test selection."""
+
+        files = ['setup.F90', 'adder_test.F90', 'adder_setup_test.F90']
+        suite = FRUIT.test_suite(files)
+        self.assertEqual(['adder_test_module', 'adder_setup_test'],
+                         suite.select())
+        self.assertEqual(['adder_test_module:test_add1',
+                          'adder_test_module:test_add3_setup',
+                          'adder_test_module:test_teardown_test',
+                          'adder_test_module:test_oldschool',
+                          'adder_setup_test'],
+                         suite.select('*', 'test_add2'))
+        self.assertEqual(['adder_test_module:test_oldschool',
+                          'adder_setup_test:test_1'],
+                         suite.select(['OldSchool', 'adder_setup*:*_1']))
+        self.assertEqual([], suite.select('nothing'))
+
+        lines = suite.driver_lines(selection=True)
+        self.assertIn('  call fruitpy_read_selection', lines)
+        self.assertIn("  if (fruitpy_module_selected('adder_setup_test'))"
+                      " then", lines)
+        self.assertIn("         'test_oldschool')) then", lines)
+
+    def test_impacted(self):
+        """Tests selection of test modules affected by changed files."""
+
+        files = ['setup.F90', 'adder_test.F90', 'adder_setup_test.F90']
+        suite = FRUIT.test_suite(files)
+        self.assertEqual(['adder_module', 'fruit'],
+                         suite.test_modules[1].uses)
+        self.assertEqual(['adder_module', 'adder_test_module'],
+                         suite.test_modules[2].uses)
+
+        graph = FRUIT.module_graph(source_files=files + ['adder.F90'])
+        self.assertEqual(['adder_module'],
+                         graph.defines[os.path.abspath('adder.F90')])
+        self.assertEqual(set([os.path.abspath(f) for f in
+                              ['adder.F90', 'adder_test.F90']]),
+                         graph.dependencies('adder_setup_test.F90'))
+
+        impacted = suite.impacted(['adder.F90'], source_files=['adder.F90'])
+        self.assertEqual(files, impacted.test_filenames)
+        impacted = suite.impacted(['adder_test.F90'])
+        self.assertEqual(files, impacted.test_filenames)
+        impacted = suite.impacted(['adder_setup_test.F90'])
+        self.assertEqual(['setup.F90', 'adder_setup_test.F90'],
+                         impacted.test_filenames)
+        self.assertEqual([], suite.impacted(['other.F90']).test_filenames)
+
+    def test_scaling_result(self):
+        """Tests MPI scaling sweep results."""
+
+        result = FRUIT.scaling_result()
+        for num_procs, seconds in [(4, 5.), (1, 8.), (2, 4.), (4, 4.),
+                                   (1, 10.), (2, 5.)]:
+            result.add(num_procs, seconds, True)
+        result.add(4, 4.5, False)
+        self.assertEqual([1, 2, 4], result.num_procs)
+        self.assertEqual(9., result.mean_time(1))
+        self.assertEqual(2., result.speedup(2))
+        self.assertEqual(0.5, result.efficiency(4))
+        self.assertEqual([4], result.inefficient(0.6))
+        data = result.get_data()
+        self.assertEqual([1., 1., 0.5], [d['efficiency'] for d in data])
+        self.assertEqual([True, True, False], [d['success'] for d in data])
+        self.assertEqual(4, len(result.table().splitlines()))
+
+    @unittest.skipUnless(os.name == 'posix', "requires POSIX")
+    def test_scaling_sweep(self):
+        """Tests MPI scaling sweep, using a stub mpirun command."""
+
+        import json
+        import shutil
+        import subprocess
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        path = os.environ['PATH']
+        try:
+            # stub mpirun: runs faster on 2 processes than on 1, but no
+            # faster on 4, and logs the numbers of processes:
+            log = os.path.join(tmpdir, 'mpirun.log')
+            mpirun = os.path.join(tmpdir, 'mpirun')
+            with open(mpirun, 'w') as f:
+                f.write("#!%s\n" % sys.executable)
+                f.write("import sys, time\n")
+                f.write("num_procs = int(sys.argv[2])\n")
+                f.write("open(%r, 'a').write('%%d\\n' %% num_procs)\n" % log)
+                f.write("time.sleep(0.2 / min(num_procs, 2))\n")
+                f.write("print(%r)\n" % self.fruit_output((5, 5), (3, 3), []))
+            os.chmod(mpirun, 0o755)
+            os.environ['PATH'] = tmpdir + os.pathsep + path
+            driver = os.path.join(tmpdir, 'driver.F90')
+
+            suite = FRUIT.test_suite(['adder_test.F90'])
+            suite.exe, suite.built = FRUIT.executable_name(driver), True
+            result = suite.scaling_sweep([1, 2, 4], repeats=2)
+            with open(log) as f:
+                self.assertEqual(['1', '1', '2', '2', '4', '4'],
+                                 f.read().split())
+            self.assertEqual([1, 2, 4], result.num_procs)
+            self.assertEqual([2, 2, 2], [len(result.times[n])
+                                         for n in result.num_procs])
+            self.assertTrue(result.best_time(1) >= 0.2)
+            self.assertTrue(result.best_time(2) >= 0.1)
+            self.assertTrue(result.efficiency(2) > 0.7)
+            self.assertTrue(result.efficiency(4) < 0.55)
+            self.assertEqual([4], result.inefficient(0.6))
+            self.assertTrue(all(result.success.values()))
+
+            # command line, failing if efficiency is below minimum:
+            sweep_file = os.path.join(tmpdir, 'sweep.json')
+
+            def sweep(min_efficiency):
+                return subprocess.call(
+                    [sys.executable, FRUIT.__file__, 'sweep',
+                     'adder_test.F90', '--driver', driver, '-n', '1', '2',
+                     '4', '-r', '1', '--sweep-file', sweep_file,
+                     '--min-efficiency', str(min_efficiency)],
+                    stdout=subprocess.PIPE)
+
+            self.assertEqual(1, sweep(0.6))
+            with open(sweep_file) as f:
+                self.assertEqual([1, 2, 4], [d['num_procs']
+                                             for d in json.load(f)])
+            self.assertEqual(0, sweep(0.1))
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(os.name == 'posix', "requires POSIX")
+    def test_stop_run(self):
+        """Tests stopping runs with hung or failing test cases."""
+
+        import time
+        script = "import subprocess, sys\n"
+        script += "print('FRUITPy case start: 1 mod test_a')\n"
+        script += "print('..FRUITPy case end: 1 mod test_a %d 2 %d')\n"
+        script += "print('FRUITPy case start: 2 mod test_b')\n"
+        script += "sys.stdout.flush()\n"
+        script += "subprocess.call(['sleep', '30'])\n"
+        suite = FRUIT.test_suite([])
+
+        start = time.time()
+        self.assertFalse(suite.run([sys.executable, '-c', script % (0, 0)],
+                                   case_timeout=0.5))
+        self.assertEqual('case timeout', suite.stopped)
+        self.assertEqual((2, 'mod', 'test_b'), suite.in_flight)
+        self.assertEqual((2, 2), (suite.asserts.success, suite.asserts.total))
+        self.assertEqual((1, 1), (suite.cases.success, suite.cases.total))
+
+        self.assertFalse(suite.run([sys.executable, '-c', script % (0, 0)],
+                                   timeout=0.5))
+        self.assertEqual('timeout', suite.stopped)
+
+        self.assertFalse(suite.run([sys.executable, '-c', script % (1, 1)],
+                                   fail_fast=True))
+        self.assertEqual('fail fast', suite.stopped)
+        self.assertEqual([('mod', 'test_a')], suite.failed_cases)
+        self.assertEqual((0, 1), (suite.cases.success, suite.cases.total))
+        self.assertLess(time.time() - start, 10)
+
+    def test_resume(self):
+        """Tests resuming runs after the driver crashes."""
+
+        import shutil
+        import tempfile
+        script = "import os, sys\n"
+        script += "if '--start=3' in sys.argv:\n"
+        script += "    print('FRUITPy case start: 3 mod test_c')\n"
+        script += "    print('.FRUITPy case end: 3 mod test_c 0 1 0')\n"
+        script += "    print(' SUCCESSFUL!')\n"
+        script += "    print(' Successful asserts / total asserts : [ 1 / 1 ]')\n"
+        script += "    print(' Successful cases   / total cases   : [ 1 / 1 ]')\n"
+        script += "    sys.exit(0)\n"
+        script += "print('FRUITPy case start: 1 mod test_a')\n"
+        script += "print('..FRUITPy case end: 1 mod test_a 0 2 0')\n"
+        script += "print('FRUITPy case start: 2 mod test_b')\n"
+        script += "sys.stdout.flush()\n"
+        script += "os._exit(3)\n"
+        suite = FRUIT.test_suite([])
+        run_command = [sys.executable, '-c', script]
+
+        self.assertFalse(suite.run(run_command))
+        self.assertEqual([('mod', 'test_b', 'exit status 3')], suite.crashes)
+        self.assertEqual((1, 2), (suite.cases.success, suite.cases.total))
+
+        self.assertFalse(suite.run(run_command, resume=1))
+        self.assertEqual([('mod', 'test_b', 'exit status 3')], suite.crashes)
+        self.assertEqual((3, 3), (suite.asserts.success, suite.asserts.total))
+        self.assertEqual((2, 3), (suite.cases.success, suite.cases.total))
+        self.assertEqual([('mod', 'test_b')], suite.failed_cases)
+        self.assertEqual(['[test_b]:crashed (exit status 3)'], suite.messages)
+
+        if which('gfortran'):
+            tmpdir = tempfile.mkdtemp()
+            try:
+                fruit = os.path.join(tmpdir, 'fruit.f90')
+                crash_test = os.path.join(tmpdir, 'crash_test.F90')
+                for filename, source in [(fruit, fruit_source),
+                                         (crash_test, crash_test_source)]:
+                    with open(filename, 'w') as f:
+                        f.write(source)
+                engine = FRUIT.fortran_build(
+                    'gfortran', sources=[fruit, 'adder.F90'],
+                    cache_dir=os.path.join(tmpdir, 'cache'))
+                suite = FRUIT.test_suite(['adder_test.F90', crash_test])
+                driver = os.path.join(tmpdir, 'driver.F90')
+                self.assertFalse(suite.build_run(driver, engine,
+                                                 output_dir=tmpdir, resume=2))
+                self.assertTrue(suite.built)
+                self.assertEqual([('crash_test_module', 'test_crash',
+                                   'signal 6')], suite.crashes)
+                self.assertEqual((16, 17), (suite.asserts.success,
+                                            suite.asserts.total))
+                self.assertEqual((6, 8), (suite.cases.success,
+                                          suite.cases.total))
+            finally:
+                shutil.rmtree(tmpdir)
+
+    def test_distributed(self):
+        """Tests running test modules on workers via a coordinator."""
+
+        import shutil
+        import socket
+        import tempfile
+        import threading
+        script = "import os, sys\n"
+        script += "counts = {'adder_test_module': 5, 'adder_setup_test': 2}\n"
+        script += "if sys.argv[1] == 'crash_test_module':\n"
+        script += "    print('FRUITPy case start: 1 crash_test_module " \
+                  "test_ok')\n"
+        script += "    print('.FRUITPy case end: 1 crash_test_module " \
+                  "test_ok 0 1 0')\n"
+        script += "    print('FRUITPy case start: 2 crash_test_module " \
+                  "test_crash')\n"
+        script += "    sys.stdout.flush()\n"
+        script += "    os._exit(3)\n"
+        script += "n = counts[sys.argv[1]]\n"
+        script += "print(' SUCCESSFUL!')\n"
+        script += "print(' Successful asserts / total asserts : " \
+                  "[ %d / %d ]' % (n, n))\n"
+        script += "print(' Successful cases   / total cases   : " \
+                  "[ %d / %d ]' % (n, n))\n"
+        run_command = [sys.executable, '-c', script]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            crash_test = os.path.join(tmpdir, 'crash_test.F90')
+            with open(crash_test, 'w') as f:
+                f.write(crash_test_source)
+            suite = FRUIT.test_suite(['setup.F90', 'adder_test.F90',
+                                      'adder_setup_test.F90', crash_test])
+            coordinator = FRUIT.test_coordinator(suite)
+            lost = []
+
+            def workers():
+                # first worker dies after being handed a task:
+                sock = socket.create_connection(coordinator.address)
+                FRUIT.send_message(sock, {'type': 'ready', 'name': 'lost'})
+                reader = sock.makefile('rb')
+                lost.append(FRUIT.receive_message(reader)['modules'])
+                reader.close()
+                sock.close()
+                for i in range(2):
+                    worker = FRUIT.test_worker(coordinator.address, None,
+                                               run_command, name=str(i))
+                    threading.Thread(target=worker.serve).start()
+
+            threading.Thread(target=workers).start()
+            self.assertFalse(coordinator.run(timeout=30))
+            self.assertIsNone(suite.stopped)
+            self.assertEqual([['adder_test_module']], lost)
+            self.assertEqual([1, 0, 0], coordinator.attempts)
+            self.assertEqual(['0', '1', 'lost'], sorted(coordinator.workers))
+            self.assertEqual(0, coordinator.workers['lost'])
+            self.assertEqual(3, sum(coordinator.workers.values()))
+            self.assertEqual([('crash_test_module', 'test_crash',
+                               'exit status 3')], suite.crashes)
+            self.assertEqual((8, 8), (suite.asserts.success,
+                                      suite.asserts.total))
+            self.assertEqual((8, 9), (suite.cases.success, suite.cases.total))
+            self.assertEqual([('crash_test_module', 'test_crash')],
+                             suite.failed_cases)
+
+            coordinator = FRUIT.test_coordinator(suite)
+            self.assertFalse(coordinator.run(timeout=0.2))
+            self.assertEqual('timeout', suite.stopped)
+            self.assertEqual(3, len(suite.crashes))
+            self.assertEqual((0, 10), (suite.cases.success,
+                                       suite.cases.total))
+
+            # driver without runtime selection runs all test modules:
+            script = "print('FRUITPy case start: 1 adder_setup_test " \
+                     "test_a')\n"
+            script += "print('.FRUITPy case end: 1 adder_setup_test " \
+                      "test_a 0 1 0')\n"
+            script += "print(' SUCCESSFUL!')\n"
+            suite = FRUIT.test_suite(['adder_test.F90'])
+            coordinator = FRUIT.test_coordinator(suite)
+            worker = FRUIT.test_worker(coordinator.address, None,
+                                       [sys.executable, '-c', script])
+            threading.Thread(target=worker.serve).start()
+            self.assertFalse(coordinator.run(timeout=30))
+            self.assertEqual([('adder_test_module', None,
+                               'cases from other test modules')],
+                             suite.crashes)
+            self.assertEqual((0, 5), (suite.cases.success,
+                                      suite.cases.total))
+
+            if hasattr(self, 'assertLogs'):
+                suite = FRUIT.test_suite(['adder_test.F90'])
+                coordinator = FRUIT.test_coordinator(suite, retries=0)
+
+                def bad_worker():
+                    sock = socket.create_connection(coordinator.address)
+                    FRUIT.send_message(sock, {'type': 'ready',
+                                              'name': 'bad'})
+                    reader = sock.makefile('rb')
+                    FRUIT.receive_message(reader)
+                    FRUIT.send_message(sock, {'type': 'result'})
+                    FRUIT.receive_message(reader)
+                    reader.close()
+                    sock.close()
+
+                threading.Thread(target=bad_worker).start()
+                with self.assertLogs('FRUIT', 'WARNING') as logs:
+                    self.assertFalse(coordinator.run(timeout=30))
+                self.assertIn('Protocol error from worker bad: KeyError',
+                              logs.output[0])
+                self.assertEqual('worker lost', suite.crashes[0][2])
+
+            if hasattr(socket, 'AF_UNIX'):
+                address = os.path.join(tmpdir, 'coordinator.sock')
+                suite = FRUIT.test_suite(['adder_test.F90'])
+                coordinator = FRUIT.test_coordinator(suite, address)
+                worker = FRUIT.test_worker(address, None, run_command)
+                threading.Thread(target=worker.serve).start()
+                self.assertTrue(coordinator.run(timeout=30))
+                self.assertEqual((5, 5), (suite.cases.success,
+                                          suite.cases.total))
+                self.assertFalse(os.path.exists(address))
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(('host', 1234), FRUIT.socket_address('host:1234'))
+        self.assertEqual(('localhost', 1234), FRUIT.socket_address(':1234'))
+        self.assertEqual('/tmp/fruit.sock',
+                         FRUIT.socket_address('/tmp/fruit.sock'))
+
+    @unittest.skipUnless(os.path.isdir('/proc'), "requires /proc")
+    def test_profile(self):
+        """Tests sampling peak memory and CPU time of test cases."""
+
+        import json
+        import tempfile
+        script = "import sys, time\n"
+        script += "print('FRUITPy case start: 1 mod test_big')\n"
+        script += "sys.stdout.flush()\n"
+        script += "x = bytearray(200 * 1024 * 1024)\n"
+        script += "time.sleep(0.5)\n"
+        script += "del x\n"
+        script += "print('.FRUITPy case end: 1 mod test_big 0 1 0')\n"
+        script += "print('FRUITPy case start: 2 mod test_busy')\n"
+        script += "sys.stdout.flush()\n"
+        script += "start = time.time()\n"
+        script += "while time.time() - start < 0.5: pass\n"
+        script += "print('.FRUITPy case end: 2 mod test_busy 0 2 0')\n"
+        script += "print(' SUCCESSFUL!')\n"
+        suite = FRUIT.test_suite([])
+        self.assertTrue(suite.run([sys.executable, '-c', script],
+                                  profile=0.05))
+        self.assertEqual([('mod', 'test_big'), ('mod', 'test_busy')],
+                         list(suite.resources.keys()))
+        self.assertEqual([0], list(suite.resources[('mod', 'test_big')]))
+        largest = suite.largest(1)[0]
+        self.assertEqual(('mod', 'test_big'), largest[:2])
+        self.assertGreater(largest[2], 150 * 1024)
+        self.assertGreater(suite.largest()[1][3], 0.2)
+        fd, filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            suite.write_resources(filename)
+            with open(filename) as f:
+                self.assertEqual(2, len(json.load(f)))
+        finally:
+            os.remove(filename)
+
+    def test_rerun_failed(self):
+        """Tests rerunning failed test cases."""
+
+        import shutil
+        import tempfile
+        suite = FRUIT.test_suite(['setup.F90', 'adder_test.F90'])
+        suite.messages = ['[Adder test with comment]:Expected [4], Got [3]',
+                          '[test_add1]:Expected [4], Got [3]']
+        failed = [('adder_test_module', 'test_add1'),
+                  ('adder_test_module', 'test_add2')]
+        self.assertEqual(failed, suite.failed_case_names)
+        subsuite = suite.case_subsuite(failed[1:])
+        self.assertEqual(['setup_module', 'adder_test_module'],
+                         [mod.test_module_name
+                          for mod in subsuite.test_modules])
+        self.assertEqual(['test_add2'], [sub.name for sub in
+                                         subsuite.test_modules[1].subroutines])
+        self.assertEqual(5, len(suite.test_modules[1].subroutines))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            build_command = [sys.executable, '-c',
+                             "open(%r + '/{exe}', 'w')" % tmpdir]
+            # test_add1 always fails, test_add2 fails on the first rerun:
+            count = os.path.join(tmpdir, 'count')
+            script = "import os\n"
+            script += "n = len(open(%r).read()) if os.path.isfile(%r) " \
+                      "else 0\n" % (count, count)
+            script += "open(%r, 'a').write('x')\n" % count
+            script += "marker = 'FRUITPy case end: %d adder_test_module " \
+                      "%s %d 1 1'\n"
+            script += "if 'test_add1' in open('driver_rerun.F90').read():\n"
+            script += "    print(marker % (1, 'test_add1', 1))\n"
+            script += "print(marker % (2, 'test_add2', int(n == 0)))\n"
+            driver = os.path.join(tmpdir, 'driver.F90')
+            self.assertFalse(suite.rerun_failed(
+                driver, build_command, [sys.executable, '-c', script],
+                output_dir=tmpdir, reruns=3))
+            self.assertEqual(failed[1:], suite.flaky)
+            self.assertEqual(failed[:1], suite.persistent)
+            with open(count) as f:
+                self.assertEqual(3, len(f.read()))
+            with open(os.path.join(tmpdir, 'driver_rerun.F90')) as f:
+                lines = f.read()
+            self.assertIn('fruitpy_case_start', lines)
+            self.assertNotIn('test_add2', lines)
+            self.assertFalse(suite.rerun_build_failed)
+
+            self.assertFalse(suite.rerun_failed(
+                driver, [sys.executable, '-c', 'import sys; sys.exit(1)'],
+                [sys.executable, '-c', script], output_dir=tmpdir))
+            self.assertTrue(suite.rerun_build_failed)
+            self.assertEqual(([], []), (suite.flaky, suite.persistent))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_results_history(self):
+        """Tests results history and history-based module ordering."""
+
+        import shutil
+        import tempfile
+        from collections import OrderedDict
+        files = ['setup.F90', 'adder_test.F90', 'adder_setup_test.F90']
+        suite = FRUIT.test_suite(files)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            history = FRUIT.results_history(os.path.join(tmpdir, 'h.db'))
+            for failed in [1, 0]:
+                suite.success = not failed
+                suite.timings = OrderedDict([
+                    (('case', 'adder_test_module', 'test_add1'), 2.),
+                    (('case', 'adder_setup_test', 'test_1'), 1.)])
+                suite.case_failures = OrderedDict([
+                    (('adder_test_module', 'test_add1'), 0),
+                    (('adder_setup_test', 'test_1'), failed)])
+                suite.failed_cases = [('adder_setup_test', 'test_1')] \
+                    if failed else []
+                history.record(suite)
+            self.assertEqual(2, history.num_runs)
+            self.assertEqual([False, True], [run[2] for run in
+                                             history.runs()[::-1]])
+            self.assertEqual([(False, 1.), (True, 1.)],
+                             [case[2:] for case in history.case_history(
+                                 'ADDER_SETUP_TEST', 'test_1')])
+            self.assertEqual({('adder_setup_test', 'test_1'): 0.5},
+                             history.failure_rates())
+            self.assertEqual({}, history.failure_rates(last_runs=1))
+            self.assertEqual((2, 0, 2.), history.case_statistics()[
+                ('adder_test_module', 'test_add1')])
+            names = ['setup_module', 'adder_test_module', 'adder_setup_test']
+            self.assertEqual(['adder_setup_test', 'setup_module',
+                              'adder_test_module'],
+                             history.module_order(names))
+            self.assertEqual(['setup_module', 'adder_setup_test',
+                              'adder_test_module'],
+                             history.module_order(names, last_runs=1))
+            lines = suite.driver_lines(ordering=True)
+            self.assertIn('  call fruitpy_read_order(2)', lines)
+            self.assertIn('      call run_test_case(test_add1,"test_add1")',
+                          lines)
+            order = [mod.test_module_name
+                     for mod in suite.ordered_modules(history)]
+            filename = suite.write_order(order)
+            with open(filename) as f:
+                self.assertEqual(['2', '1'], f.read().split())
+            os.remove(filename)
+            history.close()
+
+            if which('gfortran'):
+                fruit = os.path.join(tmpdir, 'fruit.f90')
+                with open(fruit, 'w') as f:
+                    f.write(fruit_source)
+                engine = FRUIT.fortran_build(
+                    'gfortran', sources=[fruit, 'adder.F90'],
+                    cache_dir=os.path.join(tmpdir, 'cache'))
+                driver = os.path.join(tmpdir, 'driver.F90')
+                filename = os.path.join(tmpdir, 'run.db')
+                suite.case_failures[('adder_setup_test', 'test_1')] = 1
+                suite.failed_cases = [('adder_setup_test', 'test_1')]
+                for first in ['adder_test_module', 'adder_setup_test']:
+                    run_suite = FRUIT.test_suite(files)
+                    self.assertTrue(run_suite.build_run(
+                        driver, engine, output_dir=tmpdir, markers=True,
+                        history=filename))
+                    self.assertEqual(first, list(
+                        run_suite.case_failures)[0][0])
+                    with FRUIT.results_history(filename) as history:
+                        history.record(suite)
+                self.assertNotIn('driver.F90', [os.path.basename(name)
+                                                for name in engine.compiled])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_watch_build_run(self):
+        """Tests watching files and re-running affected tests."""
+
+        import shutil
+        import tempfile
+        import threading
+        import time
+        tmpdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmpdir, 'src')
+            os.mkdir(src)
+            shutil.copy('adder.F90', src)
+            files = []
+            for filename in ['setup.F90', 'adder_test.F90']:
+                shutil.copy(filename, tmpdir)
+                files.append(os.path.join(tmpdir, filename))
+            suite = FRUIT.test_suite(files)
+            build_command = [sys.executable, '-c',
+                             "open(%r + '/{exe}', 'w')" % tmpdir]
+            log = os.path.join(tmpdir, 'log')
+            script = "import sys\n"
+            script += "args = [open(arg[1:]).read() for arg in sys.argv[1:]]"
+            script += "\nopen(%r, 'a').write(repr(args) + '\\n')\n" % log
+            script += "print(' SUCCESSFUL!')\n"
+            changes = []
+
+            def change():
+                with open(os.path.join(src, 'adder.F90'), 'a') as f:
+                    f.write('! changed\n')
+
+            def callback(suite, changed):
+                changes.append(changed)
+                if changed is None:
+                    threading.Timer(0.3, change).start()
+
+            self.assertTrue(suite.watch_build_run(
+                os.path.join(src, 'driver.F90'), build_command,
+                [sys.executable, '-c', script], output_dir=tmpdir,
+                source_dirs=[src], interval=0.1, debounce=0.1,
+                callback=callback, max_cycles=2))
+            self.assertEqual([None, [os.path.abspath(
+                os.path.join(src, 'adder.F90'))]], changes)
+            with open(log) as f:
+                runs = f.read().splitlines()
+            self.assertEqual(['[]', "['adder_test_module\\n']"], runs)
+
+            generated = os.path.join(src, 'generated')
+            watcher = FRUIT.file_watcher([], [src], interval=5.,
+                                         ignore=[generated])
+            try:
+                new_dir = os.path.join(src, 'new')
+                os.mkdir(new_dir)
+                os.mkdir(generated)
+                with open(os.path.join(generated, 'unit.F90'), 'w') as f:
+                    f.write('! generated\n')
+                self.assertEqual([], watcher.changes())
+                if watcher.inotify is not None:
+                    watcher.sleep(0.)
+                    self.assertIn(new_dir, watcher.watches.values())
+                    self.assertNotIn(generated, watcher.watches.values())
+                    threading.Timer(0.1, lambda: open(os.path.join(
+                        new_dir, 'new.F90'), 'w').close()).start()
+                    start = time.time()
+                    watcher.sleep(5.)
+                    self.assertLess(time.time() - start, 2.)
+            finally:
+                watcher.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(sys.version_info < (3, 5), "requires Python 3.5")
+    def test_async(self):
+        """Tests running suites concurrently with asyncio."""
+
+        import asyncio
+        import time
+        import FRUIT_async
+        script = "import time; time.sleep(0.5); print(%r)"
+        outputs = [self.fruit_output((5, 5), (3, 3), []), self.fruit_output()]
+        suites = [FRUIT_async.async_test_suite([]) for output in outputs]
+        runs = [suite.async_run([sys.executable, '-c', script % output])
+                for suite, output in zip(suites, outputs)]
+        start = time.time()
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(
+                FRUIT_async.gather(*runs, max_concurrent=2))
+            self.assertLess(time.time() - start, 1.0)
+            self.assertEqual([True, False], results)
+            self.assertEqual((14, 16), (suites[1].asserts.success,
+                                        suites[1].asserts.total))
+            self.assertEqual(2, len(suites[1].messages))
+
+            suite = suites[0]
+            result = loop.run_until_complete(suite.async_run(
+                [sys.executable, '-c', script % outputs[0]], timeout=0.1))
+            self.assertFalse(result)
+            self.assertEqual('timeout', suite.stopped)
+
+            # cancelling the run kills the driver:
+            import tempfile
+            pid_file = tempfile.mktemp()
+            script = "import os, time\n"
+            script += "with open(%r, 'w') as f: f.write(str(os.getpid()))\n" \
+                      % pid_file
+            script += "time.sleep(30)\n"
+            task = loop.create_task(suite.async_run(
+                [sys.executable, '-c', script]))
+
+            def cancel_when_started():
+                if os.path.isfile(pid_file) and os.path.getsize(pid_file):
+                    task.cancel()
+                else:
+                    loop.call_later(0.02, cancel_when_started)
+
+            loop.call_later(0.02, cancel_when_started)
+            self.assertRaises(asyncio.CancelledError,
+                              loop.run_until_complete, task)
+            with open(pid_file) as f:
+                pid = int(f.read())
+            os.remove(pid_file)
+            self.assertRaises(OSError, os.kill, pid, 0)
+
+            self.assertIsInstance(suite.subsuite([]),
+                                  FRUIT_async.async_test_suite)
+        finally:
+            loop.close()
+
+
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(FRUITPyTestCase)
     unittest.TextTestRunner(verbosity=1).run(suite)